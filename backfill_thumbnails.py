@@ -0,0 +1,120 @@
+"""
+Backfill of the thumbnail derivatives of datalake images.
+
+Images uploaded by the tool or by ingest.py get their derivative when they are uploaded. This job
+renders and uploads the derivatives of the datalake.camera_image rows that existed before that.
+Rows are paged through in id order, and the id of the last completed page is recorded in a
+checkpoint file, so an interrupted run resumes where it stopped.
+
+Usage:
+    python backfill_thumbnails.py --workers 8
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# NOTE: This must be performed before boto3 is loaded, directly or indirectly via other imports.
+import ushr.qc.app.env
+ushr.qc.app.env.set_aws_env()
+
+import services
+import thumbnails
+
+log = logging.getLogger(__name__)
+
+
+def load_checkpoint(path):
+    # Return the id of the last row whose derivative was completed, or 0.
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)['last_id']
+    except (OSError, ValueError, KeyError):
+        return 0
+
+
+def save_checkpoint(path, last_id):
+    # Write to a temporary file first, so an interrupted write never leaves a truncated checkpoint.
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'last_id': last_id}, f)
+    os.replace(path + '.tmp', path)
+
+
+def rows_after(last_id, page_size, db_region):
+    """
+    Return the next page of (id, s3_location) rows of datalake.camera_image after last_id.
+    """
+    with services.db_connection(db_region) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(""" SELECT id, s3_location
+            FROM datalake.camera_image
+            WHERE id > %s
+            ORDER BY id
+            LIMIT %s""", (last_id, page_size))
+            return cursor.fetchall()
+
+
+def backfill_row(row, directory):
+    """
+    Render and upload the derivative of one row. Return True on success.
+    """
+    row_id, s3_location = row
+    try:
+        file, bucket, key = services.split_s3_location(s3_location)
+        # The original is only needed to render the derivative, so it is kept in memory.
+        data = services.read_file(bucket, key)
+        path = thumbnails.upload_thumbnail(data, bucket, key, directory)
+        os.remove(path)
+    except Exception as e:
+        log.warning(f"Thumbnail of row {row_id} ({s3_location}) failed; {e}")
+        return False
+    return True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-region', default='north_america')
+    parser.add_argument('--checkpoint', default='backfill_thumbnails_checkpoint.json',
+                        help='checkpoint file to resume from')
+    parser.add_argument('--workers', type=int, default=8, help='images rendered and uploaded at once')
+    parser.add_argument('--page-size', type=int, default=500, help='rows read per database query')
+    parser.add_argument('--limit', type=int, default=None, help='stop after this many rows')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    last_id = load_checkpoint(args.checkpoint)
+    print(f"Resuming after row {last_id}." if last_id else "Starting a new backfill.")
+
+    done = failed = 0
+    started = time.monotonic()
+    with tempfile.TemporaryDirectory() as directory, ThreadPoolExecutor(args.workers) as executor:
+        try:
+            while args.limit is None or done + failed < args.limit:
+                rows = rows_after(last_id, args.page_size, args.db_region)
+                if args.limit is not None:
+                    rows = rows[:args.limit - done - failed]
+                if not rows:
+                    break
+                results = list(executor.map(lambda row: backfill_row(row, directory), rows))
+                done += sum(results)
+                failed += len(results) - sum(results)
+                # The page is complete; failed rows are logged, and left for a run with --checkpoint reset.
+                last_id = rows[-1][0]
+                save_checkpoint(args.checkpoint, last_id)
+                elapsed = time.monotonic() - started
+                print(f"{done} thumbnails, {done / elapsed:.2f}/s; {failed} failed; last row {last_id}")
+        except KeyboardInterrupt:
+            print("Interrupted. Run again to resume from the last completed page.")
+
+    print(f"Done: {done} thumbnails, {failed} failed.")
+    return 0 if not failed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
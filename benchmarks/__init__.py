@@ -0,0 +1,8 @@
+"""
+Offline benchmarks of the tool's hot paths, run against local stand-ins for Nexar, s3 and the datalake.
+
+Run the benchmarks with:
+    python -m benchmarks.run --out before.json
+and compare two runs with:
+    python -m benchmarks.compare before.json after.json
+"""
@@ -0,0 +1,54 @@
+"""
+Compare two benchmark reports written by benchmarks.run.
+
+Usage:
+    python -m benchmarks.compare before.json after.json
+"""
+
+import argparse
+import json
+
+
+def compare(before, after, statistic='p50'):
+    """
+    Return a list of (metric, unit, before, after, change in percent, improved) for metrics in both reports.
+    """
+    lines = []
+    for name, metric in before['metrics'].items():
+        if name not in after['metrics']:
+            continue
+        old = metric[statistic]
+        new = after['metrics'][name][statistic]
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        improved = new < old if metric['better'] == 'lower' else new > old
+        lines.append((name, metric['unit'], old, new, change, improved))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('before', help='report of the baseline run')
+    parser.add_argument('after', help='report of the run to compare with the baseline')
+    parser.add_argument('--statistic', default='p50', choices=['mean', 'p50', 'p95', 'min', 'max'])
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    if before['config'] != after['config']:
+        changed = sorted(key for key in set(before['config']) | set(after['config'])
+                         if before['config'].get(key) != after['config'].get(key))
+        print(f"Warning: the runs used different settings: {', '.join(changed)}")
+
+    print(f"{'metric':32} {'unit':14} {'before':>12} {'after':>12} {'change':>9}")
+    for name, unit, old, new, change, improved in compare(before, after, args.statistic):
+        verdict = 'better' if improved else 'worse' if new != old else ''
+        print(f"{name:32} {unit:14} {old:12.4f} {new:12.4f} {change:+8.1f}% {verdict}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""
+Run the offline benchmarks headlessly and write a JSON report.
+
+The tool's own code paths are driven against the local stand-ins in benchmarks.standins:
+- search_nexar_latency: thread_search_nexar, from request to frames emitted.
+- search_datalake_latency: thread_search_datalake, from query to rows emitted.
+- datalake_grid_bytes: bytes read from s3 to fill the thumbnail grid with Datalake results.
+- thumbnail_throughput: thread_load_thumbnails, thumbnails downloaded and decoded per second.
+- full_image_time_to_display: a Nexar frame downloaded and decoded, ready to display.
+- full_image_time_to_preview: a Nexar frame received far enough for the first reduced resolution decode.
+- ingest_rate: the ingest.py pipeline, Nexar frames downloaded, uploaded to s3 and inserted per second.
+
+With --cache-daemon every fetch goes through a cache daemon, as on a server shared by copies of the tool.
+
+Usage:
+    python -m benchmarks.run --latency-ms 50 --image-kb 2000 --out before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime as dt
+
+LATITUDE = 33.98343972
+LONGITUDE = -84.21422089
+
+
+def summarize(samples, unit, better):
+    """
+    Return the summary statistics of a list of samples.
+    """
+    ordered = sorted(samples)
+    return {
+        'unit': unit,
+        'better': better,
+        'count': len(ordered),
+        'mean': statistics.fmean(ordered) if ordered else None,
+        'p50': ordered[len(ordered) // 2] if ordered else None,
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else None,
+        'min': ordered[0] if ordered else None,
+        'max': ordered[-1] if ordered else None,
+        'samples': samples,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except OSError:
+        return None
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default='benchmark_report.json', help='path of the JSON report to write')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of each measurement')
+    parser.add_argument('--frames', type=int, default=200, help='frames known to the mock Nexar server')
+    parser.add_argument('--datalake-rows', type=int, default=50, help='rows in the local datalake')
+    parser.add_argument('--thumbnails', type=int, default=32, help='thumbnails loaded per throughput run')
+    parser.add_argument('--ingest-workers', type=int, default=4, help='download and upload workers of ingest runs')
+    parser.add_argument('--radius', type=float, default=150, help='search radius in meters')
+    parser.add_argument('--latency-ms', type=float, default=50, help='latency of every Nexar response')
+    parser.add_argument('--s3-latency-ms', type=float, default=20, help='latency of every s3 transfer')
+    parser.add_argument('--db-latency-ms', type=float, default=5, help='latency of every database query')
+    parser.add_argument('--nexar-rate-limit', type=int, default=0,
+                        help='requests per second the mock Nexar server accepts before answering 429, 0 for unlimited')
+    parser.add_argument('--client-rate-limit', type=float, default=None,
+                        help='requests per second the tool sends to Nexar (default NEXAR_RATE_LIMIT), 0 for unlimited')
+    parser.add_argument('--bandwidth-mbps', type=float, default=0, help='payload bandwidth, 0 for unlimited')
+    parser.add_argument('--thumbnail-kb', type=int, default=20, help='minimum thumbnail payload size')
+    parser.add_argument('--thumbnail-size', type=parse_size, default='320x180', help='thumbnail WIDTHxHEIGHT')
+    parser.add_argument('--image-kb', type=int, default=2000, help='minimum full image payload size')
+    parser.add_argument('--image-size', type=parse_size, default='1920x1080', help='full image WIDTHxHEIGHT')
+    parser.add_argument('--no-derivatives', action='store_true',
+                        help='seed the Datalake without thumbnail derivatives, as before the backfill')
+    parser.add_argument('--cache-daemon', action='store_true',
+                        help='fetch Nexar and s3 objects through a cache daemon run in front of the stand-ins')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the generated data')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    out = os.path.abspath(args.out)
+
+    # Run without a display. This must be set before Qt is loaded.
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    from PyQt5 import QtGui, QtWidgets
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    import disk_cache
+    import local_index
+    import main as tool
+    import preview
+    import services
+    import thumbnail_pack
+    from benchmarks import standins
+
+    bandwidth = args.bandwidth_mbps * 1e6 / 8 or None
+    cwd = os.getcwd()
+    work = tempfile.mkdtemp(prefix='image_viewer_benchmark_')
+
+    nexar = standins.MockNexarServer(LATITUDE, LONGITUDE, frames=args.frames, latency=args.latency_ms / 1000,
+                                     bandwidth=bandwidth, thumbnail_size=args.thumbnail_size,
+                                     thumbnail_bytes=args.thumbnail_kb * 1000, image_size=args.image_size,
+                                     image_bytes=args.image_kb * 1000, rate_limit=args.nexar_rate_limit or None,
+                                     seed=args.seed)
+    store = standins.LocalObjectStore(os.path.join(work, 's3'), latency=args.s3_latency_ms / 1000, bandwidth=bandwidth)
+    datalake = standins.LocalDatalake(os.path.join(work, 'datalake.sqlite'), latency=args.db_latency_ms / 1000)
+    datalake.seed(store, LATITUDE, LONGITUDE, rows=args.datalake_rows, image_size=args.image_size,
+                  image_bytes=args.image_kb * 1000, derivatives=not args.no_derivatives, seed=args.seed)
+    nexar.start()
+    standins.install(nexar=nexar, store=store, datalake=datalake)
+    if args.client_rate_limit is not None:
+        services.nexar_limiter = services.TokenBucket(args.client_rate_limit, services.NEXAR_BURST)
+    shared_cache = None
+    if args.cache_daemon:
+        import cache_daemon
+        # The store outlives reset_caches, like the store shared by the copies of the tool on a server.
+        shared_cache = cache_daemon.CacheDaemon(os.path.join(work, 'cache_daemon'), port=0)
+        shared_cache.start()
+        cache_daemon.install(shared_cache.base_url)
+
+    # The tool keeps its caches relative to the working directory.
+    run_dir = os.path.join(work, 'run')
+    os.makedirs(run_dir)
+    os.chdir(run_dir)
+
+    def reset_caches():
+        # Let background cache writes finish first, or they would land in the emptied directories.
+        disk_cache.flush()
+        # The local index would otherwise answer searches from the previous run.
+        local_index.close()
+        thumbnail_pack.close()
+        for name in os.listdir(run_dir):
+            path = os.path.join(run_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+
+    def search_nexar():
+        thread = tool.thread_search_nexar()
+        thread.latitude = LATITUDE
+        thread.longitude = LONGITUDE
+        thread.radius_meters = args.radius
+        thread.auth_token = 'standin'
+        thread.directions = ['NORTH', 'SOUTH', 'EAST', 'WEST', 'NORTH_WEST', 'NORTH_EAST', 'SOUTH_WEST', 'SOUTH_EAST']
+        results = {}
+        thread.thread_search_nexar_frames.connect(results.update)
+        # Call run() directly, so signals are delivered synchronously in this thread.
+        thread.run()
+        return results.get('frames', [])
+
+    metrics = {}
+    try:
+        print('Measuring Nexar search latency ...')
+        samples = []
+        for _ in range(args.repeat):
+            reset_caches()
+            start = time.perf_counter()
+            frames = search_nexar()
+            samples.append(time.perf_counter() - start)
+        metrics['search_nexar_latency'] = summarize(samples, 's', 'lower')
+        metrics['search_nexar_latency']['frames'] = len(frames)
+
+        print('Measuring Datalake search latency ...')
+        samples = []
+        for _ in range(args.repeat):
+            rows = []
+            thread = tool.thread_search_datalake()
+            thread.latitude = LATITUDE
+            thread.longitude = LONGITUDE
+            thread.radius_meters = args.radius
+            thread.thread_search_datalake_rows.connect(rows.extend)
+            start = time.perf_counter()
+            thread.run()
+            samples.append(time.perf_counter() - start)
+        metrics['search_datalake_latency'] = summarize(samples, 's', 'lower')
+        metrics['search_datalake_latency']['rows'] = len(rows)
+
+        print('Measuring Datalake grid transfer ...')
+        samples = []
+        for _ in range(args.repeat):
+            reset_caches()
+            thread = tool.thread_load_thumbnails()
+            thread.display_mode = 1
+            thread.items = list(enumerate(rows[:thread.slots]))
+            before = store.bytes_read
+            thread.run()
+            samples.append(store.bytes_read - before)
+        metrics['datalake_grid_bytes'] = summarize(samples, 'bytes', 'lower')
+
+        print('Measuring thumbnail throughput ...')
+        samples = []
+        for _ in range(args.repeat):
+            reset_caches()
+            loaded = []
+            thread = tool.thread_load_thumbnails()
+            thread.display_mode = 2
+            thread.items = list(enumerate(frames[:args.thumbnails]))
+            thread.slots = args.thumbnails
+            thread.max_thumbnails = args.thumbnails
+            thread.auth_token = 'standin'
+            # The thread decodes thumbnails, so the images emitted are ready to display.
+            thread.thread_load_thumbnails_image.connect(lambda slot, index, image: loaded.append(image))
+            start = time.perf_counter()
+            thread.run()
+            elapsed = time.perf_counter() - start
+            samples.append(len(loaded) / elapsed if elapsed else 0.0)
+        metrics['thumbnail_throughput'] = summarize(samples, 'thumbnails/s', 'higher')
+
+        print('Measuring full image time-to-display ...')
+        samples = []
+        preview_samples = []
+        os.makedirs('full_images', exist_ok=True)
+        for frame in frames[:args.repeat]:
+            url = frame['frame_url']
+            path = 'full_images/' + url.split('/')[-1]
+            first_preview = []
+
+            def progress(partial, received, expected):
+                # The first partial decode is what the preview window shows first.
+                if not first_preview:
+                    with open(partial, 'rb') as f:
+                        if preview.decode_partial(f.read()) is not None:
+                            first_preview.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            services.download_nexar_file(url, path, 'standin', progress=progress)
+            image = QtGui.QImage(path)
+            samples.append(time.perf_counter() - start)
+            preview_samples.append(first_preview[0] if first_preview else samples[-1])
+            if image.isNull():
+                raise RuntimeError(f'Full image could not be decoded: {path}')
+        metrics['full_image_time_to_display'] = summarize(samples, 's', 'lower')
+        metrics['full_image_time_to_preview'] = summarize(preview_samples, 's', 'lower')
+
+        print('Measuring ingest rate ...')
+        import ingest
+        samples = []
+        for repeat in range(args.repeat):
+            reset_caches()
+            # A fresh database every time, or the frames ingested by the last run would be skipped.
+            standins.install(datalake=standins.LocalDatalake(os.path.join(work, f'ingest{repeat}.sqlite'),
+                                                             latency=args.db_latency_ms / 1000))
+            checkpoint = ingest.Checkpoint(os.path.join(run_dir, 'checkpoint.sqlite'))
+            ingestion = ingest.Ingestion(LATITUDE, LONGITUDE, args.radius, tool.NEXAR_START_TIME,
+                                         int(time.time() * 1000), checkpoint,
+                                         download_workers=args.ingest_workers, upload_workers=args.ingest_workers)
+            start = time.perf_counter()
+            counts = ingestion.run(report=lambda msg: None)
+            elapsed = time.perf_counter() - start
+            checkpoint.close()
+            samples.append(counts['ingested'] / elapsed if elapsed else 0.0)
+        standins.install(datalake=datalake)
+        metrics['ingest_rate'] = summarize(samples, 'frames/s', 'higher')
+
+    finally:
+        os.chdir(cwd)
+        nexar.stop()
+        if shared_cache is not None:
+            shared_cache.stop()
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {
+        'created': dt.now().isoformat(timespec='seconds'),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'revision': git_revision()},
+        'config': {key: value for key, value in vars(args).items() if key != 'out'},
+        'metrics': metrics,
+        # Requests refused by the mock server show whether the client side limiter kept under its limit.
+        'nexar_requests': {'received': nexar.requests, 'refused': nexar.refused},
+    }
+    if shared_cache is not None:
+        report['cache_daemon'] = shared_cache.summary()
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, metric in metrics.items():
+        print(f"{name}: p50 {metric['p50']:.4f} {metric['unit']}, mean {metric['mean']:.4f} {metric['unit']}")
+    print(f'Report written to {out}')
+
+
+if __name__ == '__main__':
+    main()
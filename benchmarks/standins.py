@@ -0,0 +1,424 @@
+"""
+Local stand-ins for the remote services, with configurable latency, bandwidth and payload sizes.
+
+- MockNexarServer is an HTTP server speaking the subset of the Nexar API the tool uses.
+- LocalObjectStore keeps s3 objects in a local directory.
+- LocalDatalake is a sqlite database with a datalake.camera_image table, and the handful of
+  PostGIS functions the tool's queries use registered as Python functions.
+
+install() points the services module at them.
+"""
+
+import io
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime as dt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import shapely.geometry
+import shapely.wkb
+import shapely.wkt
+from PIL import Image
+
+import services
+import thumbnails
+
+# Size of the chunks payloads are sent in when bandwidth is limited.
+CHUNK_SIZE = 64 * 1024
+
+DIRECTIONS = ['NORTH', 'NORTH_EAST', 'EAST', 'SOUTH_EAST', 'SOUTH', 'SOUTH_WEST', 'WEST', 'NORTH_WEST']
+
+
+def make_jpeg(size, payload_bytes, seed):
+    """
+    Return JPEG bytes of a noisy image of size (width, height), padded to at least payload_bytes.
+    JPEG decoders ignore data after the end of image marker, so the padding keeps the image valid.
+    """
+    rng = random.Random(seed)
+    width, height = size
+    image = Image.frombytes('RGB', (width, height), rng.randbytes(width * height * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    data = buffer.getvalue()
+    if len(data) < payload_bytes:
+        data += bytes(payload_bytes - len(data))
+    return data
+
+
+def throttle(write, data, bandwidth):
+    """
+    Write data in chunks, sleeping so the rate stays under bandwidth bytes per second (None for unlimited).
+    """
+    if not bandwidth:
+        write(data)
+        return
+    for start in range(0, len(data), CHUNK_SIZE):
+        chunk = data[start:start + CHUNK_SIZE]
+        write(chunk)
+        time.sleep(len(chunk) / bandwidth)
+
+
+class MockNexarServer:
+    """
+    A local HTTP server answering frame searches, thumbnail and frame downloads, and token refreshes.
+    """
+
+    def __init__(self, latitude, longitude, frames=200, spread_degrees=0.003, latency=0.05, bandwidth=None,
+                 thumbnail_size=(320, 180), thumbnail_bytes=20000, image_size=(1920, 1080),
+                 image_bytes=2000000, distinct_images=16, rate_limit=None, seed=0):
+        """
+        Parameters:
+        - latitude, longitude: float, the center the generated frames are scattered around.
+        - frames: int, the number of frames the server knows about.
+        - spread_degrees: float, how far from the center frames are scattered.
+        - latency: float, seconds added before every response.
+        - bandwidth: float, bytes per second for image payloads, or None for unlimited.
+        - thumbnail_size, image_size: tuple, (width, height) of the generated images.
+        - thumbnail_bytes, image_bytes: int, minimum payload size of the generated images.
+        - distinct_images: int, number of different images served, reused across frames.
+        - rate_limit: int, requests accepted per second, or None for unlimited. Requests over the limit
+          are refused with 429 Too Many Requests and a Retry-After header, like Nexar does.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self.refused = 0
+        self._window = (0, 0)
+        self._window_lock = threading.Lock()
+
+        rng = random.Random(seed)
+        self.thumbnails = [make_jpeg(thumbnail_size, thumbnail_bytes, seed * 1000 + n) for n in range(distinct_images)]
+        self.images = [make_jpeg(image_size, image_bytes, seed * 1000 + n) for n in range(distinct_images)]
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+        now_ms = int(time.time() * 1000)
+        self.frames = []
+        for n in range(frames):
+            heading = rng.uniform(0, 360)
+            self.frames.append({
+                'frame_id': f'standin{n:06d}',
+                'gps_info': {'latitude': latitude + rng.uniform(-spread_degrees, spread_degrees),
+                             'longitude': longitude + rng.uniform(-spread_degrees, spread_degrees)},
+                'direction': DIRECTIONS[int(((heading + 22.5) % 360) // 45)],
+                'captured_at': now_ms - rng.randint(0, 5 * 365 * 86400) * 1000,
+                'camera_heading': heading,
+                'frame_quality': round(rng.uniform(0.5, 1.0), 3),
+                'frame_context': rng.choice(['DAYLIGHT', 'NIGHTTIME']),
+                'thumbnail_url': f'{self.base_url}/thumbnails/{n % distinct_images}/standin{n:06d}.jpg',
+                'frame_url': f'{self.base_url}/frames/{n % distinct_images}/standin{n:06d}.jpg',
+            })
+        self.frames.sort(key=lambda frame: frame['captured_at'])
+
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def admit(self):
+        # Count a request against the current one second window. Return False if it is over the limit.
+        if not self.rate_limit:
+            return True
+        with self._window_lock:
+            second, count = self._window
+            now = int(time.time())
+            if now != second:
+                second, count = now, 0
+            self._window = (second, count + 1)
+            if count < self.rate_limit:
+                return True
+            self.refused += 1
+            return False
+
+    def search(self, query):
+        # Apply the bounding box and filters of a frame search to the known frames.
+        box = query['bounding_box']
+        filters = query.get('filters', {})
+        directions = set(filters.get('directions') or DIRECTIONS)
+        matches = []
+        for frame in self.frames:
+            latitude = frame['gps_info']['latitude']
+            longitude = frame['gps_info']['longitude']
+            if not box['south_west']['latitude'] <= latitude <= box['north_east']['latitude']:
+                continue
+            if not box['south_west']['longitude'] <= longitude <= box['north_east']['longitude']:
+                continue
+            if frame['direction'] not in directions:
+                continue
+            if frame['frame_quality'] < filters.get('min_frame_quality', 0):
+                continue
+            if not filters.get('start_time', 0) <= frame['captured_at'] <= filters.get('end_time', float('inf')):
+                continue
+            matches.append(frame)
+        return {'frames': matches}
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_payload(self, data, content_type):
+                # Honour "Range: bytes=N-" so interrupted downloads can resume.
+                status = 200
+                match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+                if match and int(match.group(1)) < len(data):
+                    start = int(match.group(1))
+                    status = 206
+                    self.send_response(status)
+                    self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+                    data = data[start:]
+                else:
+                    self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('Accept-Ranges', 'bytes')
+                self.end_headers()
+                throttle(self.wfile.write, data, server.bandwidth if content_type == 'image/jpeg' else None)
+
+            def refuse(self):
+                self.send_response(429)
+                self.send_header('Retry-After', '1')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                server.requests += 1
+                time.sleep(server.latency)
+                if not server.admit():
+                    self.refuse()
+                    return
+                parts = self.path.strip('/').split('/')
+                if len(parts) == 3 and parts[0] in ('thumbnails', 'frames'):
+                    pool = server.thumbnails if parts[0] == 'thumbnails' else server.images
+                    self.send_payload(pool[int(parts[1]) % len(pool)], 'image/jpeg')
+                else:
+                    self.send_error(404)
+
+            def do_POST(self):
+                server.requests += 1
+                time.sleep(server.latency)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not server.admit():
+                    self.refuse()
+                    return
+                if self.path.endswith('/frames'):
+                    data = server.search(json.loads(body))
+                elif self.path.endswith('/refresh-token'):
+                    data = {'token_type': 'Bearer', 'access_token': 'standin'}
+                else:
+                    self.send_error(404)
+                    return
+                self.send_payload(json.dumps(data).encode(), 'application/json')
+
+        return Handler
+
+
+class LocalObjectStore:
+    """
+    s3 objects kept under a local directory, one sub directory per bucket.
+    """
+
+    def __init__(self, root, latency=0.02, bandwidth=None):
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.downloads = 0
+        self.uploads = 0
+        self.bytes_read = 0
+
+    def object_path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def put(self, bucket, key, data):
+        path = self.object_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def read_file(self, bucket, key):
+        self.downloads += 1
+        time.sleep(self.latency)
+        source = self.object_path(bucket, key)
+        if not os.path.exists(source):
+            raise FileNotFoundError(f'No such key: s3://{bucket}/{key}')
+        with open(source, 'rb') as f:
+            data = f.read()
+        self.bytes_read += len(data)
+        received = []
+        throttle(received.append, data, self.bandwidth)
+        return b''.join(received)
+
+    def download_file(self, path, bucket, key):
+        data = self.read_file(bucket, key)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def upload_file(self, path, bucket, key):
+        self.uploads += 1
+        time.sleep(self.latency)
+        destination = self.object_path(bucket, key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copyfile(path, destination)
+
+
+def _geometry(value):
+    # Geometries are stored as WKT, or as hex WKB when inserted the way thread_updateDB does.
+    text = str(value)
+    if text.upper().startswith(('POINT', 'POLYGON')):
+        return shapely.wkt.loads(text)
+    return shapely.wkb.loads(text, hex=True)
+
+
+def _translate(sql, params):
+    """
+    Translate a psycopg2 style query to sqlite: %s placeholders become ?, and list parameters
+    of "= ANY(%s)" are expanded into "IN (?, ...)".
+    """
+    sql = re.sub(r'=\s*ANY\(%s\)', 'IN %s', sql, flags=re.IGNORECASE)
+    pieces = sql.split('%s')
+    translated = [pieces[0]]
+    flat = []
+    for param, piece in zip(params or (), pieces[1:]):
+        if isinstance(param, (list, tuple)):
+            translated.append('(' + ', '.join('?' * len(param)) + ')' if param else '(NULL)')
+            flat.extend(param)
+        else:
+            translated.append('?')
+            flat.append(param)
+        translated.append(piece)
+    return ''.join(translated), flat
+
+
+class _Cursor:
+
+    def __init__(self, cursor, latency):
+        self.cursor = cursor
+        self.latency = latency
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cursor.close()
+
+    def execute(self, sql, params=None):
+        time.sleep(self.latency)
+        self.cursor.execute(*_translate(sql, params))
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+
+class _Connection:
+
+    def __init__(self, path, latency):
+        self.latency = latency
+        self.conn = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        self.conn.execute('ATTACH DATABASE ? AS datalake', (path,))
+        self.conn.create_function('st_point', 2, lambda x, y: f'POINT({x} {y})')
+        self.conn.create_function('st_setsrid', 2, lambda geom, srid: geom)
+        self.conn.create_function('st_astext', 1, lambda geom: _geometry(geom).wkt)
+        self.conn.create_function('st_makeenvelope', 5,
+                                  lambda west, south, east, north, srid: shapely.geometry.box(west, south, east, north).wkt)
+        self.conn.create_function('st_intersects', 2, lambda a, b: _geometry(a).intersects(_geometry(b)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # Like psycopg2, leaving the block commits unless there was an error.
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        self.conn.close()
+
+    def cursor(self):
+        return _Cursor(self.conn.cursor(), self.latency)
+
+    # Used by services.db_connection, which keeps the connection open for reuse.
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+class LocalDatalake:
+    """
+    A sqlite file standing in for the datalake database, with a datalake.camera_image table.
+    """
+
+    def __init__(self, path, latency=0.005):
+        self.path = path
+        self.latency = latency
+        with sqlite3.connect(path) as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS camera_image (
+                id INTEGER PRIMARY KEY, s3_location TEXT UNIQUE, asset_id TEXT, processing_index INTEGER,
+                geom TEXT, version TEXT, datetime TIMESTAMP, vehicle_heading REAL, image_heading REAL,
+                cam_id TEXT)""")
+
+    def connect_to_db(self, db_region):
+        return _Connection(self.path, self.latency)
+
+    def seed(self, store, latitude, longitude, rows=50, spread_degrees=0.003, image_size=(1920, 1080),
+             image_bytes=2000000, distinct_images=16, derivatives=True, seed=0):
+        """
+        Insert rows near (latitude, longitude), and put their images in the object store,
+        with their thumbnail derivatives unless derivatives is False.
+        """
+        rng = random.Random(seed)
+        images = [make_jpeg(image_size, image_bytes, seed * 1000 + 500 + n) for n in range(distinct_images)]
+        rendered = [thumbnails.render(image) for image in images] if derivatives else None
+        with sqlite3.connect(self.path) as conn:
+            for n in range(rows):
+                file = f'datalake{n:06d}.jpg'
+                store.put('ushr-image', file, images[n % distinct_images])
+                if derivatives:
+                    store.put('ushr-image', thumbnails.thumbnail_name(file), rendered[n % distinct_images])
+                point = (f'POINT({longitude + rng.uniform(-spread_degrees, spread_degrees)} '
+                         f'{latitude + rng.uniform(-spread_degrees, spread_degrees)})')
+                conn.execute("""INSERT OR IGNORE INTO camera_image
+                    (s3_location, asset_id, processing_index, geom, version, datetime, vehicle_heading, image_heading, cam_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                             (f's3://ushr-image/{file}', f'asset{n % 10}', n, point, 'standin',
+                              dt.fromtimestamp(time.time() - rng.randint(0, 5 * 365 * 86400)),
+                              rng.uniform(0, 360), rng.uniform(0, 360), 'cam0'))
+
+
+def install(nexar=None, store=None, datalake=None):
+    """
+    Point the services module at the given stand-ins. Stand-ins left as None are not installed.
+    """
+    if nexar is not None:
+        services.NEXAR_BASE_URL = nexar.base_url
+        services.NEXAR_FRAMES_URL = nexar.base_url + '/api/virtualcam/v4/frames'
+        services.NEXAR_REFRESH_TOKEN_URL = nexar.base_url + '/dev-portal/refresh-token'
+    if store is not None:
+        services.download_file = store.download_file
+        services.read_file = store.read_file
+        services.upload_file = store.upload_file
+    if datalake is not None:
+        services.connect_to_db = datalake.connect_to_db
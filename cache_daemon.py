@@ -0,0 +1,422 @@
+"""
+A local daemon caching Nexar thumbnails and frames and s3 objects for every copy of the tool on a server.
+
+Each copy of the tool keeps its own thumbnails/, full_images/ and datalake_images/ under its working
+directory, so copies run side by side download the same objects again and again. The daemon keeps
+one store for all of them: a copy asks the daemon for an object, and the daemon serves it from the
+store, or fetches it once into the store while every other request for it waits. Its Nexar downloads
+also share one rate limiter, where separate copies would each use the whole limit.
+
+The daemon is started on the server, with the s3 credentials of a user allowed to read the buckets:
+    python cache_daemon.py --root /srv/image_viewer_cache --max-gb 200
+and copies of the tool use it when started with its address:
+    IMAGE_VIEWER_CACHE_DAEMON=http://127.0.0.1:8765
+
+The Nexar token of the first request for a frame fetches it; later requests are served from the store,
+so the daemon must only listen where every client is trusted. Objects served to a copy on the same file
+system are hard linked into its directories rather than copied, so they must not be edited in place.
+When the daemon can't be reached the tool fetches directly, as without it. CacheDaemon also runs in
+process, in front of the stand-ins of the benchmarks.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import shutil
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# NOTE: This must be performed before boto3 is loaded, directly or indirectly via other imports.
+# Without the internal package, as in tests against stand-ins, the AWS environment is left as it is.
+try:
+    import ushr.qc.app.env
+except ImportError:
+    pass
+else:
+    ushr.qc.app.env.set_aws_env()
+
+import services
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# Seconds the tool fetches directly after failing to reach the daemon, before trying it again.
+UNREACHABLE_RETRY = 30
+
+# The services functions replaced by the client.
+FETCHES = ['download_nexar_file', 'read_nexar_file', 'download_file', 'read_file']
+
+
+class CacheDaemon:
+    """
+    An HTTP server fetching objects into a store on disk and serving them from it,
+    bounded by the total size of its files, least recently served evicted first.
+
+    - GET /nexar?url=URL, with the Authorization header of the Nexar API, serves a Nexar thumbnail or frame.
+    - GET /s3?bucket=BUCKET&key=KEY serves an s3 object.
+    - GET /stats serves the statistics of summary() as JSON.
+
+    Objects are served with X-Cache (hit or miss) and X-Cache-Path (the file in the store) headers.
+    An object that can't be fetched is answered with 502 and the error as text.
+    """
+
+    def __init__(self, root, host=DEFAULT_HOST, port=DEFAULT_PORT, max_bytes=None):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        # The direct fetches, taken before a client could be installed in the same process.
+        self.download_nexar_file = services.download_nexar_file
+        self.download_file = services.download_file
+        self.lock = threading.Lock()
+        # Size of every file in the store by path, least recently served first.
+        self.files = OrderedDict()
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'fetched': 0, 'failed': 0, 'evicted': 0,
+                      'bytes_served': 0, 'bytes_fetched': 0}
+        self.scan()
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.base_url = f'http://{host}:{self.server.server_address[1]}'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def scan(self):
+        # Load the files left in the store by an earlier run, oldest first.
+        found = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith(services.PARTIAL_EXTENSION):
+                    path = os.path.join(directory, name)
+                    status = os.stat(path)
+                    found.append((status.st_mtime, path, status.st_size))
+        for _, path, size in sorted(found):
+            self.files[path] = size
+            self.bytes += size
+        self.evict()
+
+    def start(self):
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def store_path(self, kind, name):
+        # Objects are stored by a digest of their url or s3 location, which can't escape the store.
+        digest = hashlib.sha1(name.encode()).hexdigest()
+        extension = posixpath.splitext(urllib.parse.urlsplit(name).path)[1][:8]
+        return os.path.join(self.root, kind, digest[:2], digest + extension)
+
+    def get(self, path, fetch):
+        """
+        Open path in the store for reading, calling fetch(path) to fetch it if it isn't in the store.
+        Concurrent requests for a path missing from the store share one fetch.
+        Return (hit, file): whether it was already in the store, and the open file.
+        """
+        f = self.open_stored(path)
+        with self.lock:
+            self.stats['hits' if f is not None else 'misses'] += 1
+        if f is not None:
+            return True, f
+
+        def fill():
+            with self.lock:
+                if path in self.files:
+                    return
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fetch(path)
+            size = os.path.getsize(path)
+            with self.lock:
+                self.stats['fetched'] += 1
+                self.stats['bytes_fetched'] += size
+                self.bytes += size - self.files.pop(path, 0)
+                self.files[path] = size
+            self.evict()
+
+        while True:
+            services.coalesce(('store', path), fill)
+            f = self.open_stored(path)
+            if f is not None:
+                return False, f
+            # Evicted by other fetches before it could be opened; fetched again.
+
+    def open_stored(self, path):
+        # Open a file of the store and mark it as just served, or return None if it isn't in the store.
+        # Opened holding the lock, so it can't be evicted first; an open file is still read once removed.
+        with self.lock:
+            if path not in self.files:
+                return None
+            try:
+                f = open(path, 'rb')
+            except FileNotFoundError:
+                # Removed from outside the daemon.
+                self.bytes -= self.files.pop(path)
+                return None
+            self.files.move_to_end(path)
+            return f
+
+    def evict(self):
+        # Remove the least recently served files past the bound. Copies linked by clients are left to them.
+        if not self.max_bytes:
+            return
+        evicted = []
+        with self.lock:
+            while self.bytes > self.max_bytes and len(self.files) > 1:
+                path, size = self.files.popitem(last=False)
+                self.bytes -= size
+                evicted.append(path)
+            self.stats['evicted'] += len(evicted)
+        for path in evicted:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def summary(self):
+        """
+        Return the statistics: hits and misses of the store, fetched (misses fetched; the rest waited
+        for a fetch already running), failed fetches, evicted files, bytes served and fetched,
+        and the files and bytes in the store.
+        """
+        with self.lock:
+            summary = dict(self.stats)
+            summary['files'] = len(self.files)
+            summary['bytes'] = self.bytes
+        requests_served = summary['hits'] + summary['misses']
+        summary['hit_rate'] = summary['hits'] / requests_served if requests_served else 0.0
+        return summary
+
+    def _handler_class(self):
+        daemon = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                log.debug(format, *args)
+
+            def send_text(self, status, text, content_type='text/plain'):
+                data = text.encode()
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                parts = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(parts.query))
+
+                if parts.path == '/stats':
+                    self.send_text(200, json.dumps(daemon.summary()), 'application/json')
+                    return
+                if parts.path == '/nexar' and 'url' in query:
+                    url = query['url']
+                    token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+                    path = daemon.store_path('nexar', url)
+                    fetch = lambda path: daemon.download_nexar_file(url, path, token)
+                elif parts.path == '/s3' and 'bucket' in query and 'key' in query:
+                    bucket, key = query['bucket'], query['key']
+                    path = daemon.store_path('s3', f's3://{bucket}/{key}')
+                    fetch = lambda path: daemon.download_file(path, bucket, key)
+                else:
+                    self.send_text(404, f'Unknown request: {self.path}')
+                    return
+
+                try:
+                    hit, f = daemon.get(path, fetch)
+                except Exception as e:
+                    with daemon.lock:
+                        daemon.stats['failed'] += 1
+                    self.send_text(502, str(e))
+                    return
+
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(size))
+                    self.send_header('X-Cache', 'hit' if hit else 'miss')
+                    self.send_header('X-Cache-Path', path)
+                    self.end_headers()
+                    shutil.copyfileobj(f, self.wfile, services.DOWNLOAD_CHUNK_SIZE)
+                with daemon.lock:
+                    daemon.stats['bytes_served'] += size
+
+        return Handler
+
+
+class CacheClient:
+    """
+    Replacements of the services fetches, asking the daemon at base_url for every object.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        # The direct fetches, used while the daemon can't be reached.
+        self.direct = {name: getattr(services, name) for name in FETCHES}
+        self.unreachable_until = 0.0
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'linked': 0, 'direct': 0}
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def request(self, endpoint, params, headers=None):
+        # Return the streamed response of the daemon, or None if it can't be reached.
+        if time.monotonic() < self.unreachable_until:
+            self.count('direct')
+            return None
+        try:
+            response = requests.get(self.base_url + endpoint, params=params, headers=headers, stream=True,
+                                    timeout=services.DOWNLOAD_TIMEOUT)
+        except requests.ConnectionError as e:
+            log.warning(f"Cache daemon {self.base_url} can't be reached, fetching directly for "
+                        f"{UNREACHABLE_RETRY} s; {e}")
+            self.unreachable_until = time.monotonic() + UNREACHABLE_RETRY
+            self.count('direct')
+            return None
+        if response.status_code != 200:
+            text = response.text
+            response.close()
+            raise services.IncompleteDownload(f'Cache daemon could not fetch {params}; {text}')
+        self.count('hits' if response.headers.get('X-Cache') == 'hit' else 'misses')
+        return response
+
+    def save(self, response, path, progress=None):
+        # Link the file in the store to path when it is on the same file system, or write the body to path.
+        partial = path + services.PARTIAL_EXTENSION
+        if os.path.exists(partial):
+            os.remove(partial)
+        shared = response.headers.get('X-Cache-Path')
+        if shared:
+            try:
+                os.link(shared, partial)
+            except OSError:
+                pass
+            else:
+                os.replace(partial, path)
+                self.count('linked')
+                return
+
+        expected = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+        with open(partial, 'wb') as f:
+            received = 0
+            for chunk in response.iter_content(services.DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                received += len(chunk)
+                if progress is not None:
+                    f.flush()
+                    progress(partial, received, expected)
+        if expected is not None and received != expected:
+            os.remove(partial)
+            raise services.IncompleteDownload(f'Received {received} of {expected} bytes of {path} '
+                                              f'from the cache daemon')
+        os.replace(partial, path)
+
+    def read(self, response):
+        data = response.content
+        if 'Content-Length' in response.headers and len(data) != int(response.headers['Content-Length']):
+            raise services.IncompleteDownload(f"Received {len(data)} of {response.headers['Content-Length']} "
+                                              f"bytes from the cache daemon")
+        return data
+
+    def download_nexar_file(self, url, path, auth_token, progress=None):
+        def fetch():
+            response = self.request('/nexar', {'url': url}, {'Authorization': 'Bearer ' + auth_token})
+            if response is None:
+                return self.direct['download_nexar_file'](url, path, auth_token, progress=progress)
+            with response:
+                self.save(response, path, progress)
+        # Keyed apart from the direct download, which coalesces with the same key itself.
+        services.coalesce(('daemon_file', url, path), fetch)
+
+    def read_nexar_file(self, url, auth_token, attempts=services.DOWNLOAD_ATTEMPTS):
+        response = self.request('/nexar', {'url': url}, {'Authorization': 'Bearer ' + auth_token})
+        if response is None:
+            return self.direct['read_nexar_file'](url, auth_token, attempts)
+        with response:
+            return self.read(response)
+
+    def download_file(self, path, bucket, key):
+        def fetch():
+            response = self.request('/s3', {'bucket': bucket, 'key': key})
+            if response is None:
+                return self.direct['download_file'](path, bucket, key)
+            with response:
+                self.save(response, path)
+        services.coalesce(('daemon_s3', path), fetch)
+
+    def read_file(self, bucket, key):
+        response = self.request('/s3', {'bucket': bucket, 'key': key})
+        if response is None:
+            return self.direct['read_file'](bucket, key)
+        with response:
+            return self.read(response)
+
+    def summary(self):
+        """
+        Return the statistics of this client: hits and misses of the daemon's store, objects linked
+        rather than copied, and fetches made directly while the daemon couldn't be reached.
+        """
+        with self.lock:
+            return dict(self.stats)
+
+
+def install(base_url):
+    """
+    Fetch Nexar thumbnails and frames and s3 objects through the daemon at base_url. Return the CacheClient.
+    """
+    client = CacheClient(base_url)
+    for name in FETCHES:
+        setattr(services, name, getattr(client, name))
+    return client
+
+
+def install_from_environment():
+    """
+    Fetch through the daemon at the address in IMAGE_VIEWER_CACHE_DAEMON, if set.
+    """
+    base_url = os.environ.get('IMAGE_VIEWER_CACHE_DAEMON')
+    if not base_url:
+        return None
+    return install(base_url)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve Nexar and s3 objects to the copies of the tool on this '
+                                                 'server from one shared store.')
+    parser.add_argument('--root', default=os.environ.get('IMAGE_VIEWER_CACHE_ROOT', 'shared_cache'),
+                        help='directory of the store')
+    parser.add_argument('--host', default=DEFAULT_HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--max-gb', type=float, default=0, help='bound of the store in GB, 0 for unbounded')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    daemon = CacheDaemon(args.root, args.host, args.port, int(args.max_gb * 1e9) or None)
+    summary = daemon.summary()
+    log.info(f"Serving {summary['files']} files ({summary['bytes'] / 1e9:.2f} GB) from {daemon.root} "
+             f"at {daemon.base_url}")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server.server_close()
+        log.info(f'Statistics: {json.dumps(daemon.summary())}')
+
+
+if __name__ == '__main__':
+    main()
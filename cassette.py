@@ -0,0 +1,608 @@
+"""
+Record and replay of the tool's Nexar, s3 and database interactions.
+
+A cassette is a single zip file holding an index of every interaction, in the order they happened,
+and the response bodies and s3 objects as content addressed blobs, so repeated payloads are stored once.
+While recording, the index and blobs are written to files next to the cassette as interactions happen,
+and are merged into the cassette when the tool exits. A session cut short by a crash can still be
+replayed from those files, up to the last segment of blobs closed.
+
+Recording and replay are turned on with environment variables before the tool starts:
+    IMAGE_VIEWER_CASSETTE=session.cassette
+    IMAGE_VIEWER_CASSETTE_MODE=record            # or replay
+    IMAGE_VIEWER_CASSETTE_TIMING=fast            # replay only: fast, or recorded to keep the recorded latencies
+
+Recording only adds a write of payloads already in memory, made by a writer thread of its own, so it
+can stay on during normal use. The tokens of token refresh responses are replaced before they are
+recorded, so a cassette can be shared without leaking a live token.
+In replay mode nothing reaches the network, s3 or the database.
+"""
+
+import atexit
+import base64
+import hashlib
+import glob
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import zipfile
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+
+import requests.structures
+
+import services
+
+log = logging.getLogger(__name__)
+
+INDEX_NAME = 'index.jsonl'
+# Appended to the cassette path for the index and the numbered blob segments written while recording.
+INDEX_SUFFIX = '.index.jsonl'
+SEGMENT_SUFFIX = '.segment-'
+# Seconds of recording in a segment before the next one is started.
+SEGMENT_INTERVAL = 30
+# Size of the chunks blobs are copied in, when the segments are merged.
+COPY_CHUNK_SIZE = 1024 * 1024
+# Writes queued for the writer thread before recording waits for it, bounding the payloads held in memory.
+MAX_PENDING_WRITES = 64
+# Fields of a token refresh response replaced before it is recorded, and what they are replaced with.
+TOKEN_FIELDS = ['access_token', 'refresh_token', 'id_token']
+REDACTED = 'redacted'
+
+
+class CassetteMiss(LookupError):
+    """
+    Raised in replay mode for an interaction that is not in the cassette.
+    """
+
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def _request_digest(kwargs):
+    # Identify a request body, whichever way it was passed.
+    body = kwargs.get('json', kwargs.get('data'))
+    if body is None:
+        return None
+    return _digest(json.dumps(body, sort_keys=True, default=str).encode())
+
+
+def _redact_tokens(content):
+    # Replace the tokens of a token refresh response, so no live credential is written to a cassette.
+    # Replay never reaches Nexar, so a placeholder serves as well as the token.
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return content
+    if not isinstance(data, dict):
+        return content
+    for field in TOKEN_FIELDS:
+        if field in data:
+            data[field] = REDACTED
+    return json.dumps(data).encode()
+
+
+def _encode(value):
+    # Encode a database value as JSON, keeping types the tool relies on.
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'$bytes': base64.b64encode(bytes(value)).decode()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def _decode(value):
+    if isinstance(value, dict):
+        if '$datetime' in value:
+            return datetime.fromisoformat(value['$datetime'])
+        if '$date' in value:
+            return date.fromisoformat(value['$date'])
+        if '$bytes' in value:
+            return base64.b64decode(value['$bytes'])
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+class CassetteResponse:
+    """
+    A replayed HTTP response, offering the parts of requests.Response the tool uses.
+    """
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        size = chunk_size or len(self.content) or 1
+        for start in range(0, len(self.content), size):
+            yield self.content[start:start + size]
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise requests.HTTPError(f'{self.status_code} for url: {self.url}', response=self)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class _RecordingStream:
+    """
+    Wraps a streamed requests.Response, recording its body once it has been read through.
+    """
+
+    def __init__(self, response, record):
+        self._response = response
+        self._record = record
+        self._chunks = []
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._response.close()
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for chunk in self._response.iter_content(chunk_size, decode_unicode):
+            self._chunks.append(chunk)
+            yield chunk
+        self._record(b''.join(self._chunks))
+
+    @property
+    def content(self):
+        content = self._response.content
+        self._record(content)
+        return content
+
+
+class Recorder:
+    """
+    Records interactions into a new cassette file.
+
+    Blobs are written to segment files, a new one every SEGMENT_INTERVAL seconds, and the index to a file
+    of its own, line by line. They are merged into the cassette on close. The segments and index are
+    only written by the writer thread, in the order writes are queued, so the threads making the
+    interactions never wait on the disk unless the writer falls behind.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.blobs = set()
+        self.segments = []
+        self.segment = None
+        self.segment_started = None
+        self.index = open(path + INDEX_SUFFIX, 'w')
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cassette')
+        self.pending = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+        self.closed = False
+
+    def queue_write(self, write, *args):
+        # Run write on the writer thread. Called holding the lock, so writes are made in the order queued.
+        self.pending.acquire()
+        self.writer.submit(write, *args).add_done_callback(self.written)
+
+    def written(self, future):
+        self.pending.release()
+        if future.exception() is not None:
+            log.error(f"Failed to write to cassette {self.path}: {future.exception()}")
+
+    def write_blob(self, key, data):
+        # Close a segment once it is old enough, so a recording cut short keeps what it holds.
+        if self.segment is not None and time.monotonic() - self.segment_started > SEGMENT_INTERVAL:
+            self.segment.close()
+            self.segment = None
+        if self.segment is None:
+            self.segments.append(f'{self.path}{SEGMENT_SUFFIX}{len(self.segments)}')
+            self.segment = zipfile.ZipFile(self.segments[-1], 'w')
+            self.segment_started = time.monotonic()
+        # Images are already compressed, so they are stored as is.
+        self.segment.writestr('blobs/' + key, data, compress_type=zipfile.ZIP_STORED)
+
+    def write_entry(self, line):
+        self.index.write(line + '\n')
+        self.index.flush()
+
+    def add_blob(self, data):
+        key = _digest(data)
+        with self.lock:
+            if key not in self.blobs and not self.closed:
+                self.blobs.add(key)
+                self.queue_write(self.write_blob, key, data)
+        return key
+
+    def add_entry(self, entry, started, finished=None):
+        entry['start'] = round(started - self.started, 4)
+        entry['elapsed'] = round((finished or time.monotonic()) - started, 4)
+        line = json.dumps(entry)
+        with self.lock:
+            if not self.closed:
+                self.queue_write(self.write_entry, line)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.writer.shutdown(wait=True)
+        if self.segment is not None:
+            self.segment.close()
+        self.index.close()
+
+        # Merge the segments and index into the cassette, a blob at a time.
+        with zipfile.ZipFile(self.path, 'w') as cassette:
+            for segment_path in self.segments:
+                with zipfile.ZipFile(segment_path, 'r') as segment:
+                    for info in segment.infolist():
+                        with segment.open(info) as source, cassette.open(info, 'w') as destination:
+                            shutil.copyfileobj(source, destination, COPY_CHUNK_SIZE)
+            cassette.write(self.path + INDEX_SUFFIX, INDEX_NAME, compress_type=zipfile.ZIP_DEFLATED)
+        for segment_path in self.segments:
+            os.remove(segment_path)
+        os.remove(self.path + INDEX_SUFFIX)
+
+    # Wrappers of the services functions.
+
+    def wrap_nexar_request(self, nexar_request):
+        def recording_nexar_request(method, url, **kwargs):
+            started = time.monotonic()
+            response = nexar_request(method, url, **kwargs)
+            entry = {'kind': 'http', 'method': method, 'url': url, 'body': _request_digest(kwargs),
+                     'status': response.status_code, 'headers': dict(response.headers)}
+            refresh = url == services.NEXAR_REFRESH_TOKEN_URL
+            if refresh:
+                # The redacted body is not as long as the one sent.
+                entry['headers'] = {name: value for name, value in entry['headers'].items()
+                                    if name.lower() != 'content-length'}
+
+            def record(content):
+                if refresh:
+                    content = _redact_tokens(content)
+                if 'blob' not in entry:
+                    entry['blob'] = self.add_blob(content)
+                    self.add_entry(entry, started)
+
+            if kwargs.get('stream'):
+                return _RecordingStream(response, record)
+            record(response.content)
+            return response
+        return recording_nexar_request
+
+    def wrap_download_file(self, download_file):
+        def recording_download_file(path, bucket, key):
+            started = time.monotonic()
+            entry = {'kind': 's3_download', 'bucket': bucket, 'key': key}
+            try:
+                download_file(path, bucket, key)
+            except Exception as e:
+                entry['error'] = str(e)
+                self.add_entry(entry, started)
+                raise
+            with open(path, 'rb') as f:
+                entry['blob'] = self.add_blob(f.read())
+            self.add_entry(entry, started)
+        return recording_download_file
+
+    def wrap_read_file(self, read_file):
+        def recording_read_file(bucket, key):
+            started = time.monotonic()
+            # Recorded the same as a download, so either can replay it.
+            entry = {'kind': 's3_download', 'bucket': bucket, 'key': key}
+            try:
+                data = read_file(bucket, key)
+            except Exception as e:
+                entry['error'] = str(e)
+                self.add_entry(entry, started)
+                raise
+            entry['blob'] = self.add_blob(data)
+            self.add_entry(entry, started)
+            return data
+        return recording_read_file
+
+    def wrap_upload_file(self, upload_file):
+        def recording_upload_file(path, bucket, key):
+            started = time.monotonic()
+            entry = {'kind': 's3_upload', 'bucket': bucket, 'key': key}
+            try:
+                upload_file(path, bucket, key)
+            except Exception as e:
+                entry['error'] = str(e)
+                raise
+            finally:
+                self.add_entry(entry, started)
+        return recording_upload_file
+
+    def wrap_connect_to_db(self, connect_to_db):
+        recorder = self
+
+        class RecordingCursor:
+
+            def __init__(self, cursor, region):
+                self.cursor = cursor
+                self.region = region
+                # The last statement executed, with its start and end, recorded once its rows are fetched.
+                self.entry = None
+
+            def __enter__(self):
+                self.cursor.__enter__()
+                return self
+
+            def __exit__(self, exc_type, exc, tb):
+                self.record()
+                return self.cursor.__exit__(exc_type, exc, tb)
+
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+
+            def record(self):
+                if self.entry is not None:
+                    recorder.add_entry(*self.entry)
+                    self.entry = None
+
+            def execute(self, sql, params=None):
+                self.record()
+                started = time.monotonic()
+                self.cursor.execute(sql, params)
+                entry = {'kind': 'db', 'region': self.region, 'sql': ' '.join(sql.split()),
+                         'params': _digest(json.dumps(_encode(params)).encode()), 'rows': None}
+                self.entry = (entry, started, time.monotonic())
+
+            def fetchall(self):
+                rows = self.cursor.fetchall()
+                if self.entry is not None:
+                    self.entry[0]['rows'] = _encode(rows)
+                    self.record()
+                return rows
+
+        class RecordingConnection:
+
+            def __init__(self, conn, region):
+                self.conn = conn
+                self.region = region
+
+            def __enter__(self):
+                self.conn.__enter__()
+                return self
+
+            def __exit__(self, exc_type, exc, tb):
+                return self.conn.__exit__(exc_type, exc, tb)
+
+            def __getattr__(self, name):
+                return getattr(self.conn, name)
+
+            def cursor(self, *args, **kwargs):
+                return RecordingCursor(self.conn.cursor(*args, **kwargs), self.region)
+
+        def recording_connect_to_db(db_region):
+            return RecordingConnection(connect_to_db(db_region), db_region)
+        return recording_connect_to_db
+
+
+class Player:
+    """
+    Replays the interactions of a cassette file, at full speed or with the recorded latencies.
+    """
+
+    def __init__(self, path, recorded_timing=False):
+        self.recorded_timing = recorded_timing
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            self.zips = [zipfile.ZipFile(path, 'r')]
+            with self.zips[0].open(INDEX_NAME) as f:
+                lines = f.read().decode().splitlines()
+        else:
+            # A recording cut short before it was merged. Its last segment was never closed, so can't be read.
+            self.zips = []
+            for segment_path in sorted(glob.glob(glob.escape(path) + SEGMENT_SUFFIX + '*'),
+                                       key=lambda name: int(name.rsplit('-', 1)[1])):
+                try:
+                    self.zips.append(zipfile.ZipFile(segment_path, 'r'))
+                except zipfile.BadZipFile:
+                    pass
+            with open(path + INDEX_SUFFIX) as f:
+                lines = f.read().splitlines()
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # The last line of an index cut short.
+                break
+
+        # Interactions are matched exactly first, then loosely: request bodies hold the current
+        # time, and won't match a later session exactly. Matches are replayed in recorded order.
+        self.exact = defaultdict(deque)
+        self.loose = defaultdict(deque)
+        for entry in entries:
+            exact, loose = self.keys(entry)
+            self.exact[exact].append(entry)
+            self.loose[loose].append(entry)
+
+    @staticmethod
+    def keys(entry):
+        if entry['kind'] == 'http':
+            loose = ('http', entry['method'].upper(), entry['url'])
+            return loose + (entry['body'],), loose
+        if entry['kind'] == 'db':
+            loose = ('db', entry['region'], entry['sql'])
+            return loose + (entry['params'],), loose
+        key = (entry['kind'], entry['bucket'], entry['key'])
+        return key, key
+
+    def take(self, exact, loose):
+        with self.lock:
+            for table, key in ((self.exact, exact), (self.loose, loose)):
+                queue = table.get(key)
+                if queue:
+                    # Keep the last match around, for interactions repeated more often than recorded.
+                    entry = queue.popleft() if len(queue) > 1 else queue[0]
+                    break
+            else:
+                raise CassetteMiss(f'Not in cassette: {loose}')
+        if self.recorded_timing:
+            time.sleep(entry['elapsed'])
+        return entry
+
+    def blob(self, key):
+        with self.lock:
+            for cassette in self.zips:
+                try:
+                    return cassette.read('blobs/' + key)
+                except KeyError:
+                    pass
+        # In the last segment of a recording cut short.
+        raise CassetteMiss(f'Blob not in cassette: {key}')
+
+    def close(self):
+        for cassette in self.zips:
+            cassette.close()
+
+    # Replacements of the services functions.
+
+    def nexar_request(self, method, url, **kwargs):
+        loose = ('http', method.upper(), url)
+        entry = self.take(loose + (_request_digest(kwargs),), loose)
+        return CassetteResponse(url, entry['status'], entry['headers'], self.blob(entry['blob']))
+
+    def download_file(self, path, bucket, key):
+        entry = self.take(('s3_download', bucket, key), ('s3_download', bucket, key))
+        if 'error' in entry:
+            raise OSError(entry['error'])
+        with open(path, 'wb') as f:
+            f.write(self.blob(entry['blob']))
+
+    def read_file(self, bucket, key):
+        entry = self.take(('s3_download', bucket, key), ('s3_download', bucket, key))
+        if 'error' in entry:
+            raise OSError(entry['error'])
+        return self.blob(entry['blob'])
+
+    def upload_file(self, path, bucket, key):
+        entry = self.take(('s3_upload', bucket, key), ('s3_upload', bucket, key))
+        if 'error' in entry:
+            raise OSError(entry['error'])
+
+    def connect_to_db(self, db_region):
+        player = self
+
+        class ReplayCursor:
+
+            def __init__(self):
+                self.rows = None
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, exc_type, exc, tb):
+                pass
+
+            def execute(self, sql, params=None):
+                loose = ('db', db_region, ' '.join(sql.split()))
+                entry = player.take(loose + (_digest(json.dumps(_encode(params)).encode()),), loose)
+                self.rows = _decode(entry['rows']) if entry['rows'] is not None else []
+
+            def fetchall(self):
+                return self.rows
+
+            def fetchone(self):
+                return self.rows[0] if self.rows else None
+
+        class ReplayConnection:
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, exc_type, exc, tb):
+                pass
+
+            def cursor(self):
+                return ReplayCursor()
+
+            # Used by services.db_connection; nothing to commit or close in replay.
+            def commit(self):
+                pass
+
+            def rollback(self):
+                pass
+
+            def close(self):
+                pass
+
+        return ReplayConnection()
+
+
+def install(path, mode, recorded_timing=False):
+    """
+    Record the services interactions into a new cassette at path, or replay them from it.
+    Return the Recorder or Player.
+    """
+    if mode == 'record':
+        recorder = Recorder(path)
+        services.nexar_request = recorder.wrap_nexar_request(services.nexar_request)
+        services.download_file = recorder.wrap_download_file(services.download_file)
+        services.read_file = recorder.wrap_read_file(services.read_file)
+        services.upload_file = recorder.wrap_upload_file(services.upload_file)
+        services.connect_to_db = recorder.wrap_connect_to_db(services.connect_to_db)
+        # The index is folded into the cassette when the tool exits.
+        atexit.register(recorder.close)
+        return recorder
+
+    if mode == 'replay':
+        player = Player(path, recorded_timing)
+        services.nexar_request = player.nexar_request
+        services.download_file = player.download_file
+        services.read_file = player.read_file
+        services.upload_file = player.upload_file
+        services.connect_to_db = player.connect_to_db
+        return player
+
+    raise ValueError(f"Unknown cassette mode: {mode}. Expecting record or replay.")
+
+
+def install_from_environment():
+    """
+    Install recording or replay as set by the IMAGE_VIEWER_CASSETTE environment variables, if set.
+    """
+    path = os.environ.get('IMAGE_VIEWER_CASSETTE')
+    if not path:
+        return None
+    mode = os.environ.get('IMAGE_VIEWER_CASSETTE_MODE', 'replay')
+    recorded_timing = os.environ.get('IMAGE_VIEWER_CASSETTE_TIMING', 'fast') == 'recorded'
+    return install(path, mode, recorded_timing)
@@ -0,0 +1,186 @@
+"""
+Side-by-side comparison of the Datalake and Nexar captures of a location.
+
+The two sources are searched at once, and their results are shown in one table: captures of the same
+spot and heading are paired on a row, Datalake on the left and Nexar on the right, followed by the
+captures of either source with no match. Both result sets stay in the window, independent of the
+thumbnail grid, so neither search wipes out the other.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import Qt, pyqtSignal
+
+import geodesy
+import result_filter
+
+# Captures within this distance, and heading difference when both headings are known, are pairs.
+PAIR_DISTANCE_METERS = 15.0
+PAIR_HEADING_DEGREES = 45.0
+# Size of the thumbnails in the table.
+THUMBNAIL_SIZE = QtCore.QSize(240, 135)
+# Thumbnails loaded at once.
+LOAD_WORKERS = 8
+
+DATALAKE_COLUMN = 0
+NEXAR_COLUMN = 1
+COLUMNS = ['Datalake', 'Nexar', 'Distance', 'Time apart', 'Heading difference']
+
+
+def _heading_difference(a, b):
+    # Smallest angle between two headings in degrees, or NaN if either is unknown.
+    return 180 - np.abs(np.abs(np.asarray(a, dtype=float) - np.asarray(b, dtype=float)) % 360 - 180)
+
+
+def match_pairs(datalake_rows, nexar_frames, distance_meters=PAIR_DISTANCE_METERS, heading_degrees=PAIR_HEADING_DEGREES):
+    """
+    Pair Datalake rows with Nexar frames of the same spot and heading, nearest pairs first.
+    A Nexar frame already ingested into the datalake is paired with its own row.
+    Return a list of (row index, frame index, distance in meters), with None for the side of an unmatched capture.
+    """
+    pairs = []
+    rows_left = set(range(len(datalake_rows)))
+    frames_left = set(range(len(nexar_frames)))
+
+    # The same image in both sources.
+    row_by_location = {row[1]: index for index, row in enumerate(datalake_rows)}
+    for frame_index, frame in enumerate(nexar_frames):
+        row_index = row_by_location.get(frame.get('datalake_s3_location'))
+        if row_index is not None and row_index in rows_left:
+            pairs.append((row_index, frame_index, 0.0))
+            rows_left.discard(row_index)
+            frames_left.discard(frame_index)
+
+    rows = sorted(rows_left)
+    frames = sorted(frames_left)
+    if rows and frames:
+        points = [result_filter.parse_point(datalake_rows[index][4]) for index in rows]
+        frame_latitudes = [float(nexar_frames[index]['gps_info']['latitude']) for index in frames]
+        frame_longitudes = [float(nexar_frames[index]['gps_info']['longitude']) for index in frames]
+        frame_headings = [np.nan if nexar_frames[index].get('camera_heading') is None
+                          else float(nexar_frames[index]['camera_heading']) for index in frames]
+        candidates = []
+        for row_index, (longitude, latitude) in zip(rows, points):
+            if np.isnan(latitude):
+                continue
+            distances = geodesy.distance_meters(latitude, longitude, frame_latitudes, frame_longitudes)
+            row = datalake_rows[row_index]
+            # The image heading is the direction the camera faced; fall back to the vehicle heading.
+            heading = row[9] if row[9] is not None else row[8]
+            differences = _heading_difference(np.nan if heading is None else float(heading), frame_headings)
+            close = (distances <= distance_meters) & ~(differences > heading_degrees)
+            candidates += [(distances[k], row_index, frames[k]) for k in np.flatnonzero(close)]
+
+        # Greedily take the nearest pairs, each capture in one pair at most.
+        for distance, row_index, frame_index in sorted(candidates):
+            if row_index in rows_left and frame_index in frames_left:
+                pairs.append((row_index, frame_index, float(distance)))
+                rows_left.discard(row_index)
+                frames_left.discard(frame_index)
+
+    pairs += [(row_index, None, None) for row_index in sorted(rows_left)]
+    pairs += [(None, frame_index, None) for frame_index in sorted(frames_left)]
+    return pairs
+
+
+class ComparisonWindow(QtWidgets.QWidget):
+    """
+    A table of paired Datalake and Nexar captures, with their thumbnails loaded in the background.
+    """
+
+    # Passes the results generation, table row and column and the decoded thumbnail of a loaded thumbnail,
+    # from the executor.
+    thumbnail_loaded = pyqtSignal(int, int, int, QtGui.QImage)
+
+    def __init__(self, load_thumbnail):
+        """
+        Parameters:
+        - load_thumbnail: called in a worker thread with (display_mode, result) to return the decoded QImage of
+          the thumbnail of a Datalake row (display_mode 1) or Nexar frame (display_mode 2). Raises on failure.
+        """
+        super().__init__()
+        self.setWindowTitle('Datalake and Nexar comparison')
+        self.load_thumbnail = load_thumbnail
+        self.executor = ThreadPoolExecutor(LOAD_WORKERS, thread_name_prefix='comparison')
+        self.futures = []
+        # Bumped by every show_results, so thumbnails of earlier results aren't shown.
+        self.generation = 0
+
+        self.label_status = QtWidgets.QLabel('Searching Datalake and Nexar ...')
+        self.table = QtWidgets.QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.setIconSize(THUMBNAIL_SIZE)
+        self.table.verticalHeader().setDefaultSectionSize(THUMBNAIL_SIZE.height() + 8)
+        self.table.setColumnWidth(DATALAKE_COLUMN, THUMBNAIL_SIZE.width() + 8)
+        self.table.setColumnWidth(NEXAR_COLUMN, THUMBNAIL_SIZE.width() + 8)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.label_status)
+        layout.addWidget(self.table, 1)
+
+        self.thumbnail_loaded.connect(self.evt_thumbnail_loaded)
+
+    def show_status(self, text):
+        self.label_status.setText(text)
+
+    def show_results(self, datalake_rows, nexar_frames):
+        """
+        Fill the table with the pairs of datalake_rows and nexar_frames, replacing any earlier results.
+        """
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+        self.generation += 1
+
+        pairs = match_pairs(datalake_rows, nexar_frames)
+        self.table.clearContents()
+        self.table.setRowCount(len(pairs))
+        matched = 0
+        for table_row, (row_index, frame_index, distance) in enumerate(pairs):
+            row = datalake_rows[row_index] if row_index is not None else None
+            frame = nexar_frames[frame_index] if frame_index is not None else None
+            if row is not None:
+                self.set_capture(table_row, DATALAKE_COLUMN, 1, row, f"{row[7]}\n{row[1].split('/')[-1]}")
+            if frame is not None:
+                captured = QtCore.QDateTime.fromMSecsSinceEpoch(int(frame['captured_at'])).toString(Qt.ISODate) \
+                    if frame.get('captured_at') is not None else ''
+                self.set_capture(table_row, NEXAR_COLUMN, 2, frame, f"{captured}\n{frame.get('direction')}")
+            if row is not None and frame is not None:
+                matched += 1
+                self.table.setItem(table_row, 2, QtWidgets.QTableWidgetItem(f'{distance:.1f} m'))
+                if row[7] is not None and frame.get('captured_at') is not None:
+                    days = abs(row[7].timestamp() - float(frame['captured_at']) / 1000) / 86400
+                    self.table.setItem(table_row, 3, QtWidgets.QTableWidgetItem(f'{days:.0f} days'))
+                heading = row[9] if row[9] is not None else row[8]
+                if heading is not None and frame.get('camera_heading') is not None:
+                    difference = float(_heading_difference(float(heading), float(frame['camera_heading'])))
+                    self.table.setItem(table_row, 4, QtWidgets.QTableWidgetItem(f'{difference:.0f}°'))
+
+        self.show_status(f"{len(datalake_rows)} Datalake and {len(nexar_frames)} Nexar captures; "
+                         f"{matched} matched pairs.")
+
+    def set_capture(self, table_row, column, display_mode, result, text):
+        self.table.setItem(table_row, column, QtWidgets.QTableWidgetItem(text))
+        self.futures.append(self.executor.submit(self.load, self.generation, table_row, column, display_mode, result))
+
+    def load(self, generation, table_row, column, display_mode, result):
+        # Runs in the executor. A thumbnail that fails to load leaves its cell with the text only.
+        try:
+            image = self.load_thumbnail(display_mode, result)
+        except Exception:
+            return
+        self.thumbnail_loaded.emit(generation, table_row, column, image.scaled(THUMBNAIL_SIZE, Qt.KeepAspectRatio,
+                                                                   Qt.SmoothTransformation))
+
+    def evt_thumbnail_loaded(self, generation, table_row, column, image):
+        if generation != self.generation:
+            return
+        item = self.table.item(table_row, column)
+        if item is not None:
+            item.setIcon(QtGui.QIcon(QtGui.QPixmap.fromImage(image)))
+
+    def closeEvent(self, event):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        super().closeEvent(event)
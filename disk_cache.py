@@ -0,0 +1,110 @@
+"""
+Writes to the local image caches, done in the background.
+
+Images are displayed from the bytes already in memory, and written to thumbnails/, datalake_images/
+and full_images/ afterwards by a background thread, so local disk latency stays off the display path.
+Files are written to a temporary name and renamed, so a cached file is always complete.
+Thumbnails and other small files are appended to the pack of thumbnail_pack instead, under the same paths.
+"""
+
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import thumbnail_pack
+
+log = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk-cache')
+_lock = threading.Lock()
+# Writes not yet completed, by path, with the data being written.
+_pending = {}
+
+
+def _write(path, data):
+    try:
+        if thumbnail_pack.packed(path):
+            thumbnail_pack.put(path, data)
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+    except Exception as e:
+        # Nothing waits for the write, so a full disk or a permission problem is only seen here.
+        log.warning(f"Could not cache {path}; {e}")
+    finally:
+        with _lock:
+            if _pending.get(path, (None,))[0] is data:
+                del _pending[path]
+
+
+def write_async(path, data):
+    """
+    Write data to path in the background.
+    """
+    with _lock:
+        future = _executor.submit(_write, path, data)
+        _pending[path] = (data, future)
+
+
+def read(path):
+    """
+    Return the cached bytes of path, including data still waiting to be written, or None if not cached.
+    """
+    with _lock:
+        if path in _pending:
+            return _pending[path][0]
+    if thumbnail_pack.packed(path):
+        data = thumbnail_pack.get(path)
+        if data is not None:
+            return data
+        # Files cached before the pack are read from disk.
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def exists(path):
+    """
+    Return True if path is cached, or is being written.
+    """
+    with _lock:
+        if path in _pending:
+            return True
+    if thumbnail_pack.packed(path) and thumbnail_pack.contains(path):
+        return True
+    return os.path.exists(path)
+
+
+def pending():
+    """
+    Return the bytes and number of the writes waiting to be done.
+    """
+    with _lock:
+        return sum(len(data) for data, future in _pending.values()), len(_pending)
+
+
+def wait(path):
+    """
+    Wait until a pending write of path, if any, is on disk.
+    """
+    with _lock:
+        pending = _pending.get(path)
+    if pending:
+        pending[1].result()
+
+
+def flush():
+    """
+    Wait until every pending write is on disk.
+    """
+    with _lock:
+        futures = [future for data, future in _pending.values()]
+    for future in futures:
+        future.result()
@@ -0,0 +1,245 @@
+"""
+Export of search results to a single tar or zip archive, with a manifest of their details.
+
+Images are taken from the local caches when present, and downloaded otherwise, a few at a time.
+Each image is streamed from disk into the archive as soon as it and the images before it are
+ready, and its manifest row is written as it goes, so memory use is bounded by the few images in
+flight whatever the number of results exported.
+
+The manifest has the columns display_image_info shows for the results, plus the name of the image
+in the archive and the error of an image that could not be fetched. It is written as CSV, or as
+Parquet when pyarrow is installed and the archive is to hold a .parquet manifest.
+"""
+
+import csv
+import os
+import tarfile
+import tempfile
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+
+import services
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+DATALAKE_COLUMNS = ['id', 's3_location', 'asset_id', 'processing_index', 'long_and_lat', 'datetime', 'geom',
+                    'version', 'vehicle_heading', 'image_heading', 'cam_id']
+NEXAR_COLUMNS = ['frame_id', 'latitude', 'longitude', 'direction', 'captured_epoch', 'captured_date_time',
+                 'camera_heading', 'frame_quality', 'frame_context', 'thumbnail_url', 'frame_url',
+                 'datalake_s3_location']
+# Columns added to every manifest.
+EXPORT_COLUMNS = ['file', 'error']
+
+# Images fetched at once.
+FETCH_WORKERS = 8
+# Manifest rows buffered before a Parquet row group is written.
+PARQUET_BATCH_ROWS = 1000
+
+
+def datalake_row_sources(row):
+    """
+    Return the sources of the full image of a datalake row, for services.fetch_image.
+    """
+    file, bucket, key = services.split_s3_location(row[1])
+    path = 'datalake_images/' + file
+    return [('local', path), ('s3', path, bucket, key)]
+
+
+def nexar_frame_sources(frame):
+    """
+    Return the sources of the full image of a Nexar frame, for services.fetch_image.
+    Our own copies come first; Nexar is the last resort.
+    """
+    url = frame['frame_url']
+    file = url.split('/')[-1]
+    nexar_path = 'full_images/' + file
+    datalake_path = 'datalake_images/' + file
+    bucket, key = 'ushr-image/Nexar', file
+    if frame.get('datalake_s3_location'):
+        file, bucket, key = services.split_s3_location(frame['datalake_s3_location'])
+        datalake_path = 'datalake_images/' + file
+    return [('local', datalake_path), ('local', nexar_path),
+            ('s3', datalake_path, bucket, key), ('nexar', nexar_path, url)]
+
+
+def datalake_row_record(row):
+    """
+    Return the manifest record of a datalake row.
+    """
+    return dict(zip(DATALAKE_COLUMNS, [row[0], row[1], row[2], row[3], row[4], row[7], row[5], row[6],
+                                       row[8], row[9], row[10]]))
+
+
+def nexar_frame_record(frame):
+    """
+    Return the manifest record of a Nexar frame.
+    """
+    return {
+        'frame_id': frame['frame_id'],
+        'latitude': frame['gps_info']['latitude'],
+        'longitude': frame['gps_info']['longitude'],
+        'direction': frame.get('direction'),
+        'captured_epoch': frame.get('captured_at'),
+        # captured_at is epoch ms
+        'captured_date_time': dt.fromtimestamp(float(frame['captured_at']) / 1000) if frame.get('captured_at') else None,
+        'camera_heading': frame.get('camera_heading'),
+        'frame_quality': frame.get('frame_quality'),
+        'frame_context': frame.get('frame_context'),
+        'thumbnail_url': frame.get('thumbnail_url'),
+        'frame_url': frame.get('frame_url'),
+        'datalake_s3_location': frame.get('datalake_s3_location'),
+    }
+
+
+class _CsvManifest:
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, columns)
+        self.writer.writeheader()
+
+    def write(self, record):
+        self.writer.writerow(record)
+
+    def close(self):
+        self.file.close()
+
+
+class _ParquetManifest:
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.rows = []
+        self.writer = None
+
+    def write(self, record):
+        self.rows.append(record)
+        if len(self.rows) >= PARQUET_BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        # Values are written as text, so every row group has the same schema whatever values it holds.
+        table = pyarrow.table({column: [None if row.get(column) is None else str(row[column]) for row in self.rows]
+                               for column in self.columns})
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.writer is None:
+            # No rows; still write a manifest with the columns.
+            pyarrow.parquet.write_table(pyarrow.table({column: pyarrow.array([], pyarrow.string())
+                                                       for column in self.columns}), self.path)
+        else:
+            self.writer.close()
+
+
+class _Archive:
+
+    def __init__(self, path):
+        if path.lower().endswith('.zip'):
+            # Images are already compressed, so they are stored as they are.
+            self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED, allowZip64=True)
+            self.tar = None
+        else:
+            self.tar = tarfile.open(path, 'w')
+            self.zip = None
+
+    def add(self, path, name):
+        # Both stream the file from disk in blocks.
+        if self.zip is not None:
+            self.zip.write(path, name)
+        else:
+            self.tar.add(path, name)
+
+    def close(self):
+        (self.zip or self.tar).close()
+
+
+def export_results(archive_path, items, columns, auth_token=None, manifest_format='csv', workers=FETCH_WORKERS,
+                   progress=None, cancelled=None):
+    """
+    Write the images and manifest of results to an archive.
+
+    Parameters:
+    - archive_path: str, the .tar or .zip file to write.
+    - items: iterable of (sources, record) tuples, sources for services.fetch_image and the manifest record.
+    - columns: list, the manifest columns of the records (DATALAKE_COLUMNS or NEXAR_COLUMNS).
+    - auth_token: str, the Nexar token, for images only Nexar has.
+    - manifest_format: 'csv' or 'parquet'. Parquet needs pyarrow.
+    - progress: called with (exported, failed) after every result, or None.
+    - cancelled: called before every result; the export stops when it returns True.
+
+    Return (exported, failed) counts.
+    """
+    if manifest_format == 'parquet' and pyarrow is None:
+        raise RuntimeError('Parquet manifests need pyarrow. Install it, or export a CSV manifest.')
+
+    exported = failed = 0
+    items = iter(items)
+    pending = deque()
+    names = set()
+
+    with tempfile.TemporaryDirectory() as directory, ThreadPoolExecutor(workers) as executor:
+        manifest_name = 'manifest.' + manifest_format
+        manifest_path = os.path.join(directory, manifest_name)
+        manifest = (_ParquetManifest if manifest_format == 'parquet' else _CsvManifest)(
+            manifest_path, columns + EXPORT_COLUMNS)
+        archive = _Archive(archive_path)
+        try:
+            def submit_next():
+                for sources, record in items:
+                    pending.append((record, executor.submit(services.fetch_image, sources, auth_token)))
+                    return
+
+            # Keep a bounded window of fetches running ahead of the image being written.
+            for _ in range(workers * 2):
+                submit_next()
+
+            while pending:
+                if cancelled is not None and cancelled():
+                    break
+                record, future = pending.popleft()
+                submit_next()
+                record = dict(record)
+                try:
+                    path = future.result()
+                except Exception as e:
+                    record['error'] = str(e)
+                    failed += 1
+                else:
+                    # Results can share a file name; keep every one.
+                    name = 'images/' + os.path.basename(path)
+                    stem, extension = os.path.splitext(name)
+                    suffix = 1
+                    while name in names:
+                        name = f'{stem}_{suffix}{extension}'
+                        suffix += 1
+                    names.add(name)
+                    archive.add(path, name)
+                    record['file'] = name
+                    exported += 1
+                manifest.write(record)
+                if progress is not None:
+                    progress(exported, failed)
+
+            # Fetches not started yet are no longer needed.
+            for record, future in pending:
+                future.cancel()
+        finally:
+            manifest.close()
+            archive.add(manifest_path, manifest_name)
+            archive.close()
+
+    return exported, failed
@@ -0,0 +1,52 @@
+"""
+Search geometry on the earth's surface.
+
+A degree of latitude is about 111 km everywhere, but a degree of longitude shrinks with the cosine
+of the latitude. Searches are sent as a latitude corrected bounding box that just contains the
+search circle, and the results are then filtered by their great circle distance from the center.
+"""
+
+import math
+
+import numpy as np
+
+EARTH_RADIUS_METERS = 6371008.8
+
+
+def bounding_box(latitude, longitude, radius_meters):
+    """
+    Return (south, west, north, east), in degrees, of the smallest box containing every point
+    within radius_meters of the center. A box reaching over a pole covers every longitude.
+    Longitudes aren't wrapped, so a box across the antimeridian reaches past -180 or 180.
+    """
+    angle = radius_meters / EARTH_RADIUS_METERS
+    d_latitude = math.degrees(angle)
+    south = latitude - d_latitude
+    north = latitude + d_latitude
+    if south <= -90 or north >= 90 or angle >= math.pi / 2:
+        return max(south, -90.0), -180.0, min(north, 90.0), 180.0
+
+    # Longitude extent of the circle, at the latitude where it is widest.
+    d_longitude = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(latitude))))
+    return south, longitude - d_longitude, north, longitude + d_longitude
+
+
+def distance_meters(latitude, longitude, latitudes, longitudes):
+    """
+    Great circle distance in meters from one point to arrays of points.
+    """
+    lat1 = np.radians(latitude)
+    lat2 = np.radians(latitudes)
+    d_lat = lat2 - lat1
+    d_lon = np.radians(np.asarray(longitudes, dtype=float) - longitude)
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(d_lon / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def within_radius(latitude, longitude, radius_meters, latitudes, longitudes):
+    """
+    Return a boolean array, True for the points within radius_meters of the center.
+    Points with unknown coordinates (NaN) are kept.
+    """
+    distance = distance_meters(latitude, longitude, np.asarray(latitudes, dtype=float), longitudes)
+    return ~(distance > radius_meters)
@@ -0,0 +1,130 @@
+"""
+In-memory cache of decoded images, shared by the thumbnail grid and the full image viewer.
+
+Decoding a full resolution image takes hundreds of milliseconds; converting a decoded QImage for
+display takes a few. Decoded images are kept by path in a least recently used cache bounded by their
+size in bytes, so switching between results and reopening the viewer doesn't decode again. The
+full images of the results next to the one selected are decoded ahead of time in the background,
+when they are already on disk.
+
+The bound is set with an environment variable before the tool starts:
+    IMAGE_VIEWER_IMAGE_CACHE_MB=512
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5 import QtGui
+
+import disk_cache
+
+IMAGE_CACHE_BYTES = int(float(os.environ.get('IMAGE_VIEWER_IMAGE_CACHE_MB', '512')) * 1024 * 1024)
+# Images decoded ahead of time at once. Kept low, so decodes ahead don't compete with the grid.
+PREDECODE_WORKERS = 2
+
+
+class ImageCache:
+    """
+    Least recently used cache of decoded QImages by path, bounded by their total size in bytes.
+    QImages are implicitly shared, so an image handed out costs no copy.
+    """
+
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """
+        Return the decoded image of path, or None if it isn't cached.
+        """
+        with self.lock:
+            image = self.images.get(path)
+            if image is None:
+                self.misses += 1
+                return None
+            self.images.move_to_end(path)
+            self.hits += 1
+            return image
+
+    def put(self, path, image):
+        """
+        Cache the decoded image of path, evicting the least recently used images past the bound.
+        An image larger than the whole bound isn't cached.
+        """
+        size = image.sizeInBytes()
+        if image.isNull() or size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.images.pop(path, None)
+            if old is not None:
+                self.bytes -= old.sizeInBytes()
+            self.images[path] = image
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= evicted.sizeInBytes()
+
+    def decode(self, path, data):
+        """
+        Return the decoded image of path, decoding data and caching it if it isn't cached.
+        Raise ValueError if data can't be decoded.
+        """
+        image = self.get(path)
+        if image is None:
+            image = QtGui.QImage.fromData(data)
+            if image.isNull():
+                raise ValueError(f'Image could not be decoded: {path}')
+            self.put(path, image)
+        return image
+
+    def load(self, path):
+        """
+        Return the decoded image of path, decoding and caching it if it isn't cached.
+        Return None if the file can't be read or decoded.
+        """
+        image = self.get(path)
+        if image is not None:
+            return image
+        data = disk_cache.read(path)
+        if data is None:
+            return None
+        image = QtGui.QImage.fromData(data)
+        if image.isNull():
+            return None
+        self.put(path, image)
+        return image
+
+
+# The cache shared by the whole tool.
+cache = ImageCache()
+
+_executor = ThreadPoolExecutor(PREDECODE_WORKERS, thread_name_prefix='predecode')
+# Paths being decoded ahead, so a path asked for twice is decoded once.
+_queued = set()
+_queued_lock = threading.Lock()
+
+
+def predecode(paths):
+    """
+    Decode the images of paths in the background, those on disk and not cached yet.
+    """
+    for path in paths:
+        with _queued_lock:
+            if path in _queued or path in cache.images or not disk_cache.exists(path):
+                continue
+            _queued.add(path)
+        _executor.submit(_predecode, path)
+
+
+def _predecode(path):
+    try:
+        cache.load(path)
+    finally:
+        with _queued_lock:
+            _queued.discard(path)
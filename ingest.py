@@ -0,0 +1,525 @@
+"""
+Bulk ingestion of Nexar frames into the datalake.
+
+Every frame Nexar has for a region and time window is paged through and streamed through
+three stages: download from Nexar, upload to s3 (ushr-image/Nexar) with a thumbnail derivative,
+and batched insert into datalake.camera_image. The stages are connected by bounded queues, so a slow stage holds back
+the ones feeding it instead of letting downloaded images pile up in memory or on disk.
+
+Completed frames are recorded in a checkpoint database after their insert is committed, and
+frames already in the datalake are skipped, so an interrupted run resumes without redoing work.
+The image a run downloads is removed once its insert is committed; images cached before the run are kept.
+
+Usage:
+    python ingest.py --latitude 33.9834 --longitude -84.2142 --radius 500 --start 2023-01-01 --end 2024-01-01
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime as dt, timedelta
+
+import geoalchemy2
+import shapely
+
+# NOTE: This must be performed before boto3 is loaded, directly or indirectly via other imports.
+import ushr.qc.app.env
+ushr.qc.app.env.set_aws_env()
+
+import cache_daemon
+import creds
+import geodesy
+import known_frames
+import regions
+import services
+import thumbnails
+
+log = logging.getLogger(__name__)
+
+BUCKET = 'ushr-image/Nexar'
+
+ROAD_TYPES = ["MOTORWAY", "TRUNK", "PRIMARY", "SECONDARY", "TERTIARY", "UNCLASSIFIED", "RESIDENTIAL", "SERVICE",
+              "MOTORWAY_LINK", "TRUNK_LINK", "PRIMARY_LINK", "SECONDARY_LINK", "TERTIARY_LINK"]
+DIRECTIONS = ["NORTH", "SOUTH", "EAST", "WEST", "NORTH_WEST", "NORTH_EAST", "SOUTH_WEST", "SOUTH_EAST"]
+
+# Time windows are not split below one minute, in ms.
+MIN_WINDOW = 60 * 1000
+# Seconds between progress reports.
+REPORT_INTERVAL = 10
+# Attempts at downloading or uploading a frame before it is left for the next run.
+ATTEMPTS = 3
+# Seconds a Nexar token is used for when the refresh response doesn't say, and the margin
+# before it expires at which it is refreshed.
+TOKEN_LIFETIME = 60 * 60
+TOKEN_MARGIN = 5 * 60
+
+# Marks the end of a queue.
+_DONE = object()
+
+
+class Checkpoint:
+    """
+    A sqlite file recording the frames whose ingestion completed.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS done (
+            frame_id TEXT PRIMARY KEY, s3_location TEXT, ingested_at TEXT)""")
+        self.conn.commit()
+
+    def done_ids(self, frame_ids):
+        # Return the subset of frame_ids already ingested.
+        with self.lock:
+            found = set()
+            for start in range(0, len(frame_ids), 500):
+                chunk = frame_ids[start:start + 500]
+                cursor = self.conn.execute(
+                    f"SELECT frame_id FROM done WHERE frame_id IN ({', '.join('?' * len(chunk))})", chunk)
+                found.update(row[0] for row in cursor)
+            return found
+
+    def mark_done(self, known):
+        # Record a dictionary of frame_id to s3_location as ingested.
+        now = dt.now().isoformat(timespec='seconds')
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO done VALUES (?, ?, ?)",
+                                  [(frame_id, s3_location, now) for frame_id, s3_location in known.items()])
+            self.conn.commit()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT count(*) FROM done").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def refresh_auth_token():
+    """
+    Return a fresh Nexar access token, and the seconds it is valid for.
+    """
+    response = services.nexar_request('POST', services.NEXAR_REFRESH_TOKEN_URL,
+                                      headers={'content-type': 'application/x-www-form-urlencoded'},
+                                      data={'refresh_token': creds.refresh_token})
+    response.close()
+    data = response.json()
+    return data['access_token'], float(data.get('expires_in', TOKEN_LIFETIME))
+
+
+def unauthorized(e):
+    # Whether an exception is a request refused with 401, as a token that expired is.
+    return getattr(getattr(e, 'response', None), 'status_code', None) == 401
+
+
+def camera_image_values(frame, s3_location):
+    """
+    Return the datalake.camera_image values (s3_location, geom, version, datetime, vehicle_heading) of a frame.
+    These are the values download_image in main.py inserts for a frame opened in the viewer.
+    """
+    latitude = float(frame['gps_info']['latitude'])
+    longitude = float(frame['gps_info']['longitude'])
+    # geom must be cast as a string
+    geom = str(geoalchemy2.shape.from_shape(shapely.geometry.Point((longitude, latitude)), srid=4326))
+    version = f"nexar:{frame['frame_id']}"
+    # captured_at is epoch ms
+    datetime = dt.fromtimestamp(float(frame['captured_at'] / 1000))
+    vehicle_heading = round(float(frame['camera_heading']), 2) % 360
+    return s3_location, geom, version, datetime, vehicle_heading
+
+
+class Ingestion:
+    """
+    Pages through the Nexar frames of a region and time window, and ingests them into the datalake.
+    """
+
+    def __init__(self, latitude, longitude, radius, start_time, end_time, checkpoint, directions=DIRECTIONS,
+                 min_frame_quality=0.7, download_workers=4, upload_workers=4, batch_size=100, queue_size=16,
+                 db_region=None, directory='full_images'):
+        """
+        Parameters:
+        - latitude, longitude, radius: float, the center and radius in meters of the region.
+        - start_time, end_time: int, the capture time window in epoch ms.
+        - checkpoint: Checkpoint, where completed frames are recorded.
+        - download_workers, upload_workers: int, threads of the download and upload stages.
+        - batch_size: int, rows inserted per database transaction.
+        - queue_size: int, capacity of each queue between stages.
+        - db_region: str, the datalake database to ingest into. By default, that of the region of the center.
+        """
+        self.latitude = latitude
+        self.longitude = longitude
+        self.radius = radius
+        self.start_time = start_time
+        self.end_time = end_time
+        self.checkpoint = checkpoint
+        self.directions = list(directions)
+        self.min_frame_quality = min_frame_quality
+        self.download_workers = download_workers
+        self.upload_workers = upload_workers
+        self.batch_size = batch_size
+        self.db_region = db_region or regions.region_of_point(latitude, longitude)
+        if self.db_region is None:
+            raise ValueError(f"No datalake region covers {latitude}, {longitude}. Set db_region.")
+        self.directory = directory
+
+        self.download_queue = queue.Queue(queue_size)
+        self.upload_queue = queue.Queue(queue_size)
+        self.insert_queue = queue.Queue(queue_size * 4)
+        self.stop = threading.Event()
+        self.auth_token = None
+        self.token_expires = 0.0
+        self.token_lock = threading.Lock()
+
+        self.lock = threading.Lock()
+        self.counts = {'paged': 0, 'skipped': 0, 'downloaded': 0, 'uploaded': 0, 'ingested': 0, 'failed': 0}
+        # Workers still running in each stage. The last one of a stage to finish ends the next stage's queue.
+        self.running = {'download': download_workers, 'upload': upload_workers}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    def finish_worker(self, stage, next_queue, next_workers):
+        # Called by each worker leaving a stage. The last one puts an end marker for every next stage worker.
+        with self.lock:
+            self.running[stage] -= 1
+            last = self.running[stage] == 0
+        if last:
+            for _ in range(next_workers):
+                self.put(next_queue, _DONE, force=True)
+
+    def token(self):
+        # Return the Nexar token, refreshing it shortly before it expires. Long runs outlive a token.
+        with self.token_lock:
+            if self.auth_token is None or time.monotonic() > self.token_expires:
+                self.auth_token, lifetime = refresh_auth_token()
+                self.token_expires = time.monotonic() + lifetime - TOKEN_MARGIN
+            return self.auth_token
+
+    def token_refused(self, token):
+        # A request with token was refused with 401. The next call of token refreshes it,
+        # unless another worker already has.
+        with self.token_lock:
+            if self.auth_token == token:
+                self.token_expires = 0.0
+
+    # Paging stage.
+
+    def search(self, start_time, end_time):
+        # Return the frames captured within one time window, in the box containing the region.
+        south, west, north, east = geodesy.bounding_box(self.latitude, self.longitude, self.radius)
+        json_data = {
+            "bounding_box": {
+                "south_west": {"longitude": west, "latitude": south},
+                "north_east": {"longitude": east, "latitude": north},
+            },
+            "filters": {
+                "min_frame_quality": self.min_frame_quality,
+                "road_types": ROAD_TYPES,
+                "directions": self.directions,
+                "frames_context": ["DAYLIGHT", "NIGHTTIME"],
+                "start_time": start_time,
+                "end_time": end_time,
+            },
+            "sort_by": "TIMESTAMP",
+        }
+        # A request refused with an expired token is sent again with a fresh one.
+        for attempt in range(2):
+            token = self.token()
+            headers = {
+                'accept': 'application/json',
+                'Content-Type': 'application/json',
+                'Authorization': 'Bearer ' + token,
+            }
+            response = services.nexar_request('POST', services.NEXAR_FRAMES_URL, headers=headers, json=json_data)
+            if response.status_code != 401:
+                break
+            response.close()
+            self.token_refused(token)
+        response.raise_for_status()
+        return response.json().get('frames', [])
+
+    def pages(self):
+        # Yield the frames of the region page by page, splitting time windows that may have been truncated.
+        windows = [(self.start_time, self.end_time)]
+        while windows and not self.stop.is_set():
+            start_time, end_time = windows.pop()
+            frames = self.search(start_time, end_time)
+            # A page that may have been truncated has its time window split.
+            if len(frames) >= services.NEXAR_PAGE_LIMIT and end_time - start_time > MIN_WINDOW:
+                middle = (start_time + end_time) // 2
+                # Later window pushed first, so windows are visited in time order.
+                windows.append((middle + 1, end_time))
+                windows.append((start_time, middle))
+                continue
+            # Drop the frames in the corners of the box, outside the region.
+            keep = geodesy.within_radius(self.latitude, self.longitude, self.radius,
+                                         [frame['gps_info']['latitude'] for frame in frames],
+                                         [frame['gps_info']['longitude'] for frame in frames])
+            yield [frame for frame, inside in zip(frames, keep) if inside]
+
+    def page(self):
+        # Feed the download stage with frames not yet ingested.
+        try:
+            for frames in self.pages():
+                frame_ids = [str(frame['frame_id']) for frame in frames]
+                self.count('paged', len(frames))
+
+                # Skip frames completed by an earlier run, or already in the datalake.
+                done = self.checkpoint.done_ids(frame_ids)
+                remaining = [frame_id for frame_id in frame_ids if frame_id not in done]
+                if remaining:
+                    try:
+                        found = known_frames.query_datalake(remaining, [self.db_region])
+                    except Exception as e:
+                        # Inserts don't duplicate rows, so ingesting a known frame again only costs time.
+                        log.warning(f"Datalake lookup of Nexar frames failed; {e}")
+                    else:
+                        if found:
+                            self.checkpoint.mark_done(found)
+                        done.update(found)
+
+                for frame in frames:
+                    if str(frame['frame_id']) in done:
+                        self.count('skipped')
+                        continue
+                    # Blocks while the download stage is behind.
+                    self.put(self.download_queue, frame)
+        except Exception as e:
+            log.error(f"Paging through Nexar frames failed; {e}")
+            self.count('failed')
+        finally:
+            for _ in range(self.download_workers):
+                self.put(self.download_queue, _DONE, force=True)
+
+    def put(self, stage_queue, item, force=False):
+        # Put on a bounded queue, giving up if the run is stopped, unless forced.
+        while True:
+            try:
+                stage_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if self.stop.is_set() and not force:
+                    return
+
+    # Download stage.
+
+    def download(self):
+        # A worker leaving early would never end the next stage's queue, so every frame's failure is caught.
+        try:
+            while True:
+                frame = self.download_queue.get()
+                if frame is _DONE:
+                    break
+                if self.stop.is_set():
+                    continue
+                try:
+                    self.download_frame(frame)
+                except Exception as e:
+                    log.warning(f"Download of frame {frame.get('frame_id')} failed; {e}")
+                    self.count('failed')
+        finally:
+            self.finish_worker('download', self.upload_queue, self.upload_workers)
+
+    def download_frame(self, frame):
+        file = frame['frame_url'].split('/')[-1]
+        path = os.path.join(self.directory, file)
+        # Images cached before the run, by the tool or an earlier run, are kept.
+        cached = os.path.exists(path)
+        for attempt in range(1, ATTEMPTS + 1):
+            token = self.token()
+            try:
+                if not os.path.exists(path):
+                    services.download_nexar_file(frame['frame_url'], path, token)
+            except Exception as e:
+                if unauthorized(e):
+                    self.token_refused(token)
+                log.warning(f"Download of frame {frame['frame_id']} failed, attempt {attempt}; {e}")
+            else:
+                self.count('downloaded')
+                self.put(self.upload_queue, (frame, path, cached))
+                return
+        self.count('failed')
+
+    # Upload stage.
+
+    def upload(self):
+        try:
+            while True:
+                item = self.upload_queue.get()
+                if item is _DONE:
+                    break
+                if self.stop.is_set():
+                    continue
+                frame, path, cached = item
+                try:
+                    self.upload_frame(frame, path, cached)
+                except Exception as e:
+                    log.warning(f"Upload of frame {frame.get('frame_id')} failed; {e}")
+                    self.count('failed')
+        finally:
+            self.finish_worker('upload', self.insert_queue, 1)
+
+    def upload_frame(self, frame, path, cached):
+        file = os.path.basename(path)
+        # Computed first, so a frame missing a value isn't uploaded for nothing.
+        values = camera_image_values(frame, f's3://{BUCKET}/{file}')
+        for attempt in range(1, ATTEMPTS + 1):
+            try:
+                services.upload_file(path, BUCKET, file)
+            except Exception as e:
+                log.warning(f"Upload of frame {frame['frame_id']} failed, attempt {attempt}; {e}")
+            else:
+                self.upload_thumbnail(frame, path, file)
+                self.count('uploaded')
+                self.put(self.insert_queue, (str(frame['frame_id']), values, None if cached else path))
+                return
+        self.count('failed')
+
+    def upload_thumbnail(self, frame, path, file):
+        # Store the thumbnail derivative the datalake search shows. A missing one is made by backfill_thumbnails.py.
+        try:
+            thumbnails.upload_thumbnail(path, BUCKET, file)
+        except Exception as e:
+            log.warning(f"Thumbnail upload of frame {frame['frame_id']} failed; {e}")
+
+    # Insert stage.
+
+    def insert(self):
+        batch = []
+        while True:
+            try:
+                item = self.insert_queue.get(timeout=1)
+            except queue.Empty:
+                item = None
+            if item is not None and item is not _DONE:
+                batch.append(item)
+            # Insert full batches, and partial ones when the queue runs dry or the run ends.
+            if batch and (len(batch) >= self.batch_size or item is None or item is _DONE):
+                self.insert_batch(batch)
+                batch = []
+            if item is _DONE:
+                break
+
+    def insert_batch(self, batch):
+        try:
+            with services.db_connection(self.db_region) as conn:
+                with conn.cursor() as cursor:
+                    for frame_id, values, path in batch:
+                        cursor.execute("""
+                        INSERT INTO datalake.camera_image (s3_location, geom, version, datetime, vehicle_heading)
+                        VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""", values)
+        except Exception as e:
+            log.warning(f"Insert of {len(batch)} frames failed; {e}")
+            self.count('failed', len(batch))
+            return
+
+        # Only committed frames are checkpointed.
+        known = {frame_id: values[0] for frame_id, values, path in batch}
+        self.checkpoint.mark_done(known)
+        known_frames.update(known)
+        self.count('ingested', len(batch))
+
+        # The images are in s3 now. Those downloaded by this run would only fill the disk.
+        for frame_id, values, path in batch:
+            if path is not None:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    log.warning(f"Could not remove the image of frame {frame_id}; {e}")
+
+    def run(self, report=print):
+        """
+        Run the ingestion to completion, or until interrupted, reporting progress with report.
+        Return the counts of frames paged, skipped, downloaded, uploaded, ingested and failed.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.token()
+
+        threads = [threading.Thread(target=self.page, name='ingest-page', daemon=True)]
+        threads += [threading.Thread(target=self.download, name=f'ingest-download-{n}', daemon=True)
+                    for n in range(self.download_workers)]
+        threads += [threading.Thread(target=self.upload, name=f'ingest-upload-{n}', daemon=True)
+                    for n in range(self.upload_workers)]
+        threads += [threading.Thread(target=self.insert, name='ingest-insert', daemon=True)]
+
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+
+        last_time, last_ingested = started, 0
+        try:
+            while any(thread.is_alive() for thread in threads):
+                threads[-1].join(REPORT_INTERVAL)
+                now = time.monotonic()
+                ingested = self.counts['ingested']
+                report(f"{ingested} ingested, {(ingested - last_ingested) / (now - last_time):.2f} frames/s now, "
+                       f"{ingested / (now - started):.2f} frames/s sustained; {self.counts['skipped']} skipped, "
+                       f"{self.counts['failed']} failed; queues {self.download_queue.qsize()}/"
+                       f"{self.upload_queue.qsize()}/{self.insert_queue.qsize()}")
+                last_time, last_ingested = now, ingested
+        except KeyboardInterrupt:
+            report("Interrupted; finishing the frames in progress. Run again to resume.")
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+
+        elapsed = time.monotonic() - started
+        report(f"Done in {elapsed:.1f} s: {json.dumps(self.counts)}; "
+               f"{self.counts['ingested'] / elapsed if elapsed else 0:.2f} frames/s sustained.")
+        return dict(self.counts)
+
+
+def parse_date(text):
+    # Return epoch ms of a YYYY-MM-DD date.
+    return int(dt.strptime(text, '%Y-%m-%d').timestamp() * 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latitude', type=float, required=True)
+    parser.add_argument('--longitude', type=float, required=True)
+    parser.add_argument('--radius', type=float, required=True, help='radius of the region in meters')
+    parser.add_argument('--start', type=parse_date, default='2014-01-01', help='first capture date, YYYY-MM-DD')
+    parser.add_argument('--end', type=parse_date, default=(dt.now() + timedelta(days=1)).strftime('%Y-%m-%d'),
+                        help='capture date to stop before, YYYY-MM-DD; by default tomorrow, to include today')
+    parser.add_argument('--directions', nargs='+', choices=DIRECTIONS, default=DIRECTIONS)
+    parser.add_argument('--min-frame-quality', type=float, default=0.7)
+    parser.add_argument('--checkpoint', default='ingest_checkpoint.sqlite', help='checkpoint file to resume from')
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=100, help='rows inserted per transaction')
+    parser.add_argument('--queue-size', type=int, default=16, help='capacity of the queues between stages')
+    parser.add_argument('--db-region', default=None, help='datalake database; by default, the region of the center')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    # Frames are downloaded through the cache daemon shared with the tool, if set.
+    cache_daemon.install_from_environment()
+
+    checkpoint = Checkpoint(args.checkpoint)
+    print(f"Resuming with {checkpoint.count()} frames already ingested." if checkpoint.count() else
+          "Starting a new ingestion.")
+    # The end time is inclusive, so it is the last ms before the end date.
+    ingestion = Ingestion(args.latitude, args.longitude, args.radius, args.start, args.end - 1, checkpoint,
+                          directions=args.directions, min_frame_quality=args.min_frame_quality,
+                          download_workers=args.download_workers, upload_workers=args.upload_workers,
+                          batch_size=args.batch_size, queue_size=args.queue_size,
+                          db_region=args.db_region)
+    try:
+        counts = ingestion.run()
+    finally:
+        checkpoint.close()
+    return 0 if not counts['failed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Local mirror of the Nexar frames that were already ingested into the datalake.
+
+Nexar frames ingested into datalake.camera_image are stored with version = 'nexar:{frame_id}'.
+The mirror maps frame_id to s3_location, so known frames can be recognized without a database
+round trip, and still be recognized when the database can't be reached.
+"""
+
+import json
+import logging
+import os
+import threading
+
+import regions
+import services
+
+log = logging.getLogger(__name__)
+
+MIRROR_PATH = 'known_frames.json'
+
+_lock = threading.Lock()
+_frames = None
+
+
+def _load():
+    # Read the mirror from disk the first time it is needed.
+    global _frames
+    if _frames is None:
+        try:
+            with open(MIRROR_PATH, 'r') as f:
+                _frames = json.load(f)
+        except (OSError, ValueError):
+            _frames = {}
+    return _frames
+
+
+def lookup(frame_ids):
+    """
+    Return a dictionary of frame_id to s3_location for the frame ids found in the mirror.
+    """
+    with _lock:
+        frames = _load()
+        return {frame_id: frames[frame_id] for frame_id in frame_ids if frame_id in frames}
+
+
+def update(known):
+    """
+    Add a dictionary of frame_id to s3_location to the mirror, and save it if anything changed.
+    """
+    with _lock:
+        frames = _load()
+        changed = {frame_id: s3_location for frame_id, s3_location in known.items()
+                   if frames.get(frame_id) != s3_location}
+        if not changed:
+            return
+        frames.update(changed)
+        # Write to a temporary file first, so an interrupted write never leaves a truncated mirror.
+        with open(MIRROR_PATH + '.tmp', 'w') as f:
+            json.dump(frames, f)
+        os.replace(MIRROR_PATH + '.tmp', MIRROR_PATH)
+
+
+def query_datalake(frame_ids, db_regions=('north_america',)):
+    """
+    Look up frame ids in datalake.camera_image of every region given, with one bulk query per region run
+    in parallel, and add the ones found to the mirror.
+    Return a dictionary of frame_id to s3_location for the frames found. Raise if no region could be queried.
+    """
+    versions = [f'nexar:{frame_id}' for frame_id in frame_ids]
+
+    def query(db_region):
+        with services.db_connection(db_region) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(""" SELECT version, s3_location
+                FROM datalake.camera_image
+                WHERE version = ANY(%s)""", (versions,))
+                return cursor.fetchall()
+
+    results, errors = regions.fan_out(list(db_regions), query)
+    if errors and not results:
+        raise next(iter(errors.values()))
+    for db_region, e in errors.items():
+        log.warning(f"Datalake lookup of Nexar frames in {db_region} failed; {e}")
+
+    found = {version.split(':', 1)[1]: s3_location
+             for rows in results.values() for version, s3_location in rows}
+    update(found)
+    return found
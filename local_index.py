@@ -0,0 +1,242 @@
+"""
+Local index of the search results whose images are cached on this machine.
+
+Every Datalake row and Nexar frame returned by a search is recorded with its location, heading,
+capture time and details, and the cache paths of its thumbnail and full image are added as they are
+downloaded. An R-tree over the locations answers an area search from the index in milliseconds, so
+the grid fills with what is already cached before, or without, any remote query.
+
+The index also keeps a watermark per Nexar search area: the newest capture time of the frames seen
+there, and the start of the time window searched. Every frame in that window up to the watermark is
+in the index, so a follow-up search of the area only asks Nexar for the frames captured since.
+"""
+
+import json
+import sqlite3
+import threading
+from datetime import datetime as dt
+
+import numpy as np
+
+import disk_cache
+import geodesy
+import result_filter
+
+INDEX_PATH = 'local_index.sqlite'
+
+DATALAKE = 'datalake'
+NEXAR = 'nexar'
+
+_lock = threading.Lock()
+_conn = None
+
+
+def _connect():
+    # Open the index the first time it is needed, creating its tables.
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(INDEX_PATH, check_same_thread=False)
+        _conn.execute("""CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY,
+            source TEXT NOT NULL,
+            key TEXT NOT NULL,
+            latitude REAL, longitude REAL, heading REAL, direction TEXT, captured_at REAL,
+            thumbnail_path TEXT, image_path TEXT,
+            record TEXT NOT NULL,
+            UNIQUE (source, key))""")
+        _conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS images_rtree USING rtree("
+                      "id, min_latitude, max_latitude, min_longitude, max_longitude)")
+        _conn.execute("""CREATE TABLE IF NOT EXISTS watermarks (
+            area TEXT PRIMARY KEY,
+            start_time INTEGER NOT NULL,
+            newest INTEGER NOT NULL)""")
+        _conn.commit()
+    return _conn
+
+
+def _encode_row(row):
+    # Datalake rows hold a datetime, at index 7, and may hold Decimals; keep them as text.
+    return json.dumps([value.isoformat() if isinstance(value, dt) else value for value in row], default=str)
+
+
+def _decode_row(text):
+    row = json.loads(text)
+    if row[7] is not None:
+        row[7] = dt.fromisoformat(row[7])
+    return tuple(row)
+
+
+def _add(entries):
+    # Insert or update entries of (source, key, latitude, longitude, heading, direction, captured_at, record).
+    with _lock:
+        conn = _connect()
+        for source, key, latitude, longitude, heading, direction, captured_at, record in entries:
+            conn.execute("""INSERT INTO images (source, key, latitude, longitude, heading, direction, captured_at, record)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (source, key) DO UPDATE SET latitude = excluded.latitude, longitude = excluded.longitude,
+                heading = excluded.heading, direction = excluded.direction, captured_at = excluded.captured_at,
+                record = excluded.record""",
+                         (source, key, latitude, longitude, heading, direction, captured_at, record))
+            image_id = conn.execute("SELECT id FROM images WHERE source = ? AND key = ?", (source, key)).fetchone()[0]
+            if latitude is not None and longitude is not None:
+                conn.execute("INSERT OR REPLACE INTO images_rtree VALUES (?, ?, ?, ?, ?)",
+                             (image_id, latitude, latitude, longitude, longitude))
+        conn.commit()
+
+
+def add_nexar_frames(frames):
+    """
+    Record the Nexar frames returned by a search.
+    """
+    entries = []
+    for frame in frames:
+        captured_at = frame.get('captured_at')
+        entries.append((NEXAR, str(frame['frame_id']), float(frame['gps_info']['latitude']),
+                        float(frame['gps_info']['longitude']), frame.get('camera_heading'), frame.get('direction'),
+                        # captured_at is epoch ms
+                        float(captured_at) / 1000 if captured_at is not None else None, json.dumps(frame)))
+    _add(entries)
+
+
+def add_datalake_rows(rows):
+    """
+    Record the rows of the datalake.camera_image query returned by a search.
+    """
+    entries = []
+    for row in rows:
+        longitude, latitude = result_filter.parse_point(row[4])
+        if np.isnan(latitude):
+            latitude = longitude = None
+        # Row ids are only unique within a region's database; s3 locations are unique across them.
+        entries.append((DATALAKE, row[1], latitude, longitude,
+                        float(row[8]) if row[8] is not None else None, None,
+                        row[7].timestamp() if row[7] is not None else None, _encode_row(row)))
+    _add(entries)
+
+
+def set_thumbnail_path(source, key, path):
+    """
+    Record where the thumbnail of a result is cached.
+    """
+    with _lock:
+        conn = _connect()
+        conn.execute("UPDATE images SET thumbnail_path = ? WHERE source = ? AND key = ?", (path, source, str(key)))
+        conn.commit()
+
+
+def set_image_path(source, key, path):
+    """
+    Record where the full image of a result is cached.
+    """
+    with _lock:
+        conn = _connect()
+        conn.execute("UPDATE images SET image_path = ? WHERE source = ? AND key = ?", (path, source, str(key)))
+        conn.commit()
+
+
+def search(source, latitude, longitude, radius_meters, start_time=None, end_time=None, directions=None,
+           cached_only=True):
+    """
+    Return the indexed results of source within radius_meters of a point, as Nexar frames or Datalake rows.
+
+    Parameters:
+    - start_time, end_time: float, capture time window in epoch seconds, or None.
+    - directions: collection of Nexar direction names, or None/empty for all.
+    - cached_only: bool, only return results with a thumbnail or full image still on disk.
+    """
+    south, west, north, east = geodesy.bounding_box(latitude, longitude, radius_meters)
+    sql = """SELECT images.latitude, images.longitude, images.direction, images.captured_at,
+        images.thumbnail_path, images.image_path, images.record
+        FROM images_rtree JOIN images ON images.id = images_rtree.id
+        WHERE images_rtree.max_latitude >= ? AND images_rtree.min_latitude <= ?
+        AND images_rtree.max_longitude >= ? AND images_rtree.min_longitude <= ?
+        AND images.source = ?"""
+    params = [south, north, west, east, source]
+    if cached_only:
+        sql += " AND (images.thumbnail_path IS NOT NULL OR images.image_path IS NOT NULL)"
+    if start_time is not None:
+        sql += " AND images.captured_at >= ?"
+        params.append(start_time)
+    if end_time is not None:
+        sql += " AND images.captured_at <= ?"
+        params.append(end_time)
+
+    with _lock:
+        entries = _connect().execute(sql, params).fetchall()
+
+    if directions and source == NEXAR:
+        entries = [entry for entry in entries if entry[2] in directions]
+    # The R-tree answers the box; keep the results within the radius.
+    keep = geodesy.within_radius(latitude, longitude, radius_meters,
+                                 [entry[0] for entry in entries], [entry[1] for entry in entries])
+    entries = [entry for entry, inside in zip(entries, keep) if inside]
+    if cached_only:
+        # Entries whose cache files were since removed can't be shown offline.
+        entries = [entry for entry in entries
+                   if (entry[4] and disk_cache.exists(entry[4])) or (entry[5] and disk_cache.exists(entry[5]))]
+
+    if source == NEXAR:
+        return [json.loads(entry[6]) for entry in entries]
+    return [_decode_row(entry[6]) for entry in entries]
+
+
+def area_key(latitude, longitude, radius_meters, directions, min_quality):
+    """
+    Return the key of the watermark of a Nexar search area, with the filters that decide which frames it holds.
+    """
+    return json.dumps([round(latitude, 5), round(longitude, 5), round(radius_meters, 1),
+                       sorted(directions), min_quality])
+
+
+def watermark(area):
+    """
+    Return (start_time, newest) of the watermark of an area, in epoch ms, or None if it was never searched.
+    Every frame of the area captured from start_time up to newest is in the index.
+    """
+    with _lock:
+        entry = _connect().execute("SELECT start_time, newest FROM watermarks WHERE area = ?", (area,)).fetchone()
+    return tuple(entry) if entry else None
+
+
+def set_watermark(area, start_time, newest):
+    """
+    Record that every frame of an area captured from start_time up to newest, in epoch ms, is in the index.
+    """
+    with _lock:
+        conn = _connect()
+        conn.execute("""INSERT INTO watermarks (area, start_time, newest) VALUES (?, ?, ?)
+            ON CONFLICT (area) DO UPDATE SET start_time = excluded.start_time, newest = excluded.newest""",
+                     (area, start_time, newest))
+        conn.commit()
+
+
+def advance_watermark(area, start_time, frames, mark=None, truncated=False):
+    """
+    Record the frames a search of an area returned as seen, and return the new watermark of the area.
+
+    Parameters:
+    - start_time: int, start of the time window searched, in epoch ms.
+    - mark: (start_time, newest) the search continued from, or None if it searched the whole window.
+    - truncated: bool, the response may have been cut short, so frames before its newest may be missing.
+      The watermark is left as it was.
+    """
+    if truncated:
+        return mark
+    newest = max([int(frame['captured_at']) for frame in frames if frame.get('captured_at') is not None]
+                 + ([mark[1]] if mark else []), default=None)
+    if newest is None:
+        return mark
+    start_time = mark[0] if mark else start_time
+    set_watermark(area, start_time, newest)
+    return start_time, newest
+
+
+def close():
+    """
+    Close the index, so its file can be removed. It is opened again when next needed.
+    """
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
@@ -6,8 +6,9 @@ ushr.qc.app.env.set_aws_env()
 
 import time
 import sys
-import requests
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 import geoalchemy2
 import shapely
@@ -19,18 +20,42 @@ from PyQt5.QtCore import pyqtSignal, pyqtSlot, Qt
 from PyQt5.QtCore import QDate
 from PyQt5.QtCore import QTime
 from PyQt5.QtCore import QThread
-import ushr.acorn.datalake.utils
-from ushr.acorn.cloud.boto_helpers import upload_file
-from ushr.acorn.cloud.boto_helpers import download_file
 from common import __version__, USHR_ICON
 from PIL import Image
+import cache_daemon
+import cassette
+import comparison
 import creds
+import disk_cache
+import export
+import image_cache
+import known_frames
+import local_index
+import memory_profile
+import phash
+import prefetch
+import preview
+import regions
+import result_filter
+import search
+import services
+import stall_watchdog
+import thumbnails
+import timeline
 
 log = logging.getLogger(__name__)
 
+# Properties of thread_search_nexar the prefetcher searches predicted areas with, as the analyst's search did.
+PREFETCH_NEXAR_SETTINGS = ['start_time', 'end_time', 'min_frame_quality', 'auth_token', 'directions']
+
 FORM_CLASS, _ = uic.loadUiType(os.path.join(os.path.dirname(__file__), 'main.ui'))
 
-METERS_PER_DEGREE = 111139
+
+# Nexar search start time of 1/1/2014, in epoch ms.
+NEXAR_START_TIME = 1388534400000
+# Minimum frame quality requested from Nexar by default.
+NEXAR_MIN_FRAME_QUALITY = 0.7
+
 
 class MainWindow(QMainWindow, FORM_CLASS):
 
@@ -88,6 +113,39 @@ class MainWindow(QMainWindow, FORM_CLASS):
         self.nexar_frames = {}
         # Init empty list for datalake rows.
         self.datalake_rows = []
+        # Init filter columns of the current results, and the extent of the query that fetched them.
+        self.result_columns = None
+        self.fetched_extent = {}
+        # Init list of result indices passing the filter, in display order.
+        self.visible_results = []
+        # Init list of result indices shown in the thumbnail grid, in slot order,
+        # and the near-duplicates collapsed behind each of them.
+        self.grid_results = []
+        self.grid_duplicates = []
+        # Init dictionary of result index to error, for results whose thumbnail failed to load.
+        self.grid_failures = {}
+        # Init thumbnail loading thread, and list of previous ones still finishing.
+        self.thread_load_thumbnails = None
+        self.retired_threads = []
+        # Init full image download thread, and the window previewing the image it downloads.
+        self.thread_download_full_image = None
+        self.preview_window = None
+        # Init export thread.
+        self.thread_export = None
+        # Init database update thread.
+        self.thread_update_DB = None
+        # Init timeline player window.
+        self.timeline_window = None
+        # Init comparison window, its search threads, and the results of each source.
+        self.comparison_window = None
+        self.thread_compare_datalake = None
+        self.thread_compare_nexar = None
+        self.comparison_results = {'datalake': [], 'nexar': []}
+        # Init prefetcher of the areas predicted to be searched next. Created when prefetching is turned on.
+        self.prefetcher = None
+        # Init lists of the Datalake rows and Nexar frames of the current search found in the local index.
+        self.local_rows = []
+        self.local_frames = []
         # Init property used to indicate which thumbnail is currently selected.
         self.currently_selected_image = 0
         # Init property assigned to full image display widget.
@@ -108,6 +166,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
 
         self.disable_image_buttons()
 
+        self.build_filter_panel()
+
         self.refresh_token()
         self.get_auth_token()
 
@@ -115,18 +175,10 @@ class MainWindow(QMainWindow, FORM_CLASS):
         # Used as a callback function of the display.py widget.
         pass
 
-    def upload_to_s3(self, path, bucket, key):
-        try:
-            upload_file(path, bucket, key)  # Upload to s3
-        except Exception as e:
-            self.update_message_log(f"Upload to s3 failed: {e}")
-        else:
-            self.update_message_log(f"Upload to s3 succeeded.")
-
     def download_from_s3(self, path, bucket, key):
 
         try:
-            download_file(path, bucket, key)
+            services.download_file(path, bucket, key)
         except Exception as e:
             self.update_message_log(f"Download from s3 failed: {e}")
         else:
@@ -169,16 +221,17 @@ class MainWindow(QMainWindow, FORM_CLASS):
 
         # This is effectively the download full image button
 
+        # The thumbnail shown in the grid is the placeholder of the preview window.
+        placeholder = self.image_labels[self.currently_selected_image - 1].pixmap()
+
         if self.display_mode == 1:
 
-            # Display datalake image. It was already downloaded as a thumbnail.
+            # Display datalake image. The grid only shows its thumbnail, so the original is downloaded now.
             image_number = self.currently_selected_image
 
-            row = self.datalake_rows[image_number -1]
+            row = self.datalake_rows[self.result_index(image_number)]
 
-            s3_location = row[1]
-            file = s3_location.split('/')[-1]
-            path = 'datalake_images/' + file
+            file = row[1].split('/')[-1]
 
             self.update_message_log(f"id: {row[0]}")
             self.update_message_log(f"s3_location: {row[1]}")
@@ -193,116 +246,190 @@ class MainWindow(QMainWindow, FORM_CLASS):
             self.update_message_log(f"cam_id: {row[10]}")
             self.update_message_log("---------------------------------------------------------")
 
-            # Launch widget to display image.
-            self.window = QtWidgets.QWidget()
-            # Pass path of image and display mode which indicates datalake or nexar.
-            self.ui = Ui_Form(self.window, path, self.display_mode)
-            # Define handler to process dialog content.
-            # This callback function is not currently in use.
-            # self.ui.submitted.connect(self.process_full_image_display())
-            # Using showMaximized instead of show allows you to see the entire datalake image instead of a portion.
-            # self.window.show()
-            self.window.showMaximized()
+            def loaded(path):
+                # Record where the image is cached, so the local index can offer it offline.
+                local_index.set_image_path(local_index.DATALAKE, row[1], path)
+
+            self.open_full_image(file, placeholder, export.datalake_row_sources(row), loaded)
 
         elif self.display_mode == 2:
 
             # Download nexar image.
             image_number = self.currently_selected_image
-            frame = self.nexar_frames['frames'][image_number - 1]
+            frame = self.nexar_frames['frames'][self.result_index(image_number)]
 
             url = frame['frame_url']
             file = url.split('/')[-1]
 
-            nexar_path = 'full_images/' + file
             datalake_path = 'datalake_images/' + file
             bucket = 'ushr-image/Nexar'
             key = file
 
+            # The search found this frame already in the datalake, so it is in our s3 bucket and database.
+            datalake_s3_location = frame.get('datalake_s3_location')
+            if datalake_s3_location:
+                file, bucket, key = services.split_s3_location(datalake_s3_location)
+                datalake_path = 'datalake_images/' + file
+
             # Avoid downloading from Nexar if possible.
             # If the image has already been downloaded from Nexar or datalake, it will be in a local directory.
             # If it's not stored locally, try downloading from s3 bucket.
             # If it is not found in either of these locations, must resort to downloading from Nexar.
-            if os.path.exists(datalake_path):
-                self.update_message_log(f'Image previously downloaded: /datalake_images/{file}')
-                path = datalake_path
-            elif os.path.exists(nexar_path):
-                self.update_message_log(f'Image previously downloaded: /full_images/{file}')
-                path = nexar_path
-            else:
-                try:
-                    # Download from datalake s3 bucket
-                    download_file(datalake_path, bucket, key)
-                    path = datalake_path
-                    self.update_message_log(f'Image downloaded: /datalake_images/{file}')
-                except Exception as ex:
-                    # download full image from nexar
-                    self.download_full_image(url)
-                    path = nexar_path
-
-            # Launch widget to display image.
-            self.window = QtWidgets.QWidget()
-            # Pass path of image and display mode which indicates datalake or nexar.
-            self.ui = Ui_Form(self.window, path, self.display_mode)
-            # Define handler to process dialog content.
-            # This callback function is not currently in use.
-            # self.ui.submitted.connect(self.process_full_image_display())
-            # Using showMaximized instead of show matches what is done for datalake images.
-            # self.window.show()
-            self.window.showMaximized()
-
-            # upload full image to s3
-            self.upload_to_s3(path, bucket, key)
+            sources = export.nexar_frame_sources(frame)
+
+            def loaded(path):
+                # Record where the image is cached, so the local index can offer it offline.
+                local_index.set_image_path(local_index.NEXAR, frame['frame_id'], path)
+                # A frame already in the datalake needs no upload or database update.
+                if datalake_s3_location and path == datalake_path:
+                    self.update_message_log(f"Image already in Datalake: {datalake_s3_location}")
+                    self.update_message_log("---------------------------------------------------------")
+                    return
+                self.add_nexar_image_to_datalake(frame, path, file, bucket, key)
+
+            self.open_full_image(file, placeholder, sources, loaded)
+
+    def open_full_image(self, file, placeholder, sources, loaded):
+        # Open a preview window at once, and download the full image in a separate thread.
+        # loaded is called with the path of the full image once it is complete.
+
+        # An earlier download still running is left to finish, but is no longer shown.
+        self.retire_thread_download_full_image()
+        if self.preview_window is not None:
+            self.preview_window.close()
+
+        self.preview_window = preview.PreviewWindow(file, placeholder)
+        # An image decoded before, or ahead of time, is shown at full resolution at once.
+        for source in sources:
+            image = image_cache.cache.get(source[1]) if source[0] == 'local' else None
+            if image is not None:
+                self.preview_window.show_image(image)
+                break
+        self.preview_window.showMaximized()
+
+        # Create and start a new thread to contain execution of the full image download.
+        self.thread_download_full_image = thread_download_full_image()
+        # Connect event handlers before starting the thread.
+        self.thread_download_full_image.thread_download_full_image_status.connect(
+            self.evt_thread_download_full_image_status)
+        self.thread_download_full_image.thread_download_full_image_preview.connect(self.preview_window.show_image)
+        self.thread_download_full_image.thread_download_full_image_loaded.connect(
+            lambda path: self.evt_thread_download_full_image_loaded(path, loaded))
+        self.thread_download_full_image.thread_download_full_image_failed.connect(
+            self.evt_thread_download_full_image_failed)
+        # Assign properties of the new thread instance.
+        self.thread_download_full_image.sources = sources
+        self.thread_download_full_image.auth_token = self.auth_token
+        # Start the thread.
+        self.thread_download_full_image.start()
 
-            image_number = self.currently_selected_image
-            frame = self.nexar_frames['frames'][image_number - 1]
-            captured_epoch = frame['captured_at']
-            # convert from ms to s
-            captured_epoch = float(captured_epoch/1000)
+    def retire_thread_download_full_image(self):
+        # Stop showing a running full image download, and keep a reference until it finishes.
+        thread = self.thread_download_full_image
+        if thread is None or thread.isFinished():
+            return
+        thread.thread_download_full_image_status.disconnect()
+        thread.thread_download_full_image_preview.disconnect()
+        thread.thread_download_full_image_loaded.disconnect()
+        thread.thread_download_full_image_failed.disconnect()
+        thread.thread_download_full_image_status.connect(self.update_message_log)
+        self.retired_threads.append(thread)
+        thread.finished.connect(lambda: self.retired_threads.remove(thread))
+
+    def evt_thread_download_full_image_status(self, status):
+        # This event is used to update the message log with full image download progress.
+        self.update_message_log(status)
+        if self.preview_window is not None:
+            self.preview_window.show_status(status)
+
+    def evt_thread_download_full_image_loaded(self, path, loaded):
+        # This event is used to hand the complete image over from the preview window to the viewer.
+
+        # Launch widget to display image.
+        self.window = QtWidgets.QWidget()
+        # Pass path of image and display mode which indicates datalake or nexar.
+        self.ui = Ui_Form(self.window, path, self.display_mode)
+        # Define handler to process dialog content.
+        # This callback function is not currently in use.
+        # self.ui.submitted.connect(self.process_full_image_display())
+        # Using showMaximized instead of show allows you to see the entire image instead of a portion.
+        # self.window.show()
+        self.window.showMaximized()
+
+        if self.preview_window is not None:
+            self.preview_window.close()
+            self.preview_window = None
+
+        loaded(path)
+
+    def evt_thread_download_full_image_failed(self, error):
+        # This event is used to report a full image that could not be downloaded from any source.
+        self.update_message_log(f"Full image could not be downloaded; {error}")
+        if self.preview_window is not None:
+            self.preview_window.show_status(f"Full image could not be downloaded; {error}")
+
+    def add_nexar_image_to_datalake(self, frame, path, file, bucket, key):
+        # Upload a Nexar frame opened in the viewer to s3, and add it to the database, in a separate thread.
+
+        captured_epoch = frame['captured_at']
+        # convert from ms to s
+        captured_epoch = float(captured_epoch/1000)
+
+        captured_date_time = dt.fromtimestamp(captured_epoch)
+        camera_heading = frame['camera_heading']
+
+        # Calculate geom for DB entry.
+        frame_id = frame['frame_id']
+        latitude = float(frame['gps_info']['latitude'])
+        longitude = float(frame['gps_info']['longitude'])
+        captured_geom = geoalchemy2.shape.from_shape(shapely.geometry.Point((longitude, latitude)), srid=4326)
+
+        # Assign other values for DB entry.
+        s3_location = f"s3://{bucket}/{file}"
+        # asset_id = None
+        # processing_index = None
+        geom = captured_geom
+        # geom must be cast as a string
+        geom = str(geom)
+        version = f'nexar:{frame_id}'
+        datetime = captured_date_time
+        vehicle_heading = camera_heading
+        vehicle_heading = round(float(vehicle_heading), 2) % 360
+        # image_heading = None
+        # cam_id = None
+
+        self.update_message_log(f"Uploading to s3 and updating database if necessary.")
+        self.update_message_log(f"s3_location: {s3_location}")
+        self.update_message_log(f"geom: {geom}")
+        self.update_message_log(f"version: {version}")
+        self.update_message_log(f"datetime: {datetime}")
+        self.update_message_log(f"vehicle_heading: {vehicle_heading}")
+        self.update_message_log("---------------------------------------------------------")
 
-            captured_date_time = dt.fromtimestamp(captured_epoch)
-            camera_heading = frame['camera_heading']
-
-            # Calculate geom for DB entry.
-            frame_id = frame['frame_id']
-            latitude = float(frame['gps_info']['latitude'])
-            longitude = float(frame['gps_info']['longitude'])
-            captured_geom = geoalchemy2.shape.from_shape(shapely.geometry.Point((longitude, latitude)), srid=4326)
-
-            # Assign other values for DB entry.
-            s3_location = f"s3://{bucket}/{file}"
-            # asset_id = None
-            # processing_index = None
-            geom = captured_geom
-            # geom must be cast as a string
-            geom = str(geom)
-            version = f'nexar:{frame_id}'
-            datetime = captured_date_time
-            vehicle_heading = camera_heading
-            vehicle_heading = round(float(vehicle_heading), 2) % 360
-            # image_heading = None
-            # cam_id = None
-
-            self.update_message_log(f"Updating database if necessary.")
-            self.update_message_log(f"s3_location: {s3_location}")
-            self.update_message_log(f"geom: {geom}")
-            self.update_message_log(f"version: {version}")
-            self.update_message_log(f"datetime: {datetime}")
-            self.update_message_log(f"vehicle_heading: {vehicle_heading}")
-            self.update_message_log("---------------------------------------------------------")
+        # An update of an earlier image still running is kept until it finishes.
+        thread = self.thread_update_DB
+        if thread is not None and not thread.isFinished():
+            self.retired_threads.append(thread)
+            thread.finished.connect(lambda: self.retired_threads.remove(thread))
 
-            # Create and start a new thread to contain execution of the DB update.
-            self.thread_update_DB = thread_updateDB()
-            # Connect event handlers before starting the thread.
-            self.thread_update_DB.finished.connect(self.evt_thread_updateDB_finished)
-            self.thread_update_DB.thread_updateDB_status.connect(self.evt_thread_updateDB_status)
-            # Assign properties of the new thread instance.
-            self.thread_update_DB.s3_location = s3_location
-            self.thread_update_DB.geom = geom
-            self.thread_update_DB.version = version
-            self.thread_update_DB.datetime = datetime
-            self.thread_update_DB.vehicle_heading = vehicle_heading
-            # Start the thread.
-            self.thread_update_DB.start()
+        # Create and start a new thread to contain execution of the s3 uploads and DB update.
+        self.thread_update_DB = thread_updateDB()
+        # Connect event handlers before starting the thread.
+        self.thread_update_DB.finished.connect(self.evt_thread_updateDB_finished)
+        self.thread_update_DB.thread_updateDB_status.connect(self.evt_thread_updateDB_status)
+        # Assign properties of the new thread instance.
+        # The image goes into the database of the region it was taken in.
+        self.thread_update_DB.db_region = regions.region_of_point(latitude, longitude)
+        self.thread_update_DB.s3_location = s3_location
+        self.thread_update_DB.geom = geom
+        self.thread_update_DB.version = version
+        self.thread_update_DB.datetime = datetime
+        self.thread_update_DB.vehicle_heading = vehicle_heading
+        self.thread_update_DB.path = path
+        self.thread_update_DB.bucket = bucket
+        self.thread_update_DB.key = key
+        # Start the thread.
+        self.thread_update_DB.start()
 
     def evt_thread_updateDB_status(self, status):
         # This event is used to update the message log with DB update progress.
@@ -434,10 +561,12 @@ class MainWindow(QMainWindow, FORM_CLASS):
 
     def display_image_info(self, image_number):
 
+        self.predecode_neighbours(image_number)
+
         if self.display_mode == 1:
             # Display datalake images
             rows = self.datalake_rows
-            row = rows[image_number - 1]
+            row = rows[self.result_index(image_number)]
 
             self.plain_text_edit_details.appendPlainText(f"id: {row[0]}")
             self.plain_text_edit_details.appendPlainText(f"s3_location: {row[1]}")
@@ -454,7 +583,7 @@ class MainWindow(QMainWindow, FORM_CLASS):
 
         elif self.display_mode == 2:
             # Display nexar images
-            frame = self.nexar_frames['frames'][image_number - 1]
+            frame = self.nexar_frames['frames'][self.result_index(image_number)]
             captured_epoch = frame['captured_at']
             # convert from ms to s
             captured_epoch = float(captured_epoch / 1000)
@@ -473,6 +602,13 @@ class MainWindow(QMainWindow, FORM_CLASS):
             self.plain_text_edit_details.appendPlainText(f"frame_context: {frame['frame_context']}")
             self.plain_text_edit_details.appendPlainText(f"thumbnail_url: {frame['thumbnail_url']}")
             self.plain_text_edit_details.appendPlainText(f"frame_url: {frame['frame_url']}")
+            if frame.get('datalake_s3_location'):
+                self.plain_text_edit_details.appendPlainText(f"in datalake: {frame['datalake_s3_location']}")
+            duplicates = self.grid_duplicates[image_number - 1]
+            if duplicates:
+                frames = self.nexar_frames['frames']
+                duplicate_ids = ', '.join(str(frames[index]['frame_id']) for index in duplicates)
+                self.plain_text_edit_details.appendPlainText(f"near-duplicates collapsed: {duplicate_ids}")
 
     def deselect_image_buttons(self):
 
@@ -482,6 +618,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_north_clicked(self):
         self.north_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def north_clicked(self):
         if self.direction_north:
@@ -494,6 +632,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_south_clicked(self):
         self.south_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def south_clicked(self):
         if self.direction_south:
@@ -506,6 +646,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_east_clicked(self):
         self.east_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def east_clicked(self):
         if self.direction_east:
@@ -518,6 +660,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_west_clicked(self):
         self.west_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def west_clicked(self):
         if self.direction_west:
@@ -530,6 +674,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_northwest_clicked(self):
         self.northwest_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def northwest_clicked(self):
         if self.direction_northwest:
@@ -542,6 +688,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_northeast_clicked(self):
         self.northeast_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def northeast_clicked(self):
         if self.direction_northeast:
@@ -554,6 +702,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_southwest_clicked(self):
         self.southwest_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def southwest_clicked(self):
         if self.direction_southwest:
@@ -566,6 +716,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_southeast_clicked(self):
         self.southeast_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def southeast_clicked(self):
         if self.direction_southeast:
@@ -578,6 +730,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_all_clicked(self):
         self.all_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def all_clicked(self):
 
@@ -598,6 +752,8 @@ class MainWindow(QMainWindow, FORM_CLASS):
     @pyqtSlot()
     def on_button_none_clicked(self):
         self.none_clicked()
+        # Update the grid from results already fetched, for the new direction selection.
+        self.apply_result_filter()
 
     def none_clicked(self):
 
@@ -619,7 +775,7 @@ class MainWindow(QMainWindow, FORM_CLASS):
         # Initial values
         latitude = 0
         longitude = 0
-        radius_degrees = 0
+        radius_meters = 0
         error = False
         error_msg = "No errors."
         coords_first = 0
@@ -649,27 +805,13 @@ class MainWindow(QMainWindow, FORM_CLASS):
 
             # Continue validating coordinates only if error free so far.
             if not error:
-                # Ensure that one coord is positive and the other is negative.
-                if coords_first < 0:
-                    if coords_second <= 0:
-                        error_msg = "Latitude is invalid. Only North America is supported. " \
-                                    "Expecting coordinates in the northern hemisphere (i.e. positive latitude) " \
-                                    "and west of the Prime Meridian, which is degrees West " \
-                                    "(typically indicated as negative longitude)."
-                        error = True
-                    else:
-                        latitude = coords_second
-                        longitude = coords_first
-                else:
-                    if coords_second >= 0:
-                        error_msg = "Longitude is invalid. Only North America is supported. " \
-                                    "Expecting coordinates in the northern hemisphere (i.e. positive latitude) " \
-                                    "and west of the Prime Meridian, which is degrees West " \
-                                    "(typically indicated as negative longitude)."
-                        error = True
-                    else:
-                        latitude = coords_first
-                        longitude = coords_second
+                latitude = coords_first
+                longitude = coords_second
+                # Coordinates may be given longitude first. Tell by the range of latitude,
+                # or else by which order falls in a region of the datalake.
+                if abs(latitude) > 90 or (regions.region_of_point(latitude, longitude) is None
+                                          and regions.region_of_point(longitude, latitude) is not None):
+                    latitude, longitude = longitude, latitude
         else:
             latitude = self.line_edit_latitude.text()
             longitude = self.line_edit_longitude.text()
@@ -680,37 +822,27 @@ class MainWindow(QMainWindow, FORM_CLASS):
                 error_msg = "Invalid coordinates. Must be numeric."
                 error = True
 
-            # Continue validating coordinates only if error free so far.
-            if not error:
-                if latitude <= 0:
-                    error_msg = "Latitude is invalid. Only North America is supported. " \
-                                    "Expecting coordinates in the northern hemisphere (i.e. positive latitude) " \
-                                    "and west of the Prime Meridian, which is degrees West " \
-                                    "(typically indicated as negative longitude)."
-                    error = True
-
-            # Continue validating coordinates only if error free so far.
-            if not error:
-                if longitude >= 0:
-                    error_msg = "Longitude is invalid. Only North America is supported. " \
-                                    "Expecting coordinates in the northern hemisphere (i.e. positive latitude) " \
-                                    "and west of the Prime Meridian, which is degrees West " \
-                                    "(typically indicated as negative longitude)."
-                    error = True
+        # Continue validating coordinates only if error free so far.
+        if not error:
+            if not -90 <= latitude <= 90:
+                error_msg = "Latitude is invalid. Expecting degrees North between -90 and 90."
+                error = True
+            elif not -180 <= longitude <= 180:
+                error_msg = "Longitude is invalid. Expecting degrees East between -180 and 180 " \
+                            "(i.e. negative longitude West of the Prime Meridian)."
+                error = True
 
         # Continue validating coordinates only if error free so far.
         if not error:
             try:
                 radius = self.line_edit_radius.text()
-                radius = float(radius)
-                radius_degrees = float(radius / METERS_PER_DEGREE)
-                radius_degrees = round(float(radius_degrees), 4)
+                radius_meters = float(radius)
 
             except Exception as ex:
                 error_msg = "Invalid search radius. Must be numeric."
                 error = True
 
-        return latitude, longitude, radius_degrees, error, error_msg
+        return latitude, longitude, radius_meters, error, error_msg
 
     @pyqtSlot()
     def on_button_search_datalake_clicked(self):
@@ -730,10 +862,17 @@ class MainWindow(QMainWindow, FORM_CLASS):
         self.disable_image_buttons()
         self.disable_interface_buttons()
 
+        # Forget the filter columns of the previous results until the new ones arrive.
+        self.result_columns = None
+        self.visible_results = []
+        self.grid_results = []
+        self.grid_duplicates = []
+        self.grid_failures = {}
+
         # log.warning(f'in search_datalake function')
 
         # Validate user inputs including coordinates and search radius.
-        latitude, longitude, radius_degrees, error, error_msg = self.validate_coords()
+        latitude, longitude, radius_meters, error, error_msg = self.validate_coords()
         if error:
             self.update_message_log(error_msg)
             self.enable_interface_buttons()
@@ -741,6 +880,19 @@ class MainWindow(QMainWindow, FORM_CLASS):
 
         self.update_message_log(f"Searching Datalake ...")
 
+        # Record the extent of this query, so the filter knows what is already fetched.
+        # The datalake query returns every heading and capture time within the radius.
+        self.fetched_extent = {'latitude': latitude, 'longitude': longitude,
+                               'radius_meters': radius_meters,
+                               'directions': None, 'start_time': None, 'end_time': None, 'min_quality': None}
+
+        # Show the results cached locally at once; the query only fetches the rows not among them.
+        self.local_rows = self.search_local_index(local_index.DATALAKE, latitude, longitude, radius_meters)
+        if self.local_rows:
+            self.datalake_rows = self.local_rows
+            self.result_columns = result_filter.datalake_rows_columns(self.local_rows)
+            self.apply_result_filter()
+
         # Create and start a new thread to contain execution of the Datalake search.
         self.thread_search_datalake = thread_search_datalake()
         # Connect event handlers before starting the thread.
@@ -750,18 +902,24 @@ class MainWindow(QMainWindow, FORM_CLASS):
         # Assign properties of the new thread instance.
         self.thread_search_datalake.latitude = latitude
         self.thread_search_datalake.longitude = longitude
-        self.thread_search_datalake.radius_degrees = radius_degrees
-        self.thread_search_datalake.image_buttons = self.image_buttons
-        self.thread_search_datalake.image_labels = self.image_labels
+        self.thread_search_datalake.radius_meters = radius_meters
+        self.thread_search_datalake.exclude_locations = [row[1] for row in self.local_rows]
         self.thread_search_datalake.interface_buttons = self.interface_buttons
         self.thread_search_datalake.direction_buttons = self.direction_buttons
 
+        self.record_prefetch_search(local_index.DATALAKE, latitude, longitude, radius_meters, {})
+
         # Start the thread.
         self.thread_search_datalake.start()
 
     def evt_thread_search_datalake_rows(self, rows):
         # This event is used to pass the datalake query results to the main application.
+        # The query left out the rows already shown from the local index.
+        rows = self.local_rows + rows
         self.datalake_rows = rows
+        self.result_columns = result_filter.datalake_rows_columns(rows)
+        # Fill the thumbnail grid with the results passing the current filter.
+        self.apply_result_filter()
 
     def evt_thread_search_datalake_status(self, status):
         # This event is used to update the message log with datalake search progress.
@@ -795,8 +953,15 @@ class MainWindow(QMainWindow, FORM_CLASS):
         self.disable_image_buttons()
         self.disable_interface_buttons()
 
+        # Forget the filter columns of the previous results until the new ones arrive.
+        self.result_columns = None
+        self.visible_results = []
+        self.grid_results = []
+        self.grid_duplicates = []
+        self.grid_failures = {}
+
         # Validate user inputs including coordinates and search radius.
-        latitude, longitude, radius_degrees, error, error_msg = self.validate_coords()
+        latitude, longitude, radius_meters, error, error_msg = self.validate_coords()
         if error:
             self.update_message_log(error_msg)
             self.enable_interface_buttons()
@@ -804,6 +969,26 @@ class MainWindow(QMainWindow, FORM_CLASS):
 
         self.update_message_log(f"Searching Nexar ...")
 
+        # The capture time window and minimum quality of the query come from the filter panel,
+        # so the fetched results are always a superset of what the filter shows.
+        settings = self.filter_settings()
+
+        # Record the extent of this query, so the filter knows what is already fetched.
+        self.fetched_extent = {'latitude': latitude, 'longitude': longitude,
+                               'radius_meters': radius_meters,
+                               'directions': set(self.selected_directions()),
+                               'start_time': settings['start_time'], 'end_time': settings['end_time'],
+                               'min_quality': settings['min_quality']}
+
+        # Show the frames cached locally at once, while Nexar is searched.
+        self.local_frames = self.search_local_index(local_index.NEXAR, latitude, longitude, radius_meters,
+                                                    settings['start_time'], settings['end_time'],
+                                                    self.selected_directions())
+        if self.local_frames:
+            self.nexar_frames = {'frames': self.local_frames}
+            self.result_columns = result_filter.nexar_columns(self.local_frames)
+            self.apply_result_filter()
+
         # Create and start a new thread to contain execution of the Nexar search.
         self.thread_search_nexar = thread_search_nexar()
         # Connect event handlers before starting the thread.
@@ -811,29 +996,104 @@ class MainWindow(QMainWindow, FORM_CLASS):
         self.thread_search_nexar.thread_search_nexar_status.connect(self.evt_thread_search_nexar_status)
         self.thread_search_nexar.thread_search_nexar_frames.connect(self.evt_thread_search_nexar_frames)
         # Assign properties of the new thread instance.
-        self.thread_search_nexar.latitude = latitude
-        self.thread_search_nexar.longitude = longitude
-        self.thread_search_nexar.radius_degrees = radius_degrees
-        self.thread_search_nexar.image_buttons = self.image_buttons
-        self.thread_search_nexar.image_labels = self.image_labels
-        self.thread_search_nexar.direction_north = self.direction_north
-        self.thread_search_nexar.direction_south = self.direction_south
-        self.thread_search_nexar.direction_east = self.direction_east
-        self.thread_search_nexar.direction_west = self.direction_west
-        self.thread_search_nexar.direction_northwest = self.direction_northwest
-        self.thread_search_nexar.direction_northeast = self.direction_northeast
-        self.thread_search_nexar.direction_southwest = self.direction_southwest
-        self.thread_search_nexar.direction_southeast = self.direction_southeast
+        self.assign_thread_search_nexar(self.thread_search_nexar, latitude, longitude, radius_meters, settings)
         self.thread_search_nexar.interface_buttons = self.interface_buttons
-        self.thread_search_nexar.auth_token = self.auth_token
         self.thread_search_nexar.direction_buttons = self.direction_buttons
 
+        self.record_prefetch_search(local_index.NEXAR, latitude, longitude, radius_meters,
+                                    {name: getattr(self.thread_search_nexar, name) for name in PREFETCH_NEXAR_SETTINGS})
+
         # Start the thread.
         self.thread_search_nexar.start()
 
+    def assign_thread_search_nexar(self, thread, latitude, longitude, radius_meters, settings):
+        # Assign the search area, and the filter settings and directions of the interface, to a Nexar search thread.
+        thread.latitude = latitude
+        thread.longitude = longitude
+        thread.radius_meters = radius_meters
+        # Nexar expects epoch ms.
+        thread.start_time = int(settings['start_time'] * 1000)
+        thread.end_time = int(settings['end_time'] * 1000)
+        thread.min_frame_quality = settings['min_quality']
+        thread.incremental = self.check_box_incremental.isChecked()
+        thread.directions = self.selected_directions()
+        thread.auth_token = self.auth_token
+
+    def compare_sources(self):
+        # Search Datalake and Nexar at once, and show their results side by side in a comparison window.
+        # The two searches run concurrently, so the comparison waits for the slower one, not for both in a row.
+        # The thumbnail grid and its results are left as they are.
+        if any(thread is not None and thread.isRunning()
+               for thread in [self.thread_compare_datalake, self.thread_compare_nexar]):
+            self.update_message_log("A comparison is already running.")
+            return
+
+        latitude, longitude, radius_meters, error, error_msg = self.validate_coords()
+        if error:
+            self.update_message_log(error_msg)
+            return
+        settings = self.filter_settings()
+
+        if self.comparison_window is not None:
+            self.comparison_window.close()
+        self.comparison_window = comparison.ComparisonWindow(self.load_comparison_thumbnail)
+        self.comparison_window.showMaximized()
+        self.comparison_results = {'datalake': [], 'nexar': []}
+        self.update_message_log("Searching Datalake and Nexar to compare ...")
+
+        # Create and start a new thread to contain execution of the Datalake search.
+        self.thread_compare_datalake = thread_search_datalake()
+        # Connect event handlers before starting the thread.
+        self.thread_compare_datalake.finished.connect(self.evt_thread_compare_finished)
+        self.thread_compare_datalake.thread_search_datalake_status.connect(self.evt_thread_search_datalake_status)
+        self.thread_compare_datalake.thread_search_datalake_rows.connect(
+            lambda rows: self.comparison_results.update(datalake=rows))
+        # Assign properties of the new thread instance.
+        self.thread_compare_datalake.latitude = latitude
+        self.thread_compare_datalake.longitude = longitude
+        self.thread_compare_datalake.radius_meters = radius_meters
+
+        # Create and start a new thread to contain execution of the Nexar search.
+        self.thread_compare_nexar = thread_search_nexar()
+        # Connect event handlers before starting the thread.
+        self.thread_compare_nexar.finished.connect(self.evt_thread_compare_finished)
+        self.thread_compare_nexar.thread_search_nexar_status.connect(self.evt_thread_search_nexar_status)
+        self.thread_compare_nexar.thread_search_nexar_frames.connect(
+            lambda data: self.comparison_results.update(nexar=data.get('frames', [])))
+        # Assign properties of the new thread instance.
+        self.assign_thread_search_nexar(self.thread_compare_nexar, latitude, longitude, radius_meters, settings)
+        # The search of the thumbnail grid may be writing data.json.
+        self.thread_compare_nexar.dump_path = None
+
+        # Start the threads.
+        self.thread_compare_datalake.start()
+        self.thread_compare_nexar.start()
+
+    def evt_thread_compare_finished(self):
+        # This event is used to show the results of either comparison search as soon as it is done,
+        # and both once the other one is done too.
+        if self.comparison_window is None:
+            return
+        self.comparison_window.show_results(self.comparison_results['datalake'], self.comparison_results['nexar'])
+        if not (self.thread_compare_datalake.isFinished() and self.thread_compare_nexar.isFinished()):
+            self.comparison_window.show_status(self.comparison_window.label_status.text() + ' Still searching ...')
+
+    def load_comparison_thumbnail(self, display_mode, result):
+        # Runs in the comparison window's executor. Load a thumbnail the way the grid does, from its caches first.
+        source = local_index.DATALAKE if display_mode == 1 else local_index.NEXAR
+        path, data = thumbnails.load(source, result, self.auth_token, log.debug)
+        return image_cache.cache.decode(path, data)
+
     def evt_thread_search_nexar_frames(self, data):
         # This event is used to pass the nexar results to the main application.
+        # Keep the cached frames Nexar no longer returned, so nothing shown from the local index disappears.
+        returned = {str(frame['frame_id']) for frame in data.get('frames', [])}
+        data['frames'] = data.get('frames', []) + [frame for frame in self.local_frames
+                                                   if str(frame['frame_id']) not in returned]
         self.nexar_frames = data
+        self.result_columns = result_filter.nexar_columns(data.get('frames', []))
+        # Fill the thumbnail grid with the results passing the current filter.
+        self.apply_result_filter()
 
     def evt_thread_search_nexar_status(self, status):
         # This event is used to update the message log with nexar search progress.
@@ -844,10 +1104,471 @@ class MainWindow(QMainWindow, FORM_CLASS):
         self.update_message_log("Closed thread searching Nexar.")
         self.update_message_log("---------------------------------------------------------")
 
+    def record_prefetch_search(self, source, latitude, longitude, radius_meters, settings):
+        # Let the prefetcher count this search as a hit or miss, and warm the areas it predicts next.
+        if not self.check_box_prefetch.isChecked():
+            return
+        if self.prefetcher is None:
+            self.prefetcher = prefetch.Prefetcher(self.prefetch_area)
+        if self.prefetcher.record_search(source, latitude, longitude, radius_meters, settings):
+            self.update_message_log("This area was prefetched.")
+        self.update_message_log(self.prefetcher.report())
+
+    def prefetch_area(self, source, latitude, longitude, radius_meters, settings, stale):
+        # Runs on the prefetch thread. Search an area the way the analyst's search would, recording
+        # the results in the local index, and cache the thumbnails of the first results.
+        # Return the (Nexar requests, bytes) spent.
+        requests = 0
+        if source == local_index.NEXAR:
+            if not settings['directions']:
+                # The analyst's search requested no direction either.
+                return 0, 0
+            # Only the frames captured since the area was last searched are requested.
+            data = search.search_nexar(latitude, longitude, radius_meters, incremental=True, status=log.debug,
+                                       **settings)
+            results = data.get('frames', [])
+            requests += 1
+        else:
+            results = search.search_datalake(latitude, longitude, radius_meters, status=log.debug)
+
+        size = 0
+        for result in results[:prefetch.THUMBNAILS_PER_AREA]:
+            if stale():
+                break
+            try:
+                path, data = thumbnails.load(source, result, settings.get('auth_token'), log.debug)
+                image_cache.cache.decode(path, data)
+            except Exception:
+                continue
+            # Thumbnails already on disk are counted too, so the budget is an upper bound.
+            size += len(data)
+            if source == local_index.NEXAR and not result.get('datalake_s3_location'):
+                requests += 1
+        return requests, size
+
+    def search_local_index(self, source, latitude, longitude, radius_meters, start_time=None, end_time=None,
+                           directions=None):
+        # Return the results of source cached locally, logging how many were found.
+        try:
+            results = local_index.search(source, latitude, longitude, radius_meters, start_time, end_time, directions)
+        except Exception as e:
+            self.update_message_log(f"Local index search failed; {e}")
+            return []
+        if results:
+            self.update_message_log(f"{len(results)} cached results found in the local index.")
+        return results
+
+    def build_filter_panel(self):
+        # The filter panel works on the results already held in memory,
+        # so the thumbnail grid updates without another Nexar or Datalake query.
+        self.dock_filter = QtWidgets.QDockWidget("Filter / Sort Results", self)
+        self.dock_filter.setObjectName('dock_filter')
+        panel = QtWidgets.QWidget()
+        layout = QtWidgets.QFormLayout(panel)
+
+        self.date_edit_filter_start = QtWidgets.QDateEdit(QtCore.QDateTime.fromMSecsSinceEpoch(NEXAR_START_TIME).date())
+        self.date_edit_filter_start.setCalendarPopup(True)
+        self.date_edit_filter_start.setDisplayFormat('yyyy-MM-dd')
+        self.date_edit_filter_end = QtWidgets.QDateEdit(QDate.currentDate())
+        self.date_edit_filter_end.setCalendarPopup(True)
+        self.date_edit_filter_end.setDisplayFormat('yyyy-MM-dd')
+
+        # A max distance of zero means the search radius.
+        self.spin_box_filter_distance = QtWidgets.QSpinBox()
+        self.spin_box_filter_distance.setRange(0, 100000)
+        self.spin_box_filter_distance.setSingleStep(10)
+        self.spin_box_filter_distance.setSuffix(' m')
+        self.spin_box_filter_distance.setSpecialValueText('Search radius')
+
+        self.double_spin_box_filter_quality = QtWidgets.QDoubleSpinBox()
+        self.double_spin_box_filter_quality.setRange(0.0, 1.0)
+        self.double_spin_box_filter_quality.setSingleStep(0.05)
+        self.double_spin_box_filter_quality.setValue(NEXAR_MIN_FRAME_QUALITY)
+
+        self.combo_filter_sort = QtWidgets.QComboBox()
+        self.combo_filter_sort.addItems(result_filter.SORT_OPTIONS)
+
+        # Nexar frames whose thumbnails are within this many bits of perceptual hash are near-duplicates.
+        self.check_box_filter_duplicates = QtWidgets.QCheckBox('Collapse near-duplicate frames')
+        self.check_box_filter_duplicates.setChecked(True)
+        self.spin_box_filter_duplicate_distance = QtWidgets.QSpinBox()
+        self.spin_box_filter_duplicate_distance.setRange(0, 32)
+        self.spin_box_filter_duplicate_distance.setSuffix(' bits')
+        self.spin_box_filter_duplicate_distance.setValue(phash.DUPLICATE_DISTANCE)
+
+        # Nexar is only asked for the frames captured since the last search of the same area;
+        # the earlier frames come from the local index.
+        self.check_box_incremental = QtWidgets.QCheckBox('Only fetch Nexar frames new since the last search')
+        self.check_box_incremental.setChecked(True)
+        # Searches along a road warm the next areas in the background; off by default, as it spends Nexar quota.
+        self.check_box_prefetch = QtWidgets.QCheckBox('Prefetch the next areas along the direction of travel')
+        self.check_box_prefetch.setChecked(False)
+
+        self.label_filter_count = QtWidgets.QLabel('No results.')
+
+        # Export the selected result, with the near-duplicates collapsed behind it, or every matching result.
+        self.button_export_selected = QtWidgets.QPushButton('Export selected ...')
+        self.button_export_all = QtWidgets.QPushButton('Export all matching ...')
+        # Searches both sources at once, and shows their captures side by side.
+        self.button_compare = QtWidgets.QPushButton('Compare Datalake and Nexar ...')
+        # Plays every capture of the searched location, Nexar and Datalake, in capture time order.
+        self.button_timeline = QtWidgets.QPushButton('Play timeline ...')
+        self.button_export_cancel = QtWidgets.QPushButton('Cancel export')
+        self.button_export_cancel.setEnabled(False)
+        self.label_export_status = QtWidgets.QLabel('')
+
+        layout.addRow('Captured from:', self.date_edit_filter_start)
+        layout.addRow('Captured to:', self.date_edit_filter_end)
+        layout.addRow('Max distance:', self.spin_box_filter_distance)
+        layout.addRow('Min frame quality:', self.double_spin_box_filter_quality)
+        layout.addRow('Sort by:', self.combo_filter_sort)
+        layout.addRow(self.check_box_filter_duplicates)
+        layout.addRow('Duplicate distance:', self.spin_box_filter_duplicate_distance)
+        layout.addRow(self.check_box_incremental)
+        layout.addRow(self.check_box_prefetch)
+        layout.addRow(self.label_filter_count)
+        layout.addRow(self.button_export_selected, self.button_export_all)
+        layout.addRow(self.button_compare, self.button_timeline)
+        layout.addRow(self.button_export_cancel, self.label_export_status)
+
+        self.dock_filter.setWidget(panel)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.dock_filter)
+
+        # Update the grid instantly whenever a filter setting changes.
+        self.date_edit_filter_start.dateChanged.connect(self.evt_filter_changed)
+        self.date_edit_filter_end.dateChanged.connect(self.evt_filter_changed)
+        self.spin_box_filter_distance.valueChanged.connect(self.evt_filter_changed)
+        self.double_spin_box_filter_quality.valueChanged.connect(self.evt_filter_changed)
+        self.combo_filter_sort.currentIndexChanged.connect(self.evt_filter_changed)
+        self.check_box_filter_duplicates.stateChanged.connect(self.evt_filter_changed)
+        self.spin_box_filter_duplicate_distance.valueChanged.connect(self.evt_filter_changed)
+
+        self.button_export_selected.clicked.connect(lambda: self.export_results(selected_only=True))
+        self.button_export_all.clicked.connect(lambda: self.export_results(selected_only=False))
+        self.button_export_cancel.clicked.connect(self.cancel_export)
+        self.button_timeline.clicked.connect(self.open_timeline)
+        self.button_compare.clicked.connect(self.compare_sources)
+
+    def evt_filter_changed(self, *args):
+        # This event is used to re-apply the filter when a filter panel setting changes.
+        self.apply_result_filter()
+
+    def open_timeline(self):
+        # Open a player of every capture within the last search area, from the Nexar and Datalake results in memory.
+        if not self.fetched_extent:
+            self.update_message_log("Search a location to play its timeline.")
+            return
+        entries = timeline.timeline_entries(self.datalake_rows, self.nexar_frames.get('frames', []),
+                                            self.fetched_extent['latitude'], self.fetched_extent['longitude'],
+                                            self.fetched_extent['radius_meters'])
+        if not entries:
+            self.update_message_log("No captures with a capture time to play.")
+            return
+
+        if self.timeline_window is not None:
+            self.timeline_window.close()
+        self.timeline_window = timeline.TimelineWindow(entries, self.auth_token)
+        self.timeline_window.showMaximized()
+        self.update_message_log(f"Playing the timeline of {len(entries)} captures.")
+
+    def export_results(self, selected_only):
+        # Export results to an archive with a manifest, in a separate thread.
+        if self.thread_export is not None and self.thread_export.isRunning():
+            self.update_message_log("An export is already running.")
+            return
+
+        if selected_only:
+            if not self.currently_selected_image:
+                self.update_message_log("Select an image to export.")
+                return
+            slot = self.currently_selected_image
+            indices = [self.result_index(slot)] + self.grid_duplicates[slot - 1]
+        else:
+            indices = list(self.visible_results)
+        if not indices:
+            self.update_message_log("No results to export.")
+            return
+
+        filters = ['Tar archive, CSV manifest (*.tar)', 'Zip archive, CSV manifest (*.zip)']
+        if export.pyarrow is not None:
+            filters += ['Tar archive, Parquet manifest (*.tar)', 'Zip archive, Parquet manifest (*.zip)']
+        archive_path, selected_filter = QtWidgets.QFileDialog.getSaveFileName(
+            self, 'Export results', 'export.tar', ';;'.join(filters))
+        if not archive_path:
+            return
+
+        # The results are copied, so a new search while exporting doesn't change what is exported.
+        if self.display_mode == 1:
+            rows = [self.datalake_rows[index] for index in indices]
+            items = [(export.datalake_row_sources(row), export.datalake_row_record(row)) for row in rows]
+            columns = export.DATALAKE_COLUMNS
+        else:
+            frames = [self.nexar_frames['frames'][index] for index in indices]
+            items = [(export.nexar_frame_sources(frame), export.nexar_frame_record(frame)) for frame in frames]
+            columns = export.NEXAR_COLUMNS
+
+        self.update_message_log(f"Exporting {len(items)} results to {archive_path} ...")
+
+        # Create and start a new thread to contain execution of the export.
+        self.thread_export = thread_export()
+        # Connect event handlers before starting the thread.
+        self.thread_export.finished.connect(self.evt_thread_export_finished)
+        self.thread_export.thread_export_status.connect(self.evt_thread_export_status)
+        self.thread_export.thread_export_progress.connect(self.evt_thread_export_progress)
+        # Assign properties of the new thread instance.
+        self.thread_export.archive_path = archive_path
+        self.thread_export.items = items
+        self.thread_export.columns = columns
+        self.thread_export.manifest_format = 'parquet' if 'Parquet' in selected_filter else 'csv'
+        self.thread_export.auth_token = self.auth_token
+        # Start the thread.
+        self.thread_export.start()
+        self.button_export_cancel.setEnabled(True)
+
+    def evt_thread_export_status(self, status):
+        # This event is used to update the message log with export progress.
+        self.update_message_log(status)
+
+    def evt_thread_export_progress(self, exported, failed, total):
+        # This event is used to show how far the export got.
+        text = f"Exported {exported} of {total}."
+        if failed:
+            text += f" {failed} failed."
+        self.label_export_status.setText(text)
+
+    def evt_thread_export_finished(self):
+        # This event is used to update the message log when the export exits.
+        self.button_export_cancel.setEnabled(False)
+        self.update_message_log("Closed thread exporting results.")
+        self.update_message_log("---------------------------------------------------------")
+
+    def cancel_export(self):
+        # Ask a running export to stop after the result it is writing. The archive keeps what was written.
+        if self.thread_export is not None and self.thread_export.isRunning():
+            self.thread_export.requestInterruption()
+            self.button_export_cancel.setEnabled(False)
+            self.update_message_log("Cancelling the export ...")
+
+    def closeEvent(self, event):
+        # Stop an export still running, and wait for it to close its archive.
+        self.cancel_export()
+        if self.thread_export is not None:
+            self.thread_export.wait()
+        super().closeEvent(event)
+
+    def selected_directions(self):
+        # Return the Nexar direction names of the directional buttons turned on.
+        selected = [(self.direction_north, "NORTH"), (self.direction_south, "SOUTH"),
+                    (self.direction_east, "EAST"), (self.direction_west, "WEST"),
+                    (self.direction_northwest, "NORTH_WEST"), (self.direction_northeast, "NORTH_EAST"),
+                    (self.direction_southwest, "SOUTH_WEST"), (self.direction_southeast, "SOUTH_EAST")]
+        return [name for on, name in selected if on]
+
+    def filter_settings(self):
+        # Return the filter panel settings. Times are epoch seconds, and the end date is inclusive.
+        start = QtCore.QDateTime(self.date_edit_filter_start.date(), QTime(0, 0))
+        end = QtCore.QDateTime(self.date_edit_filter_end.date().addDays(1), QTime(0, 0))
+        return {
+            'directions': self.selected_directions(),
+            'start_time': start.toMSecsSinceEpoch() / 1000,
+            'end_time': end.toMSecsSinceEpoch() / 1000,
+            'max_distance': self.spin_box_filter_distance.value(),
+            'min_quality': self.double_spin_box_filter_quality.value(),
+            'sort_by': self.combo_filter_sort.currentIndex(),
+        }
+
+    def filter_beyond_fetched(self, settings):
+        # Return a reason if the filter asks for results the last query could not have returned.
+        extent = self.fetched_extent
+        if settings['max_distance'] > extent['radius_meters'] + 0.5:
+            return "a larger distance"
+        if extent['directions'] is not None and settings['directions'] \
+                and not set(settings['directions']) <= extent['directions']:
+            return "other directions"
+        if extent['start_time'] is not None and settings['start_time'] < extent['start_time']:
+            return "an earlier capture date"
+        if extent['end_time'] is not None and settings['end_time'] > extent['end_time']:
+            return "a later capture date"
+        if extent['min_quality'] is not None and settings['min_quality'] < extent['min_quality'] - 1e-9:
+            return "a lower frame quality"
+        return None
+
+    def apply_result_filter(self):
+        # Filter and sort the results held in memory, and refill the thumbnail grid.
+        # The server is only queried again when the filter goes beyond what was already fetched.
+        if self.display_mode == 0 or self.result_columns is None:
+            return
+
+        settings = self.filter_settings()
+
+        reason = self.filter_beyond_fetched(settings)
+        if reason:
+            self.update_message_log(f"Filter asks for {reason} than was fetched; searching again.")
+            if settings['max_distance'] > self.fetched_extent['radius_meters']:
+                self.line_edit_radius.setText(str(settings['max_distance']))
+            if self.display_mode == 1:
+                self.search_datalake()
+            else:
+                self.search_nexar()
+            return
+
+        order = result_filter.filter_and_sort(self.result_columns,
+                                              self.fetched_extent['latitude'], self.fetched_extent['longitude'],
+                                              directions=settings['directions'],
+                                              start_time=settings['start_time'], end_time=settings['end_time'],
+                                              max_distance=settings['max_distance'],
+                                              min_quality=settings['min_quality'],
+                                              sort_by=settings['sort_by'])
+        self.visible_results = [int(index) for index in order]
+
+        self.update_filter_count()
+
+        fetched = len(self.result_columns['latitude'])
+        if fetched and not self.visible_results:
+            self.update_message_log("No fetched images match the filter.")
+
+        self.populate_thumbnail_grid()
+
+    def update_filter_count(self):
+        # Show how many results are in the grid, match the filter, and were fetched.
+        fetched = len(self.result_columns['latitude']) if self.result_columns is not None else 0
+        collapsed = sum(len(duplicates) for duplicates in self.grid_duplicates)
+        text = f"Showing {len(self.grid_results)} of {len(self.visible_results)} matching, {fetched} fetched."
+        if collapsed:
+            text += f"\n{collapsed} near-duplicates collapsed."
+        if self.grid_failures:
+            text += f"\n{len(self.grid_failures)} thumbnails failed to load."
+        self.label_filter_count.setText(text)
+
+    def predecode_neighbours(self, image_number):
+        # Decode the full images of the selected result and its neighbours in the grid ahead of time,
+        # those already on disk, so opening them in the viewer is instant.
+        paths = []
+        for number in (image_number, image_number + 1, image_number - 1):
+            if not 1 <= number <= len(self.grid_results):
+                continue
+            if self.display_mode == 1:
+                sources = export.datalake_row_sources(self.datalake_rows[self.result_index(number)])
+            else:
+                sources = export.nexar_frame_sources(self.nexar_frames['frames'][self.result_index(number)])
+            paths += [source[1] for source in sources if source[0] == 'local']
+        image_cache.predecode(paths)
+
+    def result_index(self, image_number):
+        # Return the index into the current results of the image shown in thumbnail slot image_number.
+        return self.grid_results[image_number - 1]
+
+    def populate_thumbnail_grid(self):
+        # Load the thumbnails of the visible results into the grid, in a separate thread.
+        self.clear_thumbnail_images()
+        self.deselect_image_buttons()
+        self.disable_image_buttons()
+        self.plain_text_edit_details.clear()
+        self.currently_selected_image = 0
+
+        if self.display_mode == 1:
+            results = self.datalake_rows
+        else:
+            results = self.nexar_frames.get('frames', [])
+
+        # The thread assigns grid slots as thumbnails load, skipping near-duplicates of those already shown.
+        self.grid_results = []
+        self.grid_duplicates = []
+        self.grid_failures = {}
+        items = [(index, results[index]) for index in self.visible_results]
+
+        # Stop loading thumbnails for the previous filter; its results no longer belong in the grid.
+        self.retire_thread_load_thumbnails()
+
+        # Create and start a new thread to contain execution of thumbnail loading.
+        self.thread_load_thumbnails = thread_load_thumbnails()
+        # Connect event handlers before starting the thread.
+        self.thread_load_thumbnails.thread_load_thumbnails_status.connect(self.evt_thread_load_thumbnails_status)
+        self.thread_load_thumbnails.thread_load_thumbnails_image.connect(self.evt_thread_load_thumbnails_image)
+        self.thread_load_thumbnails.thread_load_thumbnails_duplicate.connect(self.evt_thread_load_thumbnails_duplicate)
+        self.thread_load_thumbnails.thread_load_thumbnails_failed.connect(self.evt_thread_load_thumbnails_failed)
+        # Assign properties of the new thread instance.
+        self.thread_load_thumbnails.display_mode = self.display_mode
+        self.thread_load_thumbnails.items = items
+        self.thread_load_thumbnails.slots = len(self.image_labels)
+        # Duplicate suppression needs the thumbnail to hash it. Datalake images not backfilled yet
+        # are loaded from their originals, so hashing them would cost more downloads than it saves.
+        self.thread_load_thumbnails.suppress_duplicates = \
+            self.display_mode == 2 and self.check_box_filter_duplicates.isChecked()
+        self.thread_load_thumbnails.duplicate_distance = self.spin_box_filter_duplicate_distance.value()
+        self.thread_load_thumbnails.auth_token = self.auth_token
+        # Start the thread.
+        self.thread_load_thumbnails.start()
+
+    def retire_thread_load_thumbnails(self):
+        # Ask a running thumbnail thread to stop, and keep a reference until it finishes.
+        thread = self.thread_load_thumbnails
+        if thread is None or thread.isFinished():
+            return
+        thread.requestInterruption()
+        thread.thread_load_thumbnails_image.disconnect()
+        thread.thread_load_thumbnails_duplicate.disconnect()
+        thread.thread_load_thumbnails_failed.disconnect()
+        self.retired_threads.append(thread)
+        thread.finished.connect(lambda: self.retired_threads.remove(thread))
+
+    def evt_thread_load_thumbnails_status(self, status):
+        # This event is used to update the message log with thumbnail loading progress.
+        self.update_message_log(status)
+
+    def evt_thread_load_thumbnails_image(self, slot, index, image):
+        # This event is used to show a loaded thumbnail in its slot of the grid.
+        self.grid_results.append(index)
+        self.grid_duplicates.append([])
+        self.update_filter_count()
+
+        label = self.image_labels[slot - 1]
+        # Convert the image decoded by the thread; no file is read on the GUI thread.
+        pixmap = QtGui.QPixmap.fromImage(image)
+        # Set the pixmap to the label
+        label.setPixmap(pixmap)
+        # Set the alignment to center (if the label is larger than the pixmap)
+        label.setAlignment(Qt.AlignCenter)
+        # Adjust the size policy to allow shrinking smaller than the pixmap
+        label.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
+        # Set the label to scale the pixmap accordingly
+        label.setScaledContents(True)
+
+        # Flag Nexar frames that are served from our own datalake.
+        if self.display_mode == 2 and self.nexar_frames['frames'][index].get('datalake_s3_location'):
+            label.setStyleSheet('border: 4px solid blue')
+            label.setToolTip('Already in Datalake; served from s3 instead of Nexar.')
+
+        self.image_buttons[slot - 1].setEnabled(True)
+
+    def evt_thread_load_thumbnails_duplicate(self, slot, index):
+        # This event is used to collapse a near-duplicate result behind the thumbnail in its slot.
+        self.grid_duplicates[slot - 1].append(index)
+        self.update_filter_count()
+
+        label = self.image_labels[slot - 1]
+        tooltip = f"{len(self.grid_duplicates[slot - 1])} near-duplicate frames collapsed behind this one."
+        if self.nexar_frames['frames'][self.grid_results[slot - 1]].get('datalake_s3_location'):
+            tooltip = 'Already in Datalake; served from s3 instead of Nexar.\n' + tooltip
+        label.setToolTip(tooltip)
+
+        # Keep the details of the selected image current.
+        if self.currently_selected_image == slot:
+            self.plain_text_edit_details.clear()
+            self.display_image_info(slot)
+
+    def evt_thread_load_thumbnails_failed(self, index, error):
+        # This event is used to record a result whose thumbnail could not be loaded. Its slot goes to the next result.
+        self.grid_failures[index] = error
+        self.update_filter_count()
+        self.update_message_log(f"Thumbnail of result {index + 1} could not be loaded; {error}")
+
     def clear_thumbnail_images(self):
 
         for label in self.image_labels:
             label.setPixmap(QtGui.QPixmap('blank.png'))
+            label.setStyleSheet('')
+            label.setToolTip('')
 
     def update_message_log(self, msg):
         date_now = QDate.currentDate().toString(Qt.ISODate)
@@ -860,6 +1581,29 @@ class MainWindow(QMainWindow, FORM_CLASS):
         horizontal_scroll_bar = self.plain_text_edit_log.horizontalScrollBar()
         horizontal_scroll_bar.setValue(horizontal_scroll_bar.minimum())
 
+    def memory_accounts(self):
+        """
+        Return the estimated bytes and number of the results, windows and threads held by the main window,
+        as {name: (bytes, count)}, for memory_profile. Results held by several sets are counted in each.
+        """
+        frames = self.nexar_frames.get('frames', [])
+        accounts = {
+            'results.nexar_frames': (memory_profile.estimate_size(self.nexar_frames), len(frames)),
+            'results.datalake_rows': (memory_profile.estimate_size(self.datalake_rows), len(self.datalake_rows)),
+            'results.local_index': (memory_profile.estimate_size([self.local_rows, self.local_frames]),
+                                    len(self.local_rows) + len(self.local_frames)),
+            'results.columns': (memory_profile.estimate_size(self.result_columns), len(self.visible_results)),
+            'results.comparison': (memory_profile.estimate_size(self.comparison_results),
+                                   sum(len(results) for results in self.comparison_results.values())),
+            # Characters are kept as UTF-16.
+            'log.messages': (self.plain_text_edit_log.document().characterCount() * 2,
+                             self.plain_text_edit_log.document().blockCount()),
+            'threads.retired': (0, len(self.retired_threads)),
+        }
+        if self.timeline_window is not None:
+            accounts['caches.timeline_frames'] = self.timeline_window.frames.decoded()
+        return accounts
+
     def enable_interface_buttons(self):
 
         for button in self.interface_buttons:
@@ -884,30 +1628,13 @@ class MainWindow(QMainWindow, FORM_CLASS):
         for button in self.image_buttons:
             button.setEnabled(False)
 
-    def download_full_image(self, url):
-
-        # Ensure the image directory exists
-        os.makedirs("full_images", exist_ok=True)
-
-        headers = {
-            'Authorization': 'Bearer ' + self.auth_token,
-        }
-
-        response = requests.get(url, headers=headers,)
-        file = url.split('/')[-1]
-
-        with open('full_images/' + file, 'wb') as f:
-            f.write(response.content)
-
-        self.update_message_log(f'Image downloaded: /full_images/{file}')
-
     def refresh_token(self):
 
         refresh_token = creds.refresh_token
-        response = requests.post('https://external.getnexar.com/dev-portal/refresh-token',
-                                 headers={'content-type': 'application/x-www-form-urlencoded'},
-                                 data={'refresh_token': refresh_token}
-                                 )
+        response = services.nexar_request('POST', services.NEXAR_REFRESH_TOKEN_URL,
+                                          headers={'content-type': 'application/x-www-form-urlencoded'},
+                                          data={'refresh_token': refresh_token}
+                                          )
 
         # close the connection
         response.close()
@@ -936,9 +1663,14 @@ class MainWindow(QMainWindow, FORM_CLASS):
 class thread_updateDB(QThread):
     """
     This is a thread to update the database with nexar image info.
+    The image, and the thumbnail derivative the datalake search shows, are uploaded to s3 first.
     """
 
     # Properties assigned by the calling process.
+    path = None
+    bucket = None
+    key = None
+    db_region = None
     s3_location = None
     geom = None
     version = None
@@ -954,15 +1686,32 @@ class thread_updateDB(QThread):
             msg = "Started thread to update database with Nexar image info."
             self.thread_updateDB_status.emit(msg)
 
-            db_region = 'north_america'
-            with ushr.acorn.datalake.utils.connect_to_db(db_region) as conn:
+            # Without the image in s3, the row would point at nothing.
+            try:
+                services.upload_file(self.path, self.bucket, self.key)
+            except Exception as e:
+                raise RuntimeError(f"Upload to s3 failed: {e}") from e
+            self.thread_updateDB_status.emit("Upload to s3 succeeded.")
+
+            # Store the thumbnail derivative the datalake search shows for this image.
+            try:
+                thumbnails.upload_thumbnail(self.path, self.bucket, self.key)
+            except Exception as e:
+                self.thread_updateDB_status.emit(f"Upload of thumbnail to s3 failed: {e}")
+
+            if self.db_region is None:
+                raise ValueError("No Datalake region covers the location of this image.")
+            with services.db_connection(self.db_region) as conn:
                 with conn.cursor() as cursor:
                     cursor.execute("""
                     INSERT INTO datalake.camera_image (s3_location, geom, version, datetime, vehicle_heading)
                     VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING""", (self.s3_location, self.geom, self.version, self.datetime, self.vehicle_heading,))
 
+            # Remember the frame is in the datalake, so later searches serve it from s3.
+            known_frames.update({self.version.split(':', 1)[1]: self.s3_location})
+
         except Exception as e:
-            msg = "Experienced an error updating the database with Nexar image info; ", str(e)
+            msg = f"Experienced an error updating the database with Nexar image info; {e}"
         else:
             msg = "Updated the database with Nexar image info, with no errors."
 
@@ -979,9 +1728,9 @@ class thread_search_datalake(QThread):
     # These properties are assigned the value of the MainWindow properties by the same name.
     longitude = None
     latitude = None
-    radius_degrees = None
-    image_buttons = []
-    image_labels = []
+    radius_meters = None
+    # s3 locations of the rows already found in the local index, left out of the query.
+    exclude_locations = []
     interface_buttons = []
     direction_buttons = []
 
@@ -996,59 +1745,14 @@ class thread_search_datalake(QThread):
             msg = "Started thread to search Datalake."
             self.thread_search_datalake_status.emit(msg)
 
-            db_region = 'north_america'
-            with ushr.acorn.datalake.utils.connect_to_db(db_region) as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute(""" SELECT id, s3_location, asset_id, processing_index, st_astext(geom), geom, version, datetime, vehicle_heading, image_heading, cam_id 
-                    FROM datalake.camera_image
-                    WHERE st_dwithin(ST_SetSRID(ST_Point(%s, %s),4326),geom,%s)""",
-                                   (self.longitude, self.latitude, self.radius_degrees,))
-                    rows = cursor.fetchall()
-                    if rows:
-                        self.thread_search_datalake_rows.emit(rows)
-
-                        # Ensure the image directory exists
-                        os.makedirs("datalake_images", exist_ok=True)
-
-                        for index, row in enumerate(rows, start=1):
-                            if index <= len(self.image_buttons):
-
-                                s3_location = row[1]
-                                file = s3_location.split('/')[-1]
-                                path = 'datalake_images/' + file
-                                if s3_location.split('/')[-2] == 'Nexar':
-                                    bucket = 'ushr-image/Nexar'
-                                else:
-                                    bucket = 'ushr-image'
-                                key = file
-
-                                # Download the file from s3 if not already downloaded.
-                                if os.path.exists(path):
-                                    msg = f'Image previously downloaded: /datalake_images/{file}'
-                                    self.thread_search_datalake_status.emit(msg)
-                                else:
-                                    self.download_from_s3(path, bucket, key)
-                                    msg = f'Image downloaded: /datalake_images/{file}'
-                                    self.thread_search_datalake_status.emit(msg)
-
-                                self.image_buttons[index - 1].setEnabled(True)
-
-                                # Load an image and scale it (keeping aspect ratio)
-                                # pixmap = QtGui.QPixmap(path).scaled(480, 270, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                                # No need to scale it. The QSizePolicy below allows us to work with full res image.
-                                pixmap = QtGui.QPixmap(path)
-                                # Set the scaled pixmap to the label
-                                self.image_labels[index - 1].setPixmap(pixmap)
-                                # Set the alignment to center (if the label is larger than the pixmap)
-                                self.image_labels[index - 1].setAlignment(Qt.AlignCenter)
-                                # Adjust the size policy to allow shrinking smaller than the pixmap
-                                self.image_labels[index - 1].setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
-                                # Set the label to scale the pixmap accordingly
-                                self.image_labels[index - 1].setScaledContents(True)
-
-                    else:
-                        msg = 'No matching images.'
-                        self.thread_search_datalake_status.emit(msg)
+            rows = search.search_datalake(self.latitude, self.longitude, self.radius_meters, self.exclude_locations,
+                                          self.thread_search_datalake_status.emit)
+            if rows:
+                # The main application filters the rows and loads thumbnails for the ones it shows.
+                self.thread_search_datalake_rows.emit(rows)
+            else:
+                msg = 'No matching images.'
+                self.thread_search_datalake_status.emit(msg)
 
         except Exception as e:
             msg = f"Experienced an error searching Datalake; {e}"
@@ -1059,17 +1763,6 @@ class thread_search_datalake(QThread):
         self.thread_search_datalake_status.emit(msg)
         self.enable_interface_buttons()
 
-    def download_from_s3(self, path, bucket, key):
-
-        try:
-            download_file(path, bucket, key)
-        except Exception as e:
-            msg = f"Download from s3 failed: {e}"
-            self.thread_search_datalake_status.emit(msg)
-        else:
-            msg = f"Download from s3 succeeded."
-            self.thread_search_datalake_status.emit(msg)
-
     def enable_interface_buttons(self):
 
         for button in self.interface_buttons:
@@ -1088,17 +1781,16 @@ class thread_search_nexar(QThread):
     # These properties are assigned the value of the MainWindow properties by the same name.
     longitude = None
     latitude = None
-    radius_degrees = None
-    image_buttons = []
-    image_labels = []
-    direction_north = None
-    direction_south = None
-    direction_east = None
-    direction_west = None
-    direction_northwest = None
-    direction_northeast = None
-    direction_southwest = None
-    direction_southeast = None
+    radius_meters = None
+    start_time = NEXAR_START_TIME
+    end_time = None
+    min_frame_quality = NEXAR_MIN_FRAME_QUALITY
+    # Only request the frames captured since the watermark of the area, merging the earlier ones from the local index.
+    incremental = False
+    # File the response is written to, or None.
+    dump_path = "data.json"
+    # Nexar names of the directions requested, NORTH, NORTH_EAST, ...
+    directions = []
     interface_buttons = []
     auth_token = None
     direction_buttons = []
@@ -1114,126 +1806,20 @@ class thread_search_nexar(QThread):
             msg = "Started thread to search Nexar."
             self.thread_search_nexar_status.emit(msg)
 
-            sw_latitude = self.latitude - self.radius_degrees
-            sw_longitude = self.longitude - self.radius_degrees
-
-            ne_latitude = self.latitude + self.radius_degrees
-            ne_longitude = self.longitude + self.radius_degrees
-
-            headers = {
-                'accept': 'application/json',
-                'Content-Type': 'application/json',
-                'Authorization': 'Bearer ' + self.auth_token,
-            }
-            # start and end time are epoch ms
-            # Using a start_time of 1/1/2014
-            start_time = 1388534400000
-            # Calculate end_time of current day in seconds
-            end_time = int(time.time())
-            # Convert to ms
-            end_time = end_time * 1000
-
-            json_data = {
-              "bounding_box": {
-                "south_west": {
-                  "longitude": -84.22322089000001,
-                  "latitude": 33.97443972
-                },
-                "north_east": {
-                  "longitude": -84.20522089,
-                  "latitude": 33.99243972
-                }
-              },
-              "filters": {
-                "min_frame_quality": 0.7,
-                "road_types": [
-                    "MOTORWAY",
-                    "TRUNK",
-                    "PRIMARY",
-                    "SECONDARY",
-                    "TERTIARY",
-                    "UNCLASSIFIED",
-                    "RESIDENTIAL",
-                    "SERVICE",
-                    "MOTORWAY_LINK",
-                    "TRUNK_LINK",
-                    "PRIMARY_LINK",
-                    "SECONDARY_LINK",
-                    "TERTIARY_LINK"
-                ],
-                "directions": [
-
-                ],
-                "frames_context": [
-                  "DAYLIGHT",
-                  "NIGHTTIME"
-                ],
-                "start_time": start_time,
-                "end_time": end_time
-              },
-              "sort_by": "TIMESTAMP"
-            }
-
-            # Add directions to the request.
-            if self.direction_north:
-                json_data['filters']['directions'].append("NORTH")
-            if self.direction_south:
-                json_data['filters']['directions'].append("SOUTH")
-            if self.direction_east:
-                json_data['filters']['directions'].append("EAST")
-            if self.direction_west:
-                json_data['filters']['directions'].append("WEST")
-            if self.direction_northwest:
-                json_data['filters']['directions'].append("NORTH_WEST")
-            if self.direction_northeast:
-                json_data['filters']['directions'].append("NORTH_EAST")
-            if self.direction_southwest:
-                json_data['filters']['directions'].append("SOUTH_WEST")
-            if self.direction_southeast:
-                json_data['filters']['directions'].append("SOUTH_EAST")
-
-            directions = json_data['filters']['directions']
-            if len(directions) == 0:
+            if not self.directions:
                 error_msg = 'No matching images. Please select one or more directions.'
                 print(error_msg)
                 self.thread_search_nexar_status.emit(error_msg)
                 self.enable_interface_buttons()
                 return
 
-            json_data['bounding_box']['south_west']['latitude'] = sw_latitude
-            json_data['bounding_box']['south_west']['longitude'] = sw_longitude
-            json_data['bounding_box']['north_east']['latitude'] = ne_latitude
-            json_data['bounding_box']['north_east']['longitude'] = ne_longitude
-
-            response = requests.post('https://external.getnexar.com/api/virtualcam/v4/frames', headers=headers, json=json_data)
-
-            # convert response to a python dictionary.
-            data = response.json()
-
-            # dump a python object into a json string
-            new_string = json.dumps(data, indent=2)
-
-            # write to json file
-            with open("data.json", "w") as f:
-                f.write(new_string)
-
-            f.close()
-
-            # read from json file
-            with open("data.json", "r") as f:
-                data = json.load(f)
+            data = search.search_nexar(self.latitude, self.longitude, self.radius_meters, self.auth_token,
+                                       self.start_time, self.end_time, self.min_frame_quality, self.directions,
+                                       self.incremental, self.dump_path, self.thread_search_nexar_status.emit)
 
             self.thread_search_nexar_frames.emit(data)
 
-            try:
-                for index, frame in enumerate(data['frames'], start=1):
-                    url = frame['thumbnail_url']
-
-                    if index <= len(self.image_buttons):
-                        self.image_buttons[index - 1].setEnabled(True)  # Enabled the button at the current index
-                        self.download_thumbnail(url, index)
-
-            except Exception as ex:
+            if not data.get('frames'):
                 error_msg = 'No matching images.'
                 self.thread_search_nexar_status.emit(error_msg)
 
@@ -1247,47 +1833,226 @@ class thread_search_nexar(QThread):
         # Send message to main thread.
         self.thread_search_nexar_status.emit(msg)
 
-    def download_thumbnail(self, url, index):
+    def enable_interface_buttons(self):
 
-        headers = {
-            'Authorization': 'Bearer ' + self.auth_token,
-        }
+        for button in self.interface_buttons:
+            button.setEnabled(True)
 
-        # Ensure the thumbnails directory exists
-        os.makedirs("thumbnails", exist_ok=True)
+        for button in self.direction_buttons:
+            button.setEnabled(True)
 
-        response = requests.get(url, headers=headers, )
-        file = url.split('/')[-1]
 
-        with open('thumbnails/' + file, 'wb') as f:
-            f.write(response.content)
+class thread_load_thumbnails(QThread):
+    """
+    This is a thread to download and load the thumbnails of the results shown in the grid.
+    """
 
-        # Load an image.
-        pixmap = QtGui.QPixmap('thumbnails/' + file)
-        # Set the pixmap to the label
-        self.image_labels[index - 1].setPixmap(pixmap)
-        # Set the alignment to center (if the label is larger than the pixmap)
-        self.image_labels[index - 1].setAlignment(Qt.AlignCenter)
-        # Adjust the size policy to allow shrinking smaller than the pixmap
-        self.image_labels[index - 1].setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)
-        # Set the label to scale the pixmap accordingly
-        self.image_labels[index - 1].setScaledContents(True)
+    # Properties assigned by the calling process.
+    # display_mode indicates whether items hold datalake rows (1) or nexar frames (2).
+    display_mode = 0
+    # List of (index, result) tuples in display order, index being the position in the search results.
+    items = []
+    # Number of slots in the thumbnail grid.
+    slots = 8
+    # Collapse results whose thumbnails are within duplicate_distance bits of perceptual hash
+    # of a thumbnail already shown.
+    suppress_duplicates = False
+    duplicate_distance = phash.DUPLICATE_DISTANCE
+    # Limit on the thumbnails examined while looking for distinct frames to fill the grid.
+    max_thumbnails = 80
+    # Thumbnails loaded at once. Loads run ahead of the one shown next by a page of the grid,
+    # and are still shown in result order.
+    load_workers = 8
+    auth_token = None
 
-        msg = f'Image downloaded: /thumbnails/{file}'
-        self.thread_search_nexar_status.emit(msg)
+    # Create a custom signal to notify main application of status.
+    thread_load_thumbnails_status = pyqtSignal(str)
+    # Create a custom signal to pass the slot, result index and decoded image of a loaded thumbnail to main application.
+    thread_load_thumbnails_image = pyqtSignal(int, int, QtGui.QImage)
+    # Create a custom signal to pass the slot and result index of a near-duplicate to main application.
+    thread_load_thumbnails_duplicate = pyqtSignal(int, int)
+    # Create a custom signal to pass the result index and error of a thumbnail that failed to load to main application.
+    thread_load_thumbnails_failed = pyqtSignal(int, str)
 
-    def enable_interface_buttons(self):
+    def run(self):
 
-        for button in self.interface_buttons:
-            button.setEnabled(True)
+        executor = ThreadPoolExecutor(self.load_workers, thread_name_prefix='load-thumbnails')
+        try:
+            # Perceptual hashes of the thumbnails shown, in slot order.
+            shown_hashes = []
+            # Loads submitted, in result order.
+            pending = deque()
+            items = iter(self.items[:self.max_thumbnails])
+
+            def submit_next():
+                for index, result in items:
+                    pending.append((index, executor.submit(self.load_thumbnail, result)))
+                    return
+
+            # Start loading the first page of the grid at once.
+            for _ in range(self.slots):
+                submit_next()
+
+            while pending:
+                # A newer filter replaced this one; its thumbnails are no longer wanted.
+                if self.isInterruptionRequested():
+                    return
+                # Stop when the grid is full.
+                if len(shown_hashes) >= self.slots:
+                    break
+
+                index, future = pending.popleft()
+                # Keep a page of loads running ahead.
+                submit_next()
 
-        for button in self.direction_buttons:
-            button.setEnabled(True)
+                try:
+                    path, data, image = future.result()
+                except Exception as e:
+                    # Only this result is left out of the grid; the next one takes its slot.
+                    self.thread_load_thumbnails_failed.emit(index, str(e))
+                    continue
+
+                value = phash.cached_hash(path, data) if self.suppress_duplicates else None
+                if value is not None and shown_hashes:
+                    # Compare against every thumbnail shown so far in one vectorized pass.
+                    hashed_slots = [slot for slot, shown in enumerate(shown_hashes, start=1) if shown is not None]
+                    if hashed_slots:
+                        distances = phash.hamming_distances(value, [shown_hashes[slot - 1] for slot in hashed_slots])
+                        nearest = int(distances.argmin())
+                        if distances[nearest] <= self.duplicate_distance:
+                            self.thread_load_thumbnails_duplicate.emit(hashed_slots[nearest], index)
+                            continue
+
+                shown_hashes.append(value)
+                self.thread_load_thumbnails_image.emit(len(shown_hashes), index, image)
+
+        except Exception as e:
+            msg = f"Experienced an error loading thumbnails; {e}"
+            self.thread_load_thumbnails_status.emit(msg)
+        finally:
+            # Loads not started yet are no longer needed.
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def load_thumbnail(self, result):
+        # Load and decode the thumbnail of one result. Runs in the executor; raises if it can't be loaded.
+        source = local_index.DATALAKE if self.display_mode == 1 else local_index.NEXAR
+        path, data = thumbnails.load(source, result, self.auth_token, self.thread_load_thumbnails_status.emit)
+        # Thumbnails shown before, for an earlier filter or sort of the results, are already decoded.
+        return path, data, image_cache.cache.decode(path, data)
+
+
+class thread_download_full_image(QThread):
+    """
+    This is a thread to download a full image, previewing it while it is received.
+    """
+
+    # Properties assigned by the calling process.
+    # sources lists where the image may be found, in order of preference:
+    # ('local', path), ('s3', path, bucket, key) or ('nexar', path, url).
+    sources = []
+    auth_token = None
+    # Time of the last preview decode.
+    last_preview = 0
+
+    # Create a custom signal to notify main application of status.
+    thread_download_full_image_status = pyqtSignal(str)
+    # Create a custom signal to pass a reduced resolution decode of the partial image to main application.
+    thread_download_full_image_preview = pyqtSignal(QtGui.QImage)
+    # Create a custom signal to pass the path of the complete image to main application.
+    thread_download_full_image_loaded = pyqtSignal(str)
+    # Create a custom signal to pass the error of an image that could not be downloaded to main application.
+    thread_download_full_image_failed = pyqtSignal(str)
+
+    def run(self):
+
+        try:
+            path = services.fetch_image(self.sources, self.auth_token, progress=self.preview_partial)
+        except Exception as e:
+            self.thread_download_full_image_failed.emit(str(e))
+            return
+
+        # Decode the full image here, not on the GUI thread; it is kept for when it is opened again.
+        image = image_cache.cache.load(path)
+        if image is not None:
+            self.thread_download_full_image_preview.emit(image)
+
+        msg = f'Full image ready: /{path}'
+        self.thread_download_full_image_status.emit(msg)
+        self.thread_download_full_image_loaded.emit(path)
+
+    def preview_partial(self, partial, received, expected):
+        # Decode what was received so far at reduced resolution, at most every PREVIEW_INTERVAL seconds.
+        now = time.monotonic()
+        if now - self.last_preview < preview.PREVIEW_INTERVAL:
+            return
+        self.last_preview = now
+
+        with open(partial, 'rb') as f:
+            data = f.read()
+        image = preview.decode_partial(data)
+        if image is not None:
+            self.thread_download_full_image_preview.emit(image)
+        if expected:
+            self.thread_download_full_image_status.emit(f'Received {received * 100 // expected}% of the image.')
+
+
+class thread_export(QThread):
+    """
+    This is a thread to export results to an archive with a manifest.
+    """
+
+    # Properties assigned by the calling process.
+    archive_path = None
+    # List of (sources, manifest record) tuples, as built by the export module.
+    items = []
+    columns = []
+    manifest_format = 'csv'
+    auth_token = None
+
+    # Create a custom signal to notify main application of status.
+    thread_export_status = pyqtSignal(str)
+    # Create a custom signal to pass the counts of results exported, failed and in total to main application.
+    thread_export_progress = pyqtSignal(int, int, int)
+
+    def run(self):
+
+        try:
+            exported, failed = export.export_results(
+                self.archive_path, self.items, self.columns, self.auth_token, self.manifest_format,
+                progress=lambda exported, failed: self.thread_export_progress.emit(exported, failed, len(self.items)),
+                cancelled=self.isInterruptionRequested)
+        except Exception as e:
+            msg = f"Experienced an error exporting results; {e}"
+        else:
+            msg = f"Exported {exported} results to {self.archive_path}; {failed} could not be fetched."
+            if self.isInterruptionRequested():
+                msg = f"Export cancelled. {msg}"
+
+        # Send message to main thread.
+        self.thread_export_status.emit(msg)
 
 
 if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
+    # Record or replay Nexar, s3 and database interactions, if requested by the environment.
+    tape = cassette.install_from_environment()
+    # Fetch through the daemon caching Nexar and s3 objects for every copy of the tool on this server, if set.
+    # A cassette records or replays the fetches itself.
+    shared_cache = cache_daemon.install_from_environment() if not tape else None
+    # Record the stalls of the event loop, including any while the main window is created.
+    watchdog = stall_watchdog.install_from_environment(app)
+    # Profile the memory of the tool, if requested by the environment.
+    memory = memory_profile.install_from_environment(app)
     ui = MainWindow()
+    if memory:
+        memory.attach(ui, ui.memory_accounts)
+        ui.update_message_log(f"Memory profile every {memory.interval:g} s; {memory_profile.DUMP_SHORTCUT} "
+                              f"dumps it to {memory.dump_directory}/")
+    if tape:
+        ui.update_message_log(f"Cassette {os.environ.get('IMAGE_VIEWER_CASSETTE_MODE', 'replay')}: "
+                              f"{os.environ['IMAGE_VIEWER_CASSETTE']}")
+    if shared_cache:
+        ui.update_message_log(f"Cache daemon: {shared_cache.base_url}")
     ui.show()
     sys.exit(app.exec_())
 
@@ -0,0 +1,328 @@
+"""
+Memory profile of the tool, to find what makes the process grow over a long session.
+
+Most of the memory of the tool is outside the Python heap, in the pixels of pixmaps and decoded
+images, so RSS and Python allocations alone don't tell where it goes. Every sample records the RSS,
+the bytes traced by tracemalloc, and the bytes and number of objects of every subsystem: the pixmaps
+shown by every top-level window, the top-level windows themselves, visible or not, the QThread objects
+still alive, the result sets and the caches. Hidden windows and finished threads that keep growing in
+number are objects left behind.
+
+A dump compares the memory now with the last dump, or with the start: the change of every subsystem,
+and the Python allocations that grew most by source line. Dumps are written to JSON files and
+summarized in the log, on demand with Ctrl+Shift+M in the main window or a SIGUSR1 signal to the
+process, and when the tool closes.
+
+Profiling is off unless turned on with environment variables before the tool starts:
+    IMAGE_VIEWER_MEMORY_PROFILE=60               # seconds between samples; unset or 0 turns profiling off
+    IMAGE_VIEWER_MEMORY_DUMPS=memory_profile     # directory dumps are written to
+    IMAGE_VIEWER_MEMORY_TRACE_FRAMES=1           # stack frames kept per Python allocation
+
+tracemalloc slows the tool and adds to its memory, more so with more frames, so it stays off otherwise.
+"""
+
+import gc
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from datetime import datetime as dt
+
+import numpy as np
+from PyQt5 import QtCore, QtGui, QtWidgets
+
+import disk_cache
+import image_cache
+import thumbnail_pack
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 60
+DEFAULT_DUMP_DIRECTORY = 'memory_profile'
+# Samples kept, the most recent ones. A day of samples a minute apart.
+SAMPLES = 1440
+# Python allocations reported per dump, those that grew most.
+TOP_ALLOCATIONS = 25
+# Items of a long list measured to estimate the size of all of them.
+SIZE_SAMPLE = 100
+# Milliseconds between checks for a dump requested by a signal.
+REQUEST_INTERVAL_MS = 500
+DUMP_SHORTCUT = 'Ctrl+Shift+M'
+
+
+def rss_bytes():
+    """
+    Return the resident set size of the process in bytes, or None where it can't be read.
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def estimate_size(value):
+    """
+    Return an estimate of the bytes of value and everything it holds. Lists longer than SIZE_SAMPLE
+    are estimated from an even sample of their items; objects held twice are counted once.
+    """
+    return _deep_size(value, set())
+
+
+def _deep_size(value, seen):
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        # The size of an array includes its data, unless it is a view of the data of another.
+        return size
+    if isinstance(value, dict):
+        return size + sum(_deep_size(key, seen) + _deep_size(item, seen) for key, item in value.items())
+    if isinstance(value, (list, tuple, set, frozenset, np.ndarray)):
+        items = list(value) if not isinstance(value, (list, tuple)) else value
+        if len(items) > SIZE_SAMPLE:
+            step = len(items) / SIZE_SAMPLE
+            sample = [items[int(k * step)] for k in range(SIZE_SAMPLE)]
+            return size + int(sum(_deep_size(item, seen) for item in sample) * len(items) / SIZE_SAMPLE)
+        return size + sum(_deep_size(item, seen) for item in items)
+    return size
+
+
+def widget_accounts():
+    """
+    Return the bytes and number of the pixmaps shown by labels, per top-level window class,
+    and the number of top-level windows per class, hidden ones apart.
+    Must be called on the GUI thread.
+    """
+    accounts = defaultdict(lambda: [0, 0])
+    # Pixmaps are implicitly shared; one shown by several labels is counted once.
+    seen = set()
+    for widget in QtWidgets.QApplication.allWidgets():
+        if not isinstance(widget, QtWidgets.QLabel):
+            continue
+        pixmap = widget.pixmap()
+        if pixmap is None or pixmap.isNull() or pixmap.cacheKey() in seen:
+            continue
+        seen.add(pixmap.cacheKey())
+        account = accounts['pixmaps.' + type(widget.window()).__name__]
+        account[0] += pixmap.width() * pixmap.height() * pixmap.depth() // 8
+        account[1] += 1
+
+    for widget in QtWidgets.QApplication.topLevelWidgets():
+        name = 'windows.' + type(widget).__name__ + ('' if widget.isVisible() else '.hidden')
+        accounts[name][1] += 1
+    return {name: tuple(account) for name, account in accounts.items()}
+
+
+def thread_accounts():
+    """
+    Return the number of QThread objects alive per class, those still running apart, and of Python threads.
+    """
+    accounts = defaultdict(lambda: [0, 0])
+    for obj in gc.get_objects():
+        if isinstance(obj, QtCore.QThread):
+            try:
+                running = obj.isRunning()
+            except RuntimeError:
+                # The Qt object was deleted, and only its Python wrapper is left.
+                running = False
+            accounts['threads.' + type(obj).__name__][1] += 1
+            if running:
+                accounts['threads.' + type(obj).__name__ + '.running'][1] += 1
+    accounts['threads.python'][1] = threading.active_count()
+    return {name: tuple(account) for name, account in accounts.items()}
+
+
+def cache_accounts():
+    """
+    Return the bytes and number of the decoded images cached, of the images waiting to be written to disk,
+    and the bytes of the thumbnail pack mapped in memory.
+    """
+    with image_cache.cache.lock:
+        decoded = (image_cache.cache.bytes, len(image_cache.cache.images))
+    return {'caches.decoded_images': decoded, 'caches.disk_writes': disk_cache.pending(),
+            'caches.thumbnail_pack_mapped': (thumbnail_pack.mapped_bytes(), 0)}
+
+
+class Profiler(QtCore.QObject):
+    """
+    Samples the memory of the tool at an interval, and dumps its changes on demand.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, dump_directory=DEFAULT_DUMP_DIRECTORY, trace_frames=1):
+        super().__init__()
+        self.interval = interval
+        self.dump_directory = dump_directory
+        self.trace_frames = trace_frames
+        self.samples = deque(maxlen=SAMPLES)
+        # Callables returning more accounts, as {name: (bytes, count)}.
+        self.sources = [widget_accounts, thread_accounts, cache_accounts]
+        self.started = None
+        # (seconds, rss, tracemalloc snapshot, accounts) of the last dump, or of the start.
+        self.previous = None
+        self.dump_requested = False
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(int(interval * 1000))
+        self.timer.timeout.connect(self.sample)
+        self.timer_request = QtCore.QTimer(self)
+        self.timer_request.setInterval(REQUEST_INTERVAL_MS)
+        self.timer_request.timeout.connect(self.check_request)
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.trace_frames)
+        self.started = time.monotonic()
+        self.previous = self.checkpoint()
+        self.timer.start()
+        self.timer_request.start()
+        if hasattr(signal, 'SIGUSR1'):
+            # Handlers run on the main thread, between Python bytecodes; the dump itself waits for the GUI.
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.request_dump())
+
+    def stop(self):
+        self.timer.stop()
+        self.timer_request.stop()
+
+    def attach(self, window, accounts=None):
+        """
+        Dump with the shortcut in window, and add accounts, a callable returning {name: (bytes, count)},
+        to every sample.
+        """
+        QtWidgets.QShortcut(QtGui.QKeySequence(DUMP_SHORTCUT), window, self.dump)
+        if accounts is not None:
+            self.sources.append(accounts)
+
+    def request_dump(self):
+        # Safe to call from any thread or signal handler.
+        self.dump_requested = True
+
+    def check_request(self):
+        if self.dump_requested:
+            self.dump_requested = False
+            self.dump()
+
+    def accounts(self):
+        """
+        Return the bytes and number of objects of every subsystem, as {name: (bytes, count)}.
+        Must be called on the GUI thread.
+        """
+        accounts = {}
+        for source in self.sources:
+            try:
+                accounts.update(source())
+            except Exception as e:
+                log.warning(f"Memory accounts of {getattr(source, '__qualname__', source)} failed; {e}")
+        return dict(sorted(accounts.items()))
+
+    def sample(self):
+        traced, peak = tracemalloc.get_traced_memory()
+        self.samples.append({'seconds': time.monotonic() - self.started, 'rss_bytes': rss_bytes(),
+                             'traced_bytes': traced, 'traced_peak_bytes': peak,
+                             'accounts': {name: list(account) for name, account in self.accounts().items()}})
+
+    def checkpoint(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ])
+        return time.monotonic() - (self.started or time.monotonic()), rss_bytes(), snapshot, self.accounts()
+
+    def diff(self):
+        """
+        Return the changes since the last dump, or the start: of the RSS, of every subsystem,
+        and of the Python allocations that grew most. The next diff is from now.
+        """
+        seconds, rss, snapshot, accounts = current = self.checkpoint()
+        previous_seconds, previous_rss, previous_snapshot, previous_accounts = self.previous
+        self.previous = current
+
+        changes = {}
+        for name in sorted(set(accounts) | set(previous_accounts)):
+            size, count = accounts.get(name, (0, 0))
+            previous_size, previous_count = previous_accounts.get(name, (0, 0))
+            changes[name] = {'bytes': size, 'bytes_change': size - previous_size,
+                             'count': count, 'count_change': count - previous_count}
+        statistics = snapshot.compare_to(previous_snapshot, 'lineno' if self.trace_frames == 1 else 'traceback')
+        allocations = [{'where': str(stat.traceback), 'stack': stat.traceback.format(),
+                        'bytes': stat.size, 'bytes_change': stat.size_diff,
+                        'count': stat.count, 'count_change': stat.count_diff}
+                       for stat in statistics[:TOP_ALLOCATIONS]]
+        traced, peak = tracemalloc.get_traced_memory()
+        return {
+            'created': dt.now().isoformat(timespec='seconds'),
+            'seconds': seconds,
+            'since_seconds': previous_seconds,
+            'rss_bytes': rss,
+            'rss_change': rss - previous_rss if rss is not None and previous_rss is not None else None,
+            'traced_bytes': traced,
+            'traced_peak_bytes': peak,
+            'accounts': changes,
+            'allocations': allocations,
+        }
+
+    def report(self, diff):
+        """
+        Return a diff as text: the RSS, the subsystems that changed, and the allocations that grew most.
+        """
+        def mb(size):
+            return f'{size / 1e6:+.1f} MB'
+
+        rss = f"RSS {diff['rss_bytes'] / 1e6:.0f} MB ({mb(diff['rss_change'])})" if diff['rss_bytes'] is not None \
+            else 'RSS unknown'
+        lines = [f"Memory over {diff['seconds'] - diff['since_seconds']:.0f} s: {rss}, "
+                 f"Python {diff['traced_bytes'] / 1e6:.0f} MB traced."]
+        for name, account in diff['accounts'].items():
+            if account['bytes_change'] or account['count_change']:
+                lines.append(f"  {name}: {account['bytes'] / 1e6:.1f} MB ({mb(account['bytes_change'])}), "
+                             f"{account['count']} ({account['count_change']:+d})")
+        for allocation in diff['allocations'][:5]:
+            if allocation['bytes_change'] > 0:
+                lines.append(f"  {allocation['where']}: {mb(allocation['bytes_change'])}")
+        return '\n'.join(lines)
+
+    def dump(self):
+        """
+        Write the diff since the last dump, and the samples, to a new JSON file in the dump directory,
+        and log its report. Return the path of the file.
+        """
+        diff = self.diff()
+        diff['samples'] = list(self.samples)
+        os.makedirs(self.dump_directory, exist_ok=True)
+        path = os.path.join(self.dump_directory, f"memory-{dt.now().strftime('%Y%m%d-%H%M%S')}.json")
+        with open(path, 'w') as f:
+            json.dump(diff, f, indent=2)
+        log.info(self.report(diff) + f"\nMemory dump written to {path}")
+        return path
+
+
+def install_from_environment(app):
+    """
+    Start profiling the memory of the tool, as set by the IMAGE_VIEWER_MEMORY environment variables.
+    A last dump is written when app quits. Return the profiler, or None if profiling is off.
+    """
+    interval = float(os.environ.get('IMAGE_VIEWER_MEMORY_PROFILE', '0'))
+    if interval <= 0:
+        return None
+    profiler = Profiler(interval, os.environ.get('IMAGE_VIEWER_MEMORY_DUMPS', DEFAULT_DUMP_DIRECTORY),
+                        int(os.environ.get('IMAGE_VIEWER_MEMORY_TRACE_FRAMES', '1')))
+
+    def finish():
+        profiler.stop()
+        profiler.dump()
+
+    app.aboutToQuit.connect(finish)
+    profiler.start()
+    return profiler
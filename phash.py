@@ -0,0 +1,83 @@
+"""
+Perceptual hashing of thumbnails, used to collapse near-duplicate frames from the same drive pass.
+
+The hash is the 64 bit DCT hash: the image is reduced to 32x32 grayscale, and each bit records
+whether one of the 8x8 lowest frequency DCT coefficients is above their median.
+Near-duplicate images have hashes a small Hamming distance apart.
+"""
+
+import io
+
+import numpy as np
+from PIL import Image
+
+import disk_cache
+
+HASH_SIZE = 8
+IMAGE_SIZE = 32
+# Default maximum Hamming distance, in bits, between hashes of near-duplicate images.
+DUPLICATE_DISTANCE = 10
+# Extension of the file the hash is cached in, next to the thumbnail it was computed from.
+HASH_EXTENSION = '.phash'
+
+
+def _dct_matrix(size):
+    # Orthonormal DCT-II matrix, so the 2D DCT of x is M @ x @ M.T
+    k = np.arange(size)
+    matrix = np.sqrt(2.0 / size) * np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * size))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(IMAGE_SIZE)
+
+
+def image_hash(source):
+    """
+    Return the perceptual hash of an image as an int.
+
+    Parameters:
+    - source: str or file-like, the image path or an open binary buffer.
+    """
+    with Image.open(source) as image:
+        pixels = np.asarray(image.convert('L').resize((IMAGE_SIZE, IMAGE_SIZE), Image.LANCZOS), dtype=float)
+
+    dct = DCT_MATRIX @ pixels @ DCT_MATRIX.T
+    low = dct[:HASH_SIZE, :HASH_SIZE].flatten()
+    # The DC coefficient only carries overall brightness, so it is left out of the median.
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def cached_hash(path, data=None):
+    """
+    Return the hash of the image at path, reading it from the cache file next to the image if present.
+    The hash is computed and cached when missing, from data when the image is already in memory.
+    Return None if the image can't be read.
+    """
+    hash_path = path + HASH_EXTENSION
+    cached = disk_cache.read(hash_path)
+    if cached is not None:
+        try:
+            return int(cached, 16)
+        except ValueError:
+            pass
+
+    try:
+        value = image_hash(io.BytesIO(data) if data is not None else path)
+    except (OSError, ValueError):
+        return None
+
+    disk_cache.write_async(hash_path, f'{value:016x}'.encode())
+    return value
+
+
+def hamming_distances(value, hashes):
+    """
+    Return the Hamming distances between one hash and an array of hashes.
+    """
+    hashes = np.asarray(hashes, dtype=np.uint64).reshape(-1)
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    bits = np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1)
+    return bits.sum(axis=1)
+
@@ -0,0 +1,207 @@
+"""
+Speculative prefetch of the next areas an analyst is likely to search.
+
+Analysts walk along a road by nudging the search coordinates a step at a time. From the last two
+searches the prefetcher takes the step, and predicts the next areas a step or two further in the
+same direction. Their results and thumbnails are fetched in the background into the local index and
+the disk caches, so when the analyst gets there the grid fills from disk and Nexar only has the
+frames captured since to send.
+
+Prefetching runs at low priority: it waits for the analyst to pause, leaves at least half of the
+Nexar rate limit to the tool, and stops as soon as a new search makes its predictions stale. What it
+fetches is capped by a budget of Nexar requests and bytes per hour. Hit rate statistics tell how many
+searches found their area already prefetched, to tune the number of steps and the budget.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+
+import geodesy
+import services
+
+log = logging.getLogger(__name__)
+
+# Areas predicted ahead of the last search, one step apart.
+PREFETCH_STEPS = 2
+# Steps longer than this many search radii are jumps to another place, not a walk.
+MAX_STEP_RADII = 10
+# Seconds the analyst must pause before prefetching starts.
+PREFETCH_DELAY = 2.0
+# Budget of the prefetcher, over the last hour.
+REQUESTS_PER_HOUR = 600
+BYTES_PER_HOUR = 100 * 1000 * 1000
+# A search is a hit if its center is within this fraction of its radius of a prefetched center.
+HIT_TOLERANCE = 0.25
+# Prefetched areas remembered for hits, the most recent ones.
+PREFETCHED_AREAS = 32
+# Thumbnails cached per prefetched area, enough for the first pages of the grid.
+THUMBNAILS_PER_AREA = 16
+
+
+def predict(history, steps=PREFETCH_STEPS):
+    """
+    Return the (latitude, longitude, radius_meters) areas predicted to be searched next, nearest first,
+    from a list of the recent (latitude, longitude, radius_meters) searches, oldest first.
+    """
+    if len(history) < 2:
+        return []
+    (latitude0, longitude0, _), (latitude1, longitude1, radius_meters) = history[-2:]
+    step = geodesy.distance_meters(latitude0, longitude0, [latitude1], [longitude1])[0]
+    if step == 0 or step > MAX_STEP_RADII * radius_meters:
+        return []
+    d_latitude = latitude1 - latitude0
+    d_longitude = longitude1 - longitude0
+    return [(latitude1 + d_latitude * k, longitude1 + d_longitude * k, radius_meters) for k in range(1, steps + 1)]
+
+
+class Budget:
+    """
+    Rolling budget of requests and bytes over the last hour.
+    """
+
+    def __init__(self, requests_per_hour=REQUESTS_PER_HOUR, bytes_per_hour=BYTES_PER_HOUR):
+        self.requests_per_hour = requests_per_hour
+        self.bytes_per_hour = bytes_per_hour
+        # (time, requests, bytes) of every spend in the last hour.
+        self.spent = deque()
+
+    def _expire(self):
+        while self.spent and self.spent[0][0] < time.monotonic() - 3600:
+            self.spent.popleft()
+
+    def allows(self):
+        self._expire()
+        return (sum(entry[1] for entry in self.spent) < self.requests_per_hour
+                and sum(entry[2] for entry in self.spent) < self.bytes_per_hour)
+
+    def spend(self, requests, size):
+        self.spent.append((time.monotonic(), requests, size))
+
+
+class Prefetcher:
+    """
+    Predicts the next search areas and warms them on a background thread.
+    """
+
+    def __init__(self, warm, budget=None, steps=PREFETCH_STEPS, delay=PREFETCH_DELAY):
+        """
+        Parameters:
+        - warm: called on the prefetch thread with (source, latitude, longitude, radius_meters, settings, stale)
+          to fetch the results and thumbnails of an area. stale() returns True once the prefetch is no longer
+          wanted. Returns the (Nexar requests, bytes) it spent.
+        - budget: Budget, by default REQUESTS_PER_HOUR and BYTES_PER_HOUR.
+        """
+        self.warm = warm
+        self.budget = budget or Budget()
+        self.steps = steps
+        self.delay = delay
+        self.history = deque(maxlen=2)
+        # (source, latitude, longitude, radius_meters) of the areas prefetched, and whether they were hit.
+        self.prefetched = deque(maxlen=PREFETCHED_AREAS)
+        self.stats = {'searches': 0, 'hits': 0, 'predicted': 0, 'prefetched': 0, 'failed': 0,
+                      'over_budget': 0, 'requests': 0, 'bytes': 0}
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        # Bumped by every search; a prefetch started for an older generation stops.
+        self.generation = 0
+        self.job = None
+        self.thread = threading.Thread(target=self.work, name='prefetch', daemon=True)
+        self.thread.start()
+
+    def record_search(self, source, latitude, longitude, radius_meters, settings):
+        """
+        Record a search made by the analyst, count it as a hit or miss, and prefetch the areas predicted next.
+        settings are passed on to warm, and should hold whatever it needs from the interface.
+        Return True if the area was prefetched.
+        """
+        with self.lock:
+            self.stats['searches'] += 1
+            hit = False
+            for area in self.prefetched:
+                if area['source'] == source and area['radius_meters'] >= radius_meters and \
+                        geodesy.distance_meters(latitude, longitude, [area['latitude']], [area['longitude']])[0] \
+                        <= HIT_TOLERANCE * radius_meters:
+                    hit = True
+                    area['hit'] = True
+            if hit:
+                self.stats['hits'] += 1
+
+            self.history.append((latitude, longitude, radius_meters))
+            areas = predict(list(self.history), self.steps)
+            self.stats['predicted'] += len(areas)
+            self.generation += 1
+            self.job = (self.generation, time.monotonic() + self.delay, source, areas, settings) if areas else None
+            self.wake.notify()
+        return hit
+
+    def stale(self, generation):
+        return self.generation != generation
+
+    def work(self):
+        while True:
+            with self.lock:
+                while self.job is None:
+                    self.wake.wait()
+                generation, start, source, areas, settings = self.job
+                self.job = None
+
+            # Wait for the analyst to pause; a new search replaces this job.
+            while time.monotonic() < start:
+                time.sleep(max(min(start - time.monotonic(), 0.1), 0))
+                if self.stale(generation):
+                    break
+
+            for latitude, longitude, radius_meters in areas:
+                if self.stale(generation):
+                    break
+                if not self.budget.allows():
+                    with self.lock:
+                        self.stats['over_budget'] += 1
+                    break
+                # Leave at least half of the Nexar rate limit to the searches of the analyst.
+                while services.nexar_limiter.available() < services.nexar_limiter.burst / 2 \
+                        and not self.stale(generation):
+                    time.sleep(0.1)
+                if self.stale(generation):
+                    break
+                try:
+                    requests, size = self.warm(source, latitude, longitude, radius_meters, settings,
+                                               lambda: self.stale(generation))
+                except Exception as e:
+                    log.warning(f"Prefetch of {latitude}, {longitude} failed; {e}")
+                    with self.lock:
+                        self.stats['failed'] += 1
+                    continue
+                self.budget.spend(requests, size)
+                with self.lock:
+                    self.stats['prefetched'] += 1
+                    self.stats['requests'] += requests
+                    self.stats['bytes'] += size
+                    self.prefetched.append({'source': source, 'latitude': latitude, 'longitude': longitude,
+                                            'radius_meters': radius_meters, 'hit': False})
+
+    def summary(self):
+        """
+        Return the statistics: searches, hits and hit_rate (hits per search), predicted, prefetched, failed,
+        over_budget (prefetches skipped for the budget), precision (prefetched areas later searched),
+        and the Nexar requests and bytes spent.
+        """
+        with self.lock:
+            summary = dict(self.stats)
+            used = sum(1 for area in self.prefetched if area['hit'])
+            remembered = len(self.prefetched)
+        summary['hit_rate'] = summary['hits'] / summary['searches'] if summary['searches'] else 0.0
+        summary['precision'] = used / remembered if remembered else 0.0
+        return summary
+
+    def report(self):
+        """
+        Return the statistics as text.
+        """
+        summary = self.summary()
+        return (f"Prefetch: {summary['hits']} of {summary['searches']} searches hit ({summary['hit_rate']:.0%}), "
+                f"{summary['prefetched']} areas prefetched ({summary['precision']:.0%} later searched), "
+                f"{summary['requests']} Nexar requests, {summary['bytes'] / 1e6:.1f} MB, "
+                f"{summary['over_budget']} stopped by the budget.")
@@ -0,0 +1,77 @@
+"""
+Progressive preview of a full image while it downloads.
+
+The preview window opens at once with the thumbnail already shown in the grid, upscaled. It is
+replaced by reduced resolution decodes of the partially received image as the download goes on.
+Once the image is complete, the main window hands it over to the full image viewer.
+"""
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import Qt
+
+# Partial downloads are decoded at 1/PREVIEW_SCALE of the full resolution. JPEG decoders scale by
+# powers of two while decoding, so this is much cheaper than a full decode.
+PREVIEW_SCALE = 4
+# Seconds between decodes of a partial download.
+PREVIEW_INTERVAL = 0.25
+
+
+def decode_partial(data, scale=PREVIEW_SCALE):
+    """
+    Return a reduced resolution QImage of the image in data, which may be truncated.
+    The part of the image not received yet is left blank. Return None if nothing can be decoded yet.
+    """
+    buffer = QtCore.QBuffer()
+    buffer.setData(QtCore.QByteArray(data))
+    buffer.open(QtCore.QIODevice.ReadOnly)
+    reader = QtGui.QImageReader(buffer)
+    size = reader.size()
+    if not size.isValid():
+        return None
+    reader.setScaledSize(QtCore.QSize(max(size.width() // scale, 1), max(size.height() // scale, 1)))
+    image = reader.read()
+    return None if image.isNull() else image
+
+
+class PreviewWindow(QtWidgets.QWidget):
+    """
+    A window showing the best version of an image received so far, scaled to fit.
+    """
+
+    def __init__(self, title, placeholder=None):
+        """
+        Parameters:
+        - title: str, the window title.
+        - placeholder: QPixmap, the thumbnail shown until a better image arrives, or None.
+        """
+        super().__init__()
+        self.setWindowTitle(title)
+        self.pixmap = None
+        self.label = QtWidgets.QLabel('Loading ...', self)
+        self.label.setAlignment(Qt.AlignCenter)
+        self.label.setSizePolicy(QtWidgets.QSizePolicy.Ignored, QtWidgets.QSizePolicy.Ignored)
+        self.status = QtWidgets.QLabel(self)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.label, 1)
+        layout.addWidget(self.status)
+        if placeholder is not None and not placeholder.isNull():
+            self.set_pixmap(placeholder)
+
+    def set_pixmap(self, pixmap):
+        self.pixmap = pixmap
+        self.rescale()
+
+    def show_image(self, image):
+        # Show a decode of the image, replacing the thumbnail or an earlier partial decode.
+        self.set_pixmap(QtGui.QPixmap.fromImage(image))
+
+    def show_status(self, text):
+        self.status.setText(text)
+
+    def rescale(self):
+        if self.pixmap is not None:
+            self.label.setPixmap(self.pixmap.scaled(self.label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.rescale()
@@ -0,0 +1,92 @@
+"""
+Routing of datalake queries to the database of every region a search reaches.
+
+Each region has its own datalake database, named as ushr.acorn.datalake.utils.connect_to_db expects,
+and covers one or more (south, west, north, east) extents in degrees. A search is sent to every
+region its bounding box overlaps; a search straddling regions queries their databases in parallel,
+each through its own connection pool, so the slowest region sets the latency rather than the sum.
+
+Regions other than the built-in ones are added, or the built-in extents replaced, with a JSON file:
+    IMAGE_VIEWER_REGIONS=regions.json          # {"europe": [[34.0, -25.0, 72.0, 45.0]]}
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+REGIONS = {
+    'north_america': [(5.0, -170.0, 84.0, -50.0)],
+}
+
+# Region queries run at once, over every search in the tool.
+REGION_WORKERS = 8
+
+# Threads are only started as queries are submitted.
+_executor = ThreadPoolExecutor(REGION_WORKERS, thread_name_prefix='region')
+
+
+def _load_environment():
+    path = os.environ.get('IMAGE_VIEWER_REGIONS')
+    if path:
+        with open(path, 'r') as f:
+            REGIONS.update({name: [tuple(extent) for extent in extents] for name, extents in json.load(f).items()})
+
+
+_load_environment()
+
+
+def _longitude_ranges(west, east):
+    # A box reaching past the antimeridian is split into the ranges it covers within -180 to 180.
+    if east - west >= 360:
+        return [(-180.0, 180.0)]
+    west = (west + 180) % 360 - 180
+    east = west + (east - west if east >= west else east - west + 360)
+    if east > 180:
+        return [(west, 180.0), (-180.0, east - 360)]
+    return [(west, east)]
+
+
+def regions_for_box(south, west, north, east):
+    """
+    Return the names of the regions overlapping a (south, west, north, east) box, in degrees.
+    """
+    ranges = _longitude_ranges(west, east)
+    names = []
+    for name, extents in REGIONS.items():
+        for extent_south, extent_west, extent_north, extent_east in extents:
+            if south > extent_north or north < extent_south:
+                continue
+            if any(range_west <= extent_east and range_east >= extent_west for range_west, range_east in ranges):
+                names.append(name)
+                break
+    return names
+
+
+def region_of_point(latitude, longitude):
+    """
+    Return the name of the region a point is in, or None if no region covers it.
+    """
+    regions = regions_for_box(latitude, longitude, latitude, longitude)
+    return regions[0] if regions else None
+
+
+def fan_out(db_regions, query):
+    """
+    Call query(db_region) for every region at once.
+    Return (results, errors): dictionaries of region to the result of its query, and to the exception
+    of a query that failed, so one unreachable region doesn't lose the results of the others.
+    """
+    if len(db_regions) == 1:
+        # Nothing to overlap; skip the hand-off to the executor.
+        futures = None
+    else:
+        futures = {db_region: _executor.submit(query, db_region) for db_region in db_regions}
+
+    results = {}
+    errors = {}
+    for db_region in db_regions:
+        try:
+            results[db_region] = futures[db_region].result() if futures else query(db_region)
+        except Exception as e:
+            errors[db_region] = e
+    return results, errors
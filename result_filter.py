@@ -0,0 +1,134 @@
+"""
+Client-side filtering and sorting of search results that were already fetched.
+
+Nexar frames and Datalake rows are converted into columns of numpy arrays, so that
+changing a filter setting is a handful of vectorized operations instead of a new query.
+"""
+
+import numpy as np
+
+from geodesy import distance_meters
+
+# Nexar direction names in order of increasing heading, each covering a 45 degree sector.
+DIRECTION_SECTORS = ['NORTH', 'NORTH_EAST', 'EAST', 'SOUTH_EAST', 'SOUTH', 'SOUTH_WEST', 'WEST', 'NORTH_WEST']
+
+# Sort options, in the order they are listed in the filter panel.
+SORT_AS_RETURNED = 0
+SORT_NEWEST_FIRST = 1
+SORT_OLDEST_FIRST = 2
+SORT_NEAREST_FIRST = 3
+SORT_BEST_QUALITY_FIRST = 4
+SORT_OPTIONS = ['As returned', 'Newest first', 'Oldest first', 'Nearest first', 'Best quality first']
+
+
+def parse_point(text):
+    """
+    Return (longitude, latitude) from a WKT point such as 'POINT(-84.21 33.98)'.
+    """
+    try:
+        values = text[text.index('(') + 1:text.index(')')].split()
+        return float(values[0]), float(values[1])
+    except (AttributeError, ValueError, IndexError):
+        return np.nan, np.nan
+
+
+def heading_directions(headings):
+    """
+    Map headings in degrees to the Nexar direction name of the sector containing them.
+    """
+    headings = np.asarray(headings, dtype=float)
+    sectors = np.floor(np.mod(np.nan_to_num(headings) + 22.5, 360.0) / 45.0).astype(int) % 8
+    directions = np.array(DIRECTION_SECTORS, dtype=object)[sectors]
+    directions[np.isnan(headings)] = ''
+    return directions
+
+
+def nexar_columns(frames):
+    """
+    Build the filter columns for a list of Nexar frames.
+    """
+    latitude = np.array([float(frame['gps_info']['latitude']) for frame in frames], dtype=float)
+    longitude = np.array([float(frame['gps_info']['longitude']) for frame in frames], dtype=float)
+    heading = np.array([_to_float(frame.get('camera_heading')) for frame in frames], dtype=float)
+    # captured_at is epoch ms, convert to s.
+    captured_at = np.array([_to_float(frame.get('captured_at')) / 1000 for frame in frames], dtype=float)
+    quality = np.array([_to_float(frame.get('frame_quality')) for frame in frames], dtype=float)
+    # Use the direction reported by Nexar, falling back to the camera heading.
+    direction = heading_directions(heading)
+    for index, frame in enumerate(frames):
+        if frame.get('direction'):
+            direction[index] = frame['direction']
+
+    return {'latitude': latitude, 'longitude': longitude, 'heading': heading, 'direction': direction,
+            'captured_at': captured_at, 'quality': quality}
+
+
+def datalake_rows_columns(rows):
+    """
+    Build the filter columns for rows of the datalake.camera_image query.
+    """
+    points = [parse_point(row[4]) for row in rows]
+    longitude = np.array([point[0] for point in points], dtype=float)
+    latitude = np.array([point[1] for point in points], dtype=float)
+    heading = np.array([_to_float(row[8]) for row in rows], dtype=float)
+    captured_at = np.array([row[7].timestamp() if row[7] is not None else np.nan for row in rows], dtype=float)
+    # The datalake has no notion of frame quality.
+    quality = np.full(len(rows), np.nan)
+
+    return {'latitude': latitude, 'longitude': longitude, 'heading': heading,
+            'direction': heading_directions(heading), 'captured_at': captured_at, 'quality': quality}
+
+
+def filter_and_sort(columns, latitude, longitude, directions=None, start_time=None, end_time=None,
+                    max_distance=None, min_quality=None, sort_by=SORT_AS_RETURNED):
+    """
+    Return the indices of the results that pass the filter, in display order.
+
+    Parameters:
+    - columns: dict, the columns built by nexar_columns or datalake_rows_columns.
+    - latitude, longitude: float, the query point distances are measured from.
+    - directions: collection of direction names to keep, or None/empty for all headings.
+    - start_time, end_time: float, capture time window in epoch seconds, or None.
+    - max_distance: float, maximum distance in meters from the query point, or None.
+    - min_quality: float, minimum frame quality, or None. Results without a quality always pass.
+    - sort_by: int, one of the SORT_* options.
+    """
+    count = len(columns['latitude'])
+    keep = np.ones(count, dtype=bool)
+    distance = distance_meters(latitude, longitude, columns['latitude'], columns['longitude'])
+
+    # Results with unknown values are kept: a heading of no direction, and, as comparisons against NaN
+    # are False, the rest by testing the inverse.
+    if directions:
+        keep &= np.isin(columns['direction'], list(directions)) | (columns['direction'] == '')
+    if start_time is not None:
+        keep &= ~(columns['captured_at'] < start_time)
+    if end_time is not None:
+        keep &= ~(columns['captured_at'] > end_time)
+    if max_distance:
+        keep &= ~(distance > max_distance)
+    if min_quality is not None:
+        keep &= ~(columns['quality'] < min_quality)
+
+    indices = np.flatnonzero(keep)
+
+    if sort_by == SORT_NEWEST_FIRST:
+        key = -columns['captured_at'][indices]
+    elif sort_by == SORT_OLDEST_FIRST:
+        key = columns['captured_at'][indices]
+    elif sort_by == SORT_NEAREST_FIRST:
+        key = distance[indices]
+    elif sort_by == SORT_BEST_QUALITY_FIRST:
+        key = -columns['quality'][indices]
+    else:
+        return indices
+
+    # A stable sort keeps the server order for ties, and NaN keys sort last.
+    return indices[np.argsort(key, kind='stable')]
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
@@ -0,0 +1,215 @@
+"""
+Searches of the Datalake and Nexar around a point, recording their results in the local index.
+
+The search threads of the tool run these for the analyst's searches, and the prefetcher for the areas
+it predicts next. Progress is passed to status as messages; a search that fails raises.
+"""
+
+import json
+import logging
+import time
+from datetime import datetime as dt
+
+import geodesy
+import known_frames
+import local_index
+import regions
+import result_filter
+import services
+
+log = logging.getLogger(__name__)
+
+# Road types requested from Nexar.
+NEXAR_ROAD_TYPES = ['MOTORWAY', 'TRUNK', 'PRIMARY', 'SECONDARY', 'TERTIARY', 'UNCLASSIFIED', 'RESIDENTIAL',
+                    'SERVICE', 'MOTORWAY_LINK', 'TRUNK_LINK', 'PRIMARY_LINK', 'SECONDARY_LINK', 'TERTIARY_LINK']
+
+
+def search_datalake(latitude, longitude, radius_meters, exclude_locations=(), status=log.info):
+    """
+    Return the datalake.camera_image rows within radius_meters of a point, leaving out the rows of
+    exclude_locations, the s3 locations of rows already found.
+    """
+    # The envelope is answered from the spatial index; rows in its corners are dropped below.
+    south, west, north, east = geodesy.bounding_box(latitude, longitude, radius_meters)
+
+    # Query the database of every region the search reaches, in parallel.
+    db_regions = regions.regions_for_box(south, west, north, east)
+    if not db_regions:
+        raise ValueError("No Datalake region covers this search.")
+    results, errors = regions.fan_out(
+        db_regions, lambda db_region: query_datalake(db_region, south, west, north, east, exclude_locations))
+    if errors and not results:
+        raise next(iter(errors.values()))
+    # A region that failed doesn't lose the rows of the others.
+    for db_region, e in errors.items():
+        status(f"Experienced an error searching Datalake in {db_region}; {e}")
+    rows = [row for db_region in db_regions for row in results.get(db_region, [])]
+
+    # Keep the rows within the search radius, by great circle distance.
+    points = [result_filter.parse_point(row[4]) for row in rows]
+    keep = geodesy.within_radius(latitude, longitude, radius_meters,
+                                 [point[1] for point in points], [point[0] for point in points])
+    rows = [row for row, inside in zip(rows, keep) if inside]
+    # Record the rows, so their images are found locally once cached.
+    local_index.add_datalake_rows(rows)
+    return rows
+
+
+def query_datalake(db_region, south, west, north, east, exclude_locations=()):
+    # Return the rows of one region's database in the envelope, through that region's connection pool.
+    with services.db_connection(db_region) as conn:
+        with conn.cursor() as cursor:
+            sql = """ SELECT id, s3_location, asset_id, processing_index, st_astext(geom), geom, version, datetime, vehicle_heading, image_heading, cam_id
+            FROM datalake.camera_image
+            WHERE ST_Intersects(geom, ST_MakeEnvelope(%s, %s, %s, %s, 4326))"""
+            params = (west, south, east, north,)
+            if exclude_locations:
+                # Row ids are only unique within a region, so rows are left out by s3 location.
+                sql += " AND NOT (s3_location = ANY(%s))"
+                params += (list(exclude_locations),)
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+
+
+def search_nexar(latitude, longitude, radius_meters, auth_token, start_time, end_time, min_frame_quality,
+                 directions, incremental=False, dump_path=None, status=log.info):
+    """
+    Return the Nexar response of the frames within radius_meters of a point, as a dictionary.
+
+    Parameters:
+    - start_time, end_time: epoch ms of the time window; end_time None for now.
+    - directions: list of the Nexar directions requested, NORTH, NORTH_EAST, ...; one at least.
+    - incremental: only request the frames captured since the watermark of the area, merging the
+      earlier ones from the local index.
+    - dump_path: file the response is written to, or None.
+    """
+    # The smallest box containing the search circle; a degree of longitude shrinks with latitude.
+    sw_latitude, sw_longitude, ne_latitude, ne_longitude = geodesy.bounding_box(latitude, longitude, radius_meters)
+
+    headers = {
+        'accept': 'application/json',
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + auth_token,
+    }
+    if not end_time:
+        # The end of the time window is now, in ms.
+        end_time = int(time.time()) * 1000
+
+    json_data = {
+        "bounding_box": {
+            "south_west": {"longitude": sw_longitude, "latitude": sw_latitude},
+            "north_east": {"longitude": ne_longitude, "latitude": ne_latitude},
+        },
+        "filters": {
+            "min_frame_quality": min_frame_quality,
+            "road_types": NEXAR_ROAD_TYPES,
+            "directions": list(directions),
+            "frames_context": ["DAYLIGHT", "NIGHTTIME"],
+            "start_time": start_time,
+            "end_time": end_time,
+        },
+        "sort_by": "TIMESTAMP",
+    }
+
+    # If an earlier search of this area covered the start of the time window,
+    # only the frames captured after the newest one it saw are requested.
+    area = local_index.area_key(latitude, longitude, radius_meters, directions, min_frame_quality)
+    mark = local_index.watermark(area) if incremental else None
+    if mark and start_time >= mark[0]:
+        json_data['filters']['start_time'] = max(start_time, mark[1] + 1)
+        status(f"Searching Nexar for frames captured since {dt.fromtimestamp(mark[1] / 1000)}.")
+    else:
+        mark = None
+
+    if json_data['filters']['start_time'] <= end_time:
+        response = services.nexar_request('POST', services.NEXAR_FRAMES_URL, headers=headers, json=json_data)
+        data = response.json()
+        if dump_path:
+            with open(dump_path, "w") as f:
+                json.dump(data, f, indent=2)
+    else:
+        # The whole time window is older than the watermark; the local index has every frame.
+        data = {'frames': []}
+
+    # Frames Nexar returned, before any are dropped.
+    returned = len(data.get('frames', []))
+
+    # The box reaches further than the radius in its corners. Drop the frames there,
+    # so nothing is looked up or downloaded for them.
+    drop_frames_outside_radius(data, latitude, longitude, radius_meters, status)
+
+    # Flag frames already in the datalake, so they are served from our s3 bucket instead of Nexar.
+    flag_known_frames(data.get('frames', []), latitude, longitude, radius_meters, status)
+
+    # Record the frames, so their images are found locally once cached.
+    local_index.add_nexar_frames(data.get('frames', []))
+
+    # Every frame up to the newest one seen is now in the index, unless Nexar cut the response short.
+    local_index.advance_watermark(area, start_time, data.get('frames', []), mark,
+                                  truncated=returned >= services.NEXAR_PAGE_LIMIT)
+
+    if mark:
+        merge_indexed_frames(data, latitude, longitude, radius_meters, start_time, end_time, directions,
+                             min_frame_quality, status)
+    return data
+
+
+def merge_indexed_frames(data, latitude, longitude, radius_meters, start_time, end_time, directions,
+                         min_frame_quality, status=log.info):
+    # Add the frames of earlier searches of the area to the new ones, from the local index.
+    new = {str(frame['frame_id']) for frame in data.get('frames', [])}
+    indexed = local_index.search(local_index.NEXAR, latitude, longitude, radius_meters,
+                                 start_time / 1000, end_time / 1000, directions, cached_only=False)
+    indexed = [frame for frame in indexed if str(frame['frame_id']) not in new
+               and float(frame.get('frame_quality') or 0) >= min_frame_quality]
+
+    # Frames ingested since they were indexed are served from our s3 bucket; the mirror knows them.
+    known = known_frames.lookup([str(frame['frame_id']) for frame in indexed])
+    for frame in indexed:
+        if str(frame['frame_id']) in known:
+            frame['datalake_s3_location'] = known[str(frame['frame_id'])]
+
+    data['frames'] = data.get('frames', []) + indexed
+    status(f"{len(new)} new Nexar frames, and {len(indexed)} from earlier searches of this area.")
+
+
+def drop_frames_outside_radius(data, latitude, longitude, radius_meters, status=log.info):
+
+    frames = data.get('frames', [])
+    keep = geodesy.within_radius(latitude, longitude, radius_meters,
+                                 [frame['gps_info']['latitude'] for frame in frames],
+                                 [frame['gps_info']['longitude'] for frame in frames])
+    data['frames'] = [frame for frame, inside in zip(frames, keep) if inside]
+
+    dropped = len(frames) - len(data['frames'])
+    if dropped:
+        status(f"Dropped {dropped} of {len(frames)} Nexar frames outside the search radius.")
+
+
+def flag_known_frames(frames, latitude, longitude, radius_meters, status=log.info):
+
+    frame_ids = [str(frame['frame_id']) for frame in frames]
+    if not frame_ids:
+        return
+
+    # Frames in the local mirror are known without asking the database.
+    known = known_frames.lookup(frame_ids)
+    remaining = [frame_id for frame_id in frame_ids if frame_id not in known]
+
+    # Look up the remaining frames with one bulk query.
+    if remaining:
+        try:
+            # The frames are within the search box, so only the regions it reaches can hold them.
+            db_regions = regions.regions_for_box(*geodesy.bounding_box(latitude, longitude, radius_meters))
+            found = known_frames.query_datalake(remaining, db_regions) if db_regions else {}
+        except Exception as e:
+            status(f"Datalake lookup of Nexar frames failed, using local mirror only; {e}")
+        else:
+            known.update(found)
+
+    for frame in frames:
+        s3_location = known.get(str(frame['frame_id']))
+        if s3_location:
+            frame['datalake_s3_location'] = s3_location
+
+    status(f"{len(known)} of {len(frame_ids)} Nexar frames are already in the Datalake.")
@@ -0,0 +1,481 @@
+"""
+Access to the remote services used by the tool: the Nexar API, s3 and the datalake database.
+
+Everything that talks to a remote service goes through the functions in this module, and callers
+look them up on the module at call time (services.download_file(...)). That lets benchmarks and
+offline runs install local stand-ins by replacing the functions here.
+"""
+
+import base64
+import contextlib
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+import boto3
+import botocore.config
+import requests
+from boto3.s3.transfer import TransferConfig
+
+import disk_cache
+
+# Base URL of the Nexar API. Set NEXAR_BASE_URL to point the tool at a local stand-in.
+NEXAR_BASE_URL = os.environ.get('NEXAR_BASE_URL', 'https://external.getnexar.com')
+NEXAR_FRAMES_URL = NEXAR_BASE_URL + '/api/virtualcam/v4/frames'
+NEXAR_REFRESH_TOKEN_URL = NEXAR_BASE_URL + '/dev-portal/refresh-token'
+# A frames search returning at least this many frames may have been truncated by Nexar.
+NEXAR_PAGE_LIMIT = 1000
+
+# Requests per second allowed to the Nexar API, shared by every caller in the process, and the
+# burst of requests allowed at once. Set NEXAR_RATE_LIMIT to 0 to turn limiting off.
+NEXAR_RATE_LIMIT = float(os.environ.get('NEXAR_RATE_LIMIT', '10'))
+NEXAR_BURST = int(os.environ.get('NEXAR_BURST', '20'))
+# Times a request refused with 429 Too Many Requests or 503 is sent again, after the Retry-After delay.
+NEXAR_LIMITED_RETRIES = 5
+# Delay when a refusal doesn't say how long to wait.
+NEXAR_DEFAULT_RETRY_AFTER = 1.0
+
+# Size of the chunks downloads are streamed to disk in.
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+# Attempts at a download, resuming where the last one stopped, before giving up.
+DOWNLOAD_ATTEMPTS = 5
+# Seconds to wait for the server to connect or send more data.
+DOWNLOAD_TIMEOUT = 30
+# Extension of a file being downloaded. It is renamed to its final path once complete and verified.
+PARTIAL_EXTENSION = '.part'
+
+# s3 connections kept open by the shared client. Enough for every thumbnail loader and transfer thread.
+S3_MAX_POOL_CONNECTIONS = 32
+# Objects larger than the threshold are transferred in parts of S3_PART_SIZE, S3_PART_CONCURRENCY at once.
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+S3_PART_SIZE = 8 * 1024 * 1024
+S3_PART_CONCURRENCY = 4
+
+# Idle connections kept open per datalake region, for the next query to reuse.
+DB_POOL_SIZE = 4
+
+
+class IncompleteDownload(IOError):
+    """
+    Raised when a download could not be completed, or did not match its expected size or checksum.
+    """
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Each request takes a token; tokens refill at rate per second up to burst.
+    Callers wait for a token, so a burst of requests queues up instead of being refused by the server.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        # Set from Retry-After; no requests are sent before this time.
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Wait until a request may be sent.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif not self.rate:
+                    return
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def available(self):
+        """
+        Return the tokens available now, without taking one. Requests are unlimited without a rate.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return 0.0
+            if not self.rate:
+                return float(self.burst)
+            return min(self.burst, self.tokens + (now - self.updated) * self.rate)
+
+    def pause(self, seconds):
+        """
+        Hold every request for seconds, as asked by the server.
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+            self.updated = self.blocked_until
+
+
+# The limiter shared by all Nexar requests.
+nexar_limiter = TokenBucket(NEXAR_RATE_LIMIT, NEXAR_BURST)
+
+
+def _retry_after(response):
+    # Return the seconds to wait given by a Retry-After header, in seconds or as an HTTP date.
+    value = response.headers.get('Retry-After')
+    if not value:
+        return NEXAR_DEFAULT_RETRY_AFTER
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return NEXAR_DEFAULT_RETRY_AFTER
+
+
+def nexar_request(method, url, **kwargs):
+    """
+    Send a request to the Nexar API and return the requests.Response.
+
+    Requests wait their turn in nexar_limiter. A request refused with 429 or 503 pauses the limiter
+    for the Retry-After delay, for every caller, and is sent again.
+    """
+    for attempt in range(NEXAR_LIMITED_RETRIES + 1):
+        nexar_limiter.acquire()
+        response = requests.request(method, url, **kwargs)
+        if response.status_code not in (429, 503) or attempt == NEXAR_LIMITED_RETRIES:
+            return response
+        nexar_limiter.pause(_retry_after(response))
+        response.close()
+
+
+# Fetches in flight, by what they fetch, so identical concurrent fetches share one download.
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def coalesce(key, fetch):
+    """
+    Run fetch and return its result, unless a fetch with the same key is already running;
+    then wait for and share its result, or its exception.
+    """
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        owner = future is None
+        if owner:
+            future = _in_flight[key] = Future()
+    if not owner:
+        return future.result()
+
+    try:
+        result = fetch()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _in_flight_lock:
+            del _in_flight[key]
+
+
+def download_nexar_file(url, path, auth_token, progress=None):
+    """
+    Download a Nexar thumbnail or frame to path.
+    progress, if given, is called as described in stream_download.
+    """
+    headers = {
+        'Authorization': 'Bearer ' + auth_token,
+    }
+
+    # A second download of the same frame to the same path waits for the first.
+    coalesce(('file', url, path), lambda: stream_download(url, path, headers, progress=progress))
+
+
+def read_nexar_file(url, auth_token, attempts=DOWNLOAD_ATTEMPTS):
+    """
+    Download a Nexar thumbnail or frame into memory and return its bytes.
+
+    Thumbnails are small, so a failed attempt is retried from the start rather than resumed.
+    The body is checked against the Content-Length (and Content-MD5, when sent).
+    Concurrent reads of the same url share one download.
+    """
+    return coalesce(('read', url), lambda: _read_nexar_file(url, auth_token, attempts))
+
+
+def _read_nexar_file(url, auth_token, attempts):
+    headers = {
+        'Authorization': 'Bearer ' + auth_token,
+    }
+    error = None
+
+    for attempt in range(attempts):
+        try:
+            with nexar_request('GET', url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                expected = _expected_size(response, 0)
+                checksum = response.headers.get('Content-MD5')
+                data = response.content
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+            continue
+
+        if expected is not None and len(data) != expected:
+            error = IncompleteDownload(f'Received {len(data)} of {expected} bytes of {url}')
+            continue
+        if checksum and base64.b64encode(hashlib.md5(data).digest()).decode() != checksum:
+            raise IncompleteDownload(f'Checksum of {url} does not match Content-MD5')
+
+        return data
+
+    raise IncompleteDownload(f'Download of {url} failed after {attempts} attempts; {error}')
+
+
+def _expected_size(response, offset):
+    # Return the full size of the file being downloaded, or None if the server doesn't say.
+    # A compressed transfer is decoded while streamed, so its Content-Length doesn't match the file.
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range and not content_range.endswith('*'):
+        return int(content_range.rsplit('/', 1)[1])
+    if 'Content-Length' in response.headers:
+        return offset + int(response.headers['Content-Length'])
+    return None
+
+
+def _file_md5(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def stream_download(url, path, headers=None, attempts=DOWNLOAD_ATTEMPTS, progress=None):
+    """
+    Stream a download to path.
+
+    The body is written in chunks to a partial file next to path. After a dropped connection the
+    download resumes with a Range request from the end of the partial file. The partial file is
+    checked against the Content-Length (and Content-MD5, when sent) before it is renamed to path,
+    so path only ever holds a complete file.
+
+    progress, if given, is called with (partial_path, received, expected) after every chunk written,
+    expected being None when the size is unknown. The partial file is flushed first, so it can be read.
+    """
+    partial = path + PARTIAL_EXTENSION
+    error = None
+
+    for attempt in range(attempts):
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        request_headers = dict(headers or {})
+        if offset:
+            request_headers['Range'] = f'bytes={offset}-'
+
+        try:
+            with nexar_request('GET', url, headers=request_headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code == 416:
+                    # The partial file doesn't fit the file on the server any more; start over.
+                    os.remove(partial)
+                    continue
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    # The server ignored the range, and is sending the whole file.
+                    offset = 0
+                expected = _expected_size(response, offset)
+                checksum = response.headers.get('Content-MD5')
+
+                with open(partial, 'ab' if offset else 'wb') as f:
+                    received = offset
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        received += len(chunk)
+                        if progress is not None:
+                            f.flush()
+                            progress(partial, received, expected)
+
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+            continue
+
+        size = os.path.getsize(partial)
+        if expected is not None and size < expected:
+            error = IncompleteDownload(f'Received {size} of {expected} bytes of {url}')
+            continue
+        if expected is not None and size > expected:
+            os.remove(partial)
+            raise IncompleteDownload(f'Received {size} bytes of {url}, expecting {expected}')
+        if checksum and base64.b64encode(_file_md5(partial)).decode() != checksum:
+            os.remove(partial)
+            raise IncompleteDownload(f'Checksum of {url} does not match Content-MD5')
+
+        os.replace(partial, path)
+        return
+
+    raise IncompleteDownload(f'Download of {url} failed after {attempts} attempts; {error}')
+
+
+def split_s3_location(s3_location):
+    """
+    Return the file, bucket and key of a datalake s3_location, as used by the s3 helpers.
+    """
+    file = s3_location.split('/')[-1]
+    if s3_location.split('/')[-2] == 'Nexar':
+        bucket = 'ushr-image/Nexar'
+    else:
+        bucket = 'ushr-image'
+    key = file
+    return file, bucket, key
+
+
+def connect_to_db(db_region):
+    """
+    Return a connection to the datalake database of db_region, usable as a context manager.
+    """
+    # Imported here, so the rest of the module, and the stand-ins replacing this, work without the internal package.
+    import ushr.acorn.datalake.utils
+    return ushr.acorn.datalake.utils.connect_to_db(db_region)
+
+
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def db_connection(db_region):
+    """
+    Borrow a connection to the datalake database of db_region from its pool, connecting if none is idle.
+    Like a connection block, the transaction is committed when the block exits; on an error it is
+    rolled back and the connection closed, so a broken connection is never reused.
+    """
+    # Pools are kept per connect_to_db as well, so connections opened before a stand-in was installed aren't reused.
+    connect = connect_to_db
+    with _db_pools_lock:
+        pool = _db_pools.setdefault((connect, db_region), queue.LifoQueue())
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = connect(db_region)
+
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        try:
+            conn.rollback()
+            conn.close()
+        except Exception:
+            pass
+        raise
+
+    if pool.qsize() < DB_POOL_SIZE:
+        pool.put(conn)
+    else:
+        conn.close()
+
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+S3_TRANSFER_CONFIG = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD, multipart_chunksize=S3_PART_SIZE,
+                                    max_concurrency=S3_PART_CONCURRENCY)
+
+
+def s3_client():
+    """
+    Return the s3 client shared by every thread, with a connection pool large enough for concurrent transfers.
+    boto3 clients are thread safe; creating one per transfer costs more than many small transfers.
+    """
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            config = botocore.config.Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                                            connect_timeout=DOWNLOAD_TIMEOUT, read_timeout=DOWNLOAD_TIMEOUT,
+                                            retries={'max_attempts': DOWNLOAD_ATTEMPTS, 'mode': 'adaptive'})
+            _s3_client = boto3.session.Session().client('s3', config=config)
+        return _s3_client
+
+
+def _bucket_key(bucket, key):
+    # Buckets are given with a folder, as in 'ushr-image/Nexar'; s3 wants the folder in the key.
+    bucket, _, folder = bucket.partition('/')
+    if folder:
+        key = folder + '/' + key
+    return bucket, key
+
+
+def download_file(path, bucket, key):
+    """
+    Download an s3 object to path. The object is downloaded to a partial file first,
+    and renamed to path once complete, so path never holds a truncated object.
+    """
+    partial = path + PARTIAL_EXTENSION
+    bucket, key = _bucket_key(bucket, key)
+    try:
+        s3_client().download_file(bucket, key, partial, Config=S3_TRANSFER_CONFIG)
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, path)
+
+
+def read_file(bucket, key):
+    """
+    Download an s3 object into memory and return its bytes.
+    """
+    bucket, key = _bucket_key(bucket, key)
+    return s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+
+
+def upload_file(path, bucket, key):
+    """
+    Upload the file at path to s3.
+    """
+    bucket, key = _bucket_key(bucket, key)
+    s3_client().upload_file(path, bucket, key, Config=S3_TRANSFER_CONFIG)
+
+
+def fetch_image(sources, auth_token=None, progress=None):
+    """
+    Make an image available on disk from the first of its sources that has it, and return its path.
+
+    Parameters:
+    - sources: list of where the image may be found, in order of preference:
+      ('local', path) for a local cache file, ('s3', path, bucket, key) or ('nexar', path, url)
+      to download it to path.
+    - auth_token: str, the Nexar token, needed by 'nexar' sources.
+    - progress: called during a Nexar download, as described in stream_download.
+
+    Raise IncompleteDownload with the last error if no source has the image.
+    """
+    error = 'No source for the image.'
+    for source in sources:
+        kind, path = source[0], source[1]
+        try:
+            if kind == 'local':
+                # An image loaded in the background may still be on its way to disk.
+                disk_cache.wait(path)
+                if os.path.exists(path):
+                    return path
+                continue
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            if kind == 's3':
+                download_file(path, source[2], source[3])
+            else:
+                download_nexar_file(source[2], path, auth_token, progress=progress)
+            return path
+        except Exception as e:
+            error = f'{kind} download failed; {e}'
+    raise IncompleteDownload(error)
@@ -0,0 +1,187 @@
+"""
+Watchdog of the GUI event loop, recording the stalls that freeze the tool.
+
+A timer on the GUI thread beats every few milliseconds, and the delay of every beat past its interval
+is the event loop latency. A monitor thread checks the last beat; once the GUI thread has not beaten
+for longer than the stall threshold, it samples the GUI thread's stack, which names the handler
+still running. When the loop beats again, the stall is recorded with its duration, handler and stack.
+
+The watchdog runs whenever the tool runs, and is set with environment variables before it starts:
+    IMAGE_VIEWER_STALL_THRESHOLD_MS=200        # stalls shorter than this are not recorded; 0 turns the watchdog off
+    IMAGE_VIEWER_STALL_REPORT=stalls.json      # JSON report written when the tool closes, besides the log summary
+
+A summary, with the latency percentiles and the stalls per handler, is logged when the tool closes.
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict, deque
+
+import numpy as np
+from PyQt5 import QtCore
+
+log = logging.getLogger(__name__)
+
+# Milliseconds between beats of the GUI thread, and between checks of the monitor thread.
+BEAT_INTERVAL_MS = 20
+DEFAULT_THRESHOLD_MS = 200
+# Latencies kept for the percentiles, the most recent ones.
+LATENCY_SAMPLES = 100000
+# Stalls reported with their stacks, the longest ones.
+WORST_STALLS = 10
+
+
+def _handler(frame):
+    """
+    Return the name of the handler a stack sample is in: the outermost method called from the event
+    loop, such as MainWindow.download_image, or the innermost function if no method is on the stack.
+    """
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    if not frames:
+        return None
+    for frame in reversed(frames):
+        owner = frame.f_locals.get('self')
+        if owner is not None:
+            return f"{type(owner).__name__}.{frame.f_code.co_name}"
+    return frames[0].f_code.co_name
+
+
+class Watchdog(QtCore.QObject):
+    """
+    Measures the event loop latency of the thread it is created in, and records its stalls.
+    """
+
+    def __init__(self, threshold_ms=DEFAULT_THRESHOLD_MS, interval_ms=BEAT_INTERVAL_MS):
+        super().__init__()
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.thread_id = threading.get_ident()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.stalls = []
+        self.started = None
+        self.last_beat = None
+        # The stall in progress, with the stack sampled by the monitor, or None.
+        self.current = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.beat)
+        self.monitor = threading.Thread(target=self.watch, name='stall-watchdog', daemon=True)
+
+    def start(self):
+        self.started = self.last_beat = time.monotonic()
+        self.timer.start()
+        self.monitor.start()
+
+    def stop(self):
+        self.timer.stop()
+        self.stopped.set()
+
+    def beat(self):
+        # Runs on the GUI thread, whenever the event loop gets to the timer.
+        now = time.monotonic()
+        with self.lock:
+            latency = max(now - self.last_beat - self.interval, 0.0)
+            self.latencies.append(latency)
+            if latency >= self.threshold:
+                stall = self.current or {'handler': None, 'stack': []}
+                stall['started'] = self.last_beat + self.interval - self.started
+                stall['duration'] = latency
+                self.stalls.append(stall)
+            self.current = None
+            self.last_beat = now
+
+    def watch(self):
+        # Runs on the monitor thread. A stall is sampled once, as soon as it passes the threshold,
+        # so the stack shows the handler that caused it.
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                if self.current is not None or time.monotonic() - self.last_beat - self.interval < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self.thread_id)
+                self.current = {'handler': _handler(frame),
+                                'stack': traceback.format_list(traceback.extract_stack(frame)) if frame else []}
+
+    def summary(self):
+        """
+        Return a dict with the event loop latency percentiles, in ms, and the stalls per handler.
+        """
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            stalls = list(self.stalls)
+        handlers = defaultdict(lambda: {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        for stall in stalls:
+            entry = handlers[stall['handler'] or 'unknown']
+            entry['count'] += 1
+            entry['total_ms'] += stall['duration'] * 1000
+            entry['max_ms'] = max(entry['max_ms'], stall['duration'] * 1000)
+        worst = sorted(stalls, key=lambda stall: stall['duration'], reverse=True)[:WORST_STALLS]
+        return {
+            'threshold_ms': self.threshold * 1000,
+            'running_seconds': time.monotonic() - self.started if self.started else 0.0,
+            'latency_ms': {
+                'p50': float(np.percentile(latencies, 50)) if latencies.size else 0.0,
+                'p95': float(np.percentile(latencies, 95)) if latencies.size else 0.0,
+                'p99': float(np.percentile(latencies, 99)) if latencies.size else 0.0,
+                'max': float(latencies.max()) if latencies.size else 0.0,
+            },
+            'stalls': len(stalls),
+            'stalled_seconds': sum(stall['duration'] for stall in stalls),
+            'handlers': dict(sorted(handlers.items(), key=lambda item: item[1]['total_ms'], reverse=True)),
+            'worst': [{'handler': stall['handler'], 'started_seconds': stall['started'],
+                       'duration_ms': stall['duration'] * 1000, 'stack': stall['stack']} for stall in worst],
+        }
+
+    def report(self):
+        """
+        Return the summary as text.
+        """
+        summary = self.summary()
+        latency = summary['latency_ms']
+        lines = [f"Event loop latency p50 {latency['p50']:.1f} ms, p95 {latency['p95']:.1f} ms, "
+                 f"p99 {latency['p99']:.1f} ms, max {latency['max']:.1f} ms.",
+                 f"{summary['stalls']} stalls over {summary['threshold_ms']:.0f} ms, "
+                 f"{summary['stalled_seconds']:.1f} s of {summary['running_seconds']:.1f} s."]
+        for handler, entry in summary['handlers'].items():
+            lines.append(f"  {handler}: {entry['count']} stalls, {entry['total_ms']:.0f} ms total, "
+                         f"{entry['max_ms']:.0f} ms max")
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """
+        Write the summary to a JSON file.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def install_from_environment(app):
+    """
+    Start a watchdog of the event loop of app, as set by the IMAGE_VIEWER_STALL environment variables.
+    Its summary is logged, and written to the report file if set, when app quits.
+    Return the watchdog, or None if it is turned off.
+    """
+    threshold_ms = float(os.environ.get('IMAGE_VIEWER_STALL_THRESHOLD_MS', DEFAULT_THRESHOLD_MS))
+    if threshold_ms <= 0:
+        return None
+    report_path = os.environ.get('IMAGE_VIEWER_STALL_REPORT')
+    watchdog = Watchdog(threshold_ms)
+
+    def finish():
+        watchdog.stop()
+        (log.warning if watchdog.stalls else log.info)(watchdog.report())
+        if report_path:
+            watchdog.write(report_path)
+
+    app.aboutToQuit.connect(finish)
+    watchdog.start()
+    return watchdog
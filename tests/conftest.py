@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of the tool are run from the top of the repository, not installed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,129 @@
+import os
+import threading
+
+import pytest
+import requests
+
+import cache_daemon
+
+# Every stand-in object has this many bytes.
+SIZE = 100
+
+
+class Bucket:
+    """
+    Stands in for s3 in the daemon, writing an object of SIZE bytes for every key.
+    """
+
+    def __init__(self):
+        self.fetched = []
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.release.set()
+        self.error = None
+
+    def download_file(self, path, bucket, key):
+        with self.lock:
+            self.fetched.append(key)
+        self.release.wait(10)
+        if self.error is not None:
+            raise self.error
+        with open(path, 'wb') as f:
+            f.write(key.encode().ljust(SIZE, b'.'))
+
+
+@pytest.fixture
+def bucket():
+    return Bucket()
+
+
+@pytest.fixture
+def start(tmp_path, bucket):
+    daemons = []
+
+    def start(max_bytes=None):
+        daemon = cache_daemon.CacheDaemon(str(tmp_path / 'store'), port=0, max_bytes=max_bytes)
+        daemon.download_file = bucket.download_file
+        daemon.start()
+        daemons.append(daemon)
+        return daemon
+
+    yield start
+    for daemon in daemons:
+        daemon.stop()
+
+
+def get(daemon, key):
+    return requests.get(daemon.base_url + '/s3', params={'bucket': 'bucket', 'key': key}, timeout=10)
+
+
+def test_miss_then_hit(start, bucket):
+    daemon = start()
+    response = get(daemon, 'a.jpg')
+    assert response.status_code == 200
+    assert response.headers['X-Cache'] == 'miss'
+    assert response.content == b'a.jpg'.ljust(SIZE, b'.')
+    assert os.path.exists(response.headers['X-Cache-Path'])
+
+    response = get(daemon, 'a.jpg')
+    assert response.headers['X-Cache'] == 'hit'
+    assert response.content == b'a.jpg'.ljust(SIZE, b'.')
+    assert bucket.fetched == ['a.jpg']
+    summary = daemon.summary()
+    assert (summary['hits'], summary['misses'], summary['fetched']) == (1, 1, 1)
+    assert summary['bytes_served'] == 2 * SIZE
+
+
+def test_concurrent_misses_share_a_fetch(start, bucket):
+    daemon = start()
+    bucket.release.clear()
+    responses = []
+    threads = [threading.Thread(target=lambda: responses.append(get(daemon, 'a.jpg'))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    # Let every request reach the daemon before the fetch finishes.
+    while daemon.summary()['misses'] < len(threads):
+        threading.Event().wait(0.01)
+    bucket.release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert [response.status_code for response in responses] == [200] * len(threads)
+    assert bucket.fetched == ['a.jpg']
+    assert daemon.summary()['fetched'] == 1
+
+
+def test_eviction_at_the_bound(start, bucket):
+    daemon = start(max_bytes=2 * SIZE)
+    paths = [get(daemon, key).headers['X-Cache-Path'] for key in ['a.jpg', 'b.jpg']]
+    # Served last, so b.jpg is the least recently served.
+    get(daemon, 'a.jpg')
+    paths.append(get(daemon, 'c.jpg').headers['X-Cache-Path'])
+
+    assert [os.path.exists(path) for path in paths] == [True, False, True]
+    summary = daemon.summary()
+    assert (summary['evicted'], summary['files'], summary['bytes']) == (1, 2, 2 * SIZE)
+    assert get(daemon, 'b.jpg').headers['X-Cache'] == 'miss'
+
+
+def test_evicted_file_is_still_served(start, bucket):
+    daemon = start(max_bytes=SIZE)
+    path = daemon.store_path('s3', 's3://bucket/a.jpg')
+    hit, f = daemon.get(path, lambda path: bucket.download_file(path, 'bucket', 'a.jpg'))
+    with f:
+        get(daemon, 'b.jpg')
+        assert not os.path.exists(path)
+        assert f.read() == b'a.jpg'.ljust(SIZE, b'.')
+    assert not hit
+
+
+def test_failed_fetch(start, bucket):
+    daemon = start()
+    bucket.error = OSError('No such key')
+    response = get(daemon, 'a.jpg')
+    assert response.status_code == 502
+    assert 'No such key' in response.text
+    assert daemon.summary()['failed'] == 1
+
+    bucket.error = None
+    assert get(daemon, 'a.jpg').status_code == 200
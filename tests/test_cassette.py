@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+import cassette
+import services
+
+FRAMES = json.dumps({'frames': [{'frame_url': 'https://nexar/frame.jpg'}]}).encode()
+IMAGE = bytes(range(256)) * 64
+TOKEN = 'live-access-token'
+
+
+def nexar_request(method, url, **kwargs):
+    """
+    Stands in for services.nexar_request, answering searches, downloads and token refreshes.
+    """
+    if url == services.NEXAR_REFRESH_TOKEN_URL:
+        content = json.dumps({'access_token': TOKEN, 'token_type': 'Bearer', 'expires_in': 3600}).encode()
+        return cassette.CassetteResponse(url, 200, {'Content-Length': str(len(content))}, content)
+    if url.endswith('.jpg'):
+        return cassette.CassetteResponse(url, 200, {'Content-Length': str(len(IMAGE))}, IMAGE)
+    return cassette.CassetteResponse(url, 200, {'Content-Type': 'application/json'}, FRAMES)
+
+
+def download_file(path, bucket, key):
+    with open(path, 'wb') as f:
+        f.write(IMAGE)
+
+
+@pytest.fixture
+def recorded(tmp_path):
+    # Record a session, and return the cassette path.
+    path = str(tmp_path / 'session.cassette')
+    recorder = cassette.Recorder(path)
+    request = recorder.wrap_nexar_request(nexar_request)
+
+    request('POST', services.NEXAR_REFRESH_TOKEN_URL, data={'refresh_token': 'secret'}).close()
+    assert request('POST', services.NEXAR_FRAMES_URL, json={'lat': 1.0}).content == FRAMES
+    with request('GET', 'https://nexar/frame.jpg', stream=True) as response:
+        assert b''.join(response.iter_content(1000)) == IMAGE
+    recorder.wrap_download_file(download_file)(str(tmp_path / 'download.jpg'), 'ushr-image', 'a.jpg')
+    recorder.close()
+    return path
+
+
+def test_round_trip(recorded, tmp_path):
+    player = cassette.Player(recorded)
+
+    response = player.nexar_request('POST', services.NEXAR_FRAMES_URL, json={'lat': 1.0})
+    assert response.status_code == 200
+    assert response.json() == json.loads(FRAMES)
+    # Matched loosely, as a request body holding the current time is.
+    assert player.nexar_request('POST', services.NEXAR_FRAMES_URL, json={'lat': 2.0}).content == FRAMES
+    with player.nexar_request('GET', 'https://nexar/frame.jpg', stream=True) as response:
+        assert b''.join(response.iter_content(1000)) == IMAGE
+
+    path = str(tmp_path / 'replayed.jpg')
+    player.download_file(path, 'ushr-image', 'a.jpg')
+    with open(path, 'rb') as f:
+        assert f.read() == IMAGE
+    player.close()
+
+
+def test_refresh_token_redacted(recorded):
+    with open(recorded, 'rb') as f:
+        assert TOKEN.encode() not in f.read()
+
+    player = cassette.Player(recorded)
+    response = player.nexar_request('POST', services.NEXAR_REFRESH_TOKEN_URL, data={'refresh_token': 'secret'})
+    data = response.json()
+    assert data['access_token'] == cassette.REDACTED
+    assert (data['token_type'], data['expires_in']) == ('Bearer', 3600)
+    assert 'Content-Length' not in response.headers
+    player.close()
+
+
+def test_unmatched_request(recorded):
+    player = cassette.Player(recorded)
+    with pytest.raises(cassette.CassetteMiss):
+        player.nexar_request('GET', 'https://nexar/other.jpg')
+    with pytest.raises(cassette.CassetteMiss):
+        player.read_file('ushr-image', 'b.jpg')
+    player.close()
@@ -0,0 +1,81 @@
+import pytest
+
+import comparison
+
+LATITUDE, LONGITUDE = 33.98343972, -84.21422089
+# About a meter of latitude, in degrees.
+METER = 1 / 111195
+
+
+def row(location, meters_north=0.0, vehicle_heading=None, image_heading=None, point=None):
+    # The columns of the datalake.camera_image query used for pairing: s3 location, geom and headings.
+    if point is None:
+        point = f'POINT({LONGITUDE} {LATITUDE + meters_north * METER})'
+    return (1, location, None, None, point, None, None, None, vehicle_heading, image_heading, None)
+
+
+def frame(frame_id, meters_north=0.0, heading=None, datalake_s3_location=None):
+    frame = {'frame_id': frame_id, 'gps_info': {'latitude': LATITUDE + meters_north * METER, 'longitude': LONGITUDE},
+             'camera_heading': heading}
+    if datalake_s3_location:
+        frame['datalake_s3_location'] = datalake_s3_location
+    return frame
+
+
+def test_no_results():
+    assert comparison.match_pairs([], []) == []
+    assert comparison.match_pairs([row('a')], []) == [(0, None, None)]
+    assert comparison.match_pairs([], [frame(1)]) == [(None, 0, None)]
+
+
+def test_ingested_frame_pairs_with_its_row():
+    # Even when its location would pair it with another row.
+    rows = [row('s3://a', meters_north=0), row('s3://b', meters_north=500)]
+    assert comparison.match_pairs(rows, [frame(1, datalake_s3_location='s3://b')]) == \
+        [(1, 0, 0.0), (0, None, None)]
+
+
+def test_nearest_pairs_first():
+    rows = [row('a', meters_north=10), row('b', meters_north=2)]
+    frames = [frame(1, meters_north=0), frame(2, meters_north=12)]
+    pairs = sorted(comparison.match_pairs(rows, frames), key=lambda pair: pair[2])
+    assert [(pair[0], pair[1]) for pair in pairs] == [(0, 1), (1, 0)]
+    assert [pair[2] for pair in pairs] == pytest.approx([2, 2], abs=0.01)
+
+
+def test_each_capture_in_one_pair():
+    rows = [row('a', meters_north=0), row('b', meters_north=1)]
+    pairs = comparison.match_pairs(rows, [frame(1, meters_north=0.5)])
+    assert [(pair[0], pair[1]) for pair in pairs] == [(0, 0), (1, None)]
+
+
+def test_too_far_apart():
+    limit = comparison.PAIR_DISTANCE_METERS
+    assert comparison.match_pairs([row('a')], [frame(1, meters_north=limit + 1)]) == [(0, None, None), (None, 0, None)]
+    assert comparison.match_pairs([row('a')], [frame(1, meters_north=limit + 1)], distance_meters=limit + 2)[0][:2] \
+        == (0, 0)
+
+
+def test_headings():
+    # Opposite headings aren't pairs; headings either side of north are.
+    assert comparison.match_pairs([row('a', image_heading=0)], [frame(1, heading=180)]) == \
+        [(0, None, None), (None, 0, None)]
+    assert comparison.match_pairs([row('a', image_heading=350)], [frame(1, heading=20)])[0][:2] == (0, 0)
+
+
+def test_vehicle_heading_without_image_heading():
+    assert comparison.match_pairs([row('a', vehicle_heading=180)], [frame(1, heading=0)]) == \
+        [(0, None, None), (None, 0, None)]
+    assert comparison.match_pairs([row('a', vehicle_heading=180, image_heading=0)], [frame(1, heading=0)])[0][:2] \
+        == (0, 0)
+
+
+def test_missing_headings_pair_on_distance():
+    assert comparison.match_pairs([row('a')], [frame(1, heading=90)])[0][:2] == (0, 0)
+    assert comparison.match_pairs([row('a', image_heading=90)], [frame(1)])[0][:2] == (0, 0)
+    assert comparison.match_pairs([row('a')], [frame(1)])[0][:2] == (0, 0)
+
+
+def test_row_without_location_is_unmatched():
+    assert comparison.match_pairs([row('a', point='POINT EMPTY')], [frame(1)]) == [(0, None, None), (None, 0, None)]
+
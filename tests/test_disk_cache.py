@@ -0,0 +1,52 @@
+import logging
+import os
+
+import pytest
+
+import disk_cache
+import thumbnail_pack
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    yield
+    thumbnail_pack.close()
+
+
+def test_write_and_read():
+    path = os.path.join('full_images', 'a.jpg')
+    disk_cache.write_async(path, b'image')
+    assert disk_cache.exists(path)
+    assert disk_cache.read(path) == b'image'
+    disk_cache.wait(path)
+    with open(path, 'rb') as f:
+        assert f.read() == b'image'
+    assert not os.path.exists(path + '.tmp')
+    assert disk_cache.pending() == (0, 0)
+
+
+def test_packed_paths():
+    path = os.path.join('thumbnails', 'a.jpg')
+    disk_cache.write_async(path, b'thumbnail')
+    disk_cache.wait(path)
+    assert not os.path.exists(path)
+    assert disk_cache.read(path) == b'thumbnail'
+    assert disk_cache.exists(path)
+
+
+def test_missing():
+    assert disk_cache.read(os.path.join('full_images', 'missing.jpg')) is None
+    assert not disk_cache.exists(os.path.join('full_images', 'missing.jpg'))
+
+
+def test_failed_write_is_logged(caplog):
+    # A file where the directory should be.
+    with open('full_images', 'wb') as f:
+        f.write(b'')
+    path = os.path.join('full_images', 'a.jpg')
+    with caplog.at_level(logging.WARNING, logger='disk_cache'):
+        disk_cache.write_async(path, b'image')
+        disk_cache.wait(path)
+    assert f'Could not cache {path}' in caplog.text
+    assert not disk_cache.exists(path)
@@ -0,0 +1,70 @@
+import math
+
+import numpy as np
+import pytest
+
+import geodesy
+
+METERS_PER_DEGREE = math.radians(1) * geodesy.EARTH_RADIUS_METERS
+
+
+def test_distance_meters():
+    assert geodesy.distance_meters(0, 0, [0], [0])[0] == 0
+    assert geodesy.distance_meters(0, 0, [1], [0])[0] == pytest.approx(METERS_PER_DEGREE)
+    # A degree of longitude shrinks with the cosine of the latitude.
+    assert geodesy.distance_meters(60, 0, [60], [1])[0] == pytest.approx(METERS_PER_DEGREE / 2, rel=1e-4)
+
+
+def test_distance_across_antimeridian():
+    assert geodesy.distance_meters(0, 179.9995, [0], [-179.9995])[0] == pytest.approx(0.001 * METERS_PER_DEGREE)
+
+
+def test_distance_over_pole():
+    assert geodesy.distance_meters(89.999, 0, [89.999], [180])[0] == pytest.approx(0.002 * METERS_PER_DEGREE)
+
+
+@pytest.mark.parametrize('latitude', [0, 33.98, -45, 80, -89])
+def test_bounding_box_contains_circle(latitude):
+    radius = 1000
+    south, west, north, east = geodesy.bounding_box(latitude, 10, radius)
+    assert north - latitude == pytest.approx(radius / METERS_PER_DEGREE)
+    assert latitude - south == pytest.approx(radius / METERS_PER_DEGREE)
+    # The points of the circle furthest east and west are within the box, and on its edges.
+    bearings = np.radians(np.arange(0, 360, 0.5))
+    angle = radius / geodesy.EARTH_RADIUS_METERS
+    lat = math.radians(latitude)
+    latitudes = np.arcsin(np.sin(lat) * np.cos(angle) + np.cos(lat) * np.sin(angle) * np.cos(bearings))
+    longitudes = 10 + np.degrees(np.arctan2(np.sin(bearings) * np.sin(angle) * np.cos(lat),
+                                            np.cos(angle) - np.sin(lat) * np.sin(latitudes)))
+    assert longitudes.max() <= east + 1e-9 and longitudes.max() == pytest.approx(east, abs=1e-6)
+    assert longitudes.min() >= west - 1e-9 and longitudes.min() == pytest.approx(west, abs=1e-6)
+
+
+def test_bounding_box_widens_with_latitude():
+    _, west, _, east = geodesy.bounding_box(80, 0, 1000)
+    assert east - west == pytest.approx(2 * 1000 / METERS_PER_DEGREE / math.cos(math.radians(80)), rel=1e-3)
+
+
+@pytest.mark.parametrize('latitude', [89.995, -89.995])
+def test_bounding_box_over_pole(latitude):
+    south, west, north, east = geodesy.bounding_box(latitude, 45, 1000)
+    assert (west, east) == (-180.0, 180.0)
+    assert -90 <= south < latitude < north <= 90
+    assert north == 90.0 if latitude > 0 else south == -90.0
+
+
+def test_bounding_box_of_hemisphere():
+    assert geodesy.bounding_box(0, 0, math.pi / 2 * geodesy.EARTH_RADIUS_METERS)[1:4:2] == (-180.0, 180.0)
+
+
+def test_bounding_box_across_antimeridian():
+    # Longitudes aren't wrapped: the box reaches past 180 by the same extent as on the other side.
+    south, west, north, east = geodesy.bounding_box(0, 179.999, 1000)
+    assert east > 180
+    assert east - 179.999 == pytest.approx(179.999 - west)
+
+
+def test_within_radius():
+    keep = geodesy.within_radius(0, 179.9995, 200, [0, 0, np.nan, 1], [-179.9995, 179.99, np.nan, 179.9995])
+    # Across the antimeridian, too far, unknown and too far.
+    assert list(keep) == [True, False, True, False]
@@ -0,0 +1,121 @@
+import os
+import threading
+
+import pytest
+
+import ingest
+import known_frames
+import services
+
+LATITUDE, LONGITUDE = 33.98343972, -84.21422089
+
+
+class Connection:
+    """
+    Stands in for a datalake connection, recording the values inserted.
+    """
+
+    def __init__(self, inserted):
+        self.inserted = inserted
+
+    def cursor(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+    def execute(self, sql, values):
+        self.inserted.append(values)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def frame(frame_id, **changes):
+    frame = {'frame_id': frame_id, 'frame_url': f'https://nexar.example/frames/{frame_id}.jpg',
+             'gps_info': {'latitude': LATITUDE, 'longitude': LONGITUDE},
+             'captured_at': 1700000000000 + frame_id, 'camera_heading': 90.0}
+    frame.update(changes)
+    return frame
+
+
+@pytest.fixture
+def stand_ins(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    inserted = []
+    uploaded = []
+
+    def download_nexar_file(url, path, auth_token, progress=None):
+        with open(path, 'wb') as f:
+            f.write(b'image')
+
+    monkeypatch.setattr(ingest, 'refresh_auth_token', lambda: ('token', 3600.0))
+    monkeypatch.setattr(services, 'download_nexar_file', download_nexar_file)
+    monkeypatch.setattr(services, 'upload_file', lambda path, bucket, key: uploaded.append(key))
+    monkeypatch.setattr(services, 'connect_to_db', lambda db_region: Connection(inserted))
+    monkeypatch.setattr(ingest.thumbnails, 'upload_thumbnail', lambda path, bucket, key: None)
+    monkeypatch.setattr(known_frames, 'query_datalake', lambda frame_ids, db_regions: {})
+    monkeypatch.setattr(known_frames, 'update', lambda known: None)
+    return inserted, uploaded
+
+
+def run(frames, tmp_path, **kwargs):
+    checkpoint = ingest.Checkpoint(str(tmp_path / 'checkpoint.sqlite'))
+    ingestion = ingest.Ingestion(LATITUDE, LONGITUDE, 100, 0, 1, checkpoint, db_region='test',
+                                 download_workers=2, upload_workers=2, **kwargs)
+    ingestion.search = lambda start_time, end_time: frames
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(ingestion.run(report=lambda msg: None)), daemon=True)
+    thread.start()
+    thread.join(30)
+    checkpoint.close()
+    assert not thread.is_alive(), 'the ingestion did not finish'
+    return result
+
+
+def test_run(stand_ins, tmp_path):
+    inserted, uploaded = stand_ins
+    os.makedirs('full_images')
+    with open(os.path.join('full_images', '2.jpg'), 'wb') as f:
+        f.write(b'cached')
+
+    counts = run([frame(1), frame(2)], tmp_path)
+    assert counts['ingested'] == 2 and counts['failed'] == 0
+    assert sorted(uploaded) == ['1.jpg', '2.jpg']
+    assert sorted(values[2] for values in inserted) == ['nexar:1', 'nexar:2']
+    # The image downloaded by the run is removed once inserted; the one cached before it is kept.
+    assert os.listdir('full_images') == ['2.jpg']
+
+
+def test_run_finishes_past_bad_frames(stand_ins, tmp_path):
+    inserted, uploaded = stand_ins
+    frames = [frame(1), frame(2, camera_heading=None), frame(3, frame_url=None), frame(4)]
+    counts = run(frames, tmp_path)
+    assert counts['ingested'] == 2
+    assert counts['failed'] == 2
+    # The frame without a heading can't be inserted, so it isn't uploaded either.
+    assert sorted(uploaded) == ['1.jpg', '4.jpg']
+
+
+def test_run_finishes_without_a_token(stand_ins, tmp_path, monkeypatch):
+    tokens = iter([('token', 0.0)])
+
+    def refresh_auth_token():
+        # The first token expires at once, and refreshing it fails.
+        for token in tokens:
+            return token
+        raise OSError('refresh failed')
+
+    monkeypatch.setattr(ingest, 'refresh_auth_token', refresh_auth_token)
+    counts = run([frame(1), frame(2)], tmp_path)
+    assert counts['ingested'] == 0
+    assert counts['failed'] == 2
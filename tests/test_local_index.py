@@ -0,0 +1,60 @@
+import pytest
+
+import local_index
+
+START = 1_700_000_000_000
+
+
+@pytest.fixture(autouse=True)
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(local_index, 'INDEX_PATH', str(tmp_path / 'local_index.sqlite'))
+    yield
+    local_index.close()
+
+
+def frames(*captured_at):
+    return [{'frame_id': n, 'captured_at': value} for n, value in enumerate(captured_at)]
+
+
+def test_area_key_ignores_direction_order():
+    assert local_index.area_key(33.1, -84.2, 100, ['NORTH', 'SOUTH'], 0.5) == \
+        local_index.area_key(33.1, -84.2, 100, ['SOUTH', 'NORTH'], 0.5)
+    assert local_index.area_key(33.1, -84.2, 100, ['NORTH'], 0.5) != \
+        local_index.area_key(33.1, -84.2, 100, ['NORTH'], 0.7)
+
+
+def test_watermark_of_unsearched_area():
+    assert local_index.watermark('area') is None
+
+
+def test_first_search_sets_watermark():
+    assert local_index.advance_watermark('area', START, frames(START + 5, START + 9, None)) == (START, START + 9)
+    assert local_index.watermark('area') == (START, START + 9)
+
+
+def test_search_without_frames_leaves_watermark():
+    assert local_index.advance_watermark('area', START, []) is None
+    assert local_index.watermark('area') is None
+
+
+def test_continued_search_keeps_start():
+    mark = local_index.advance_watermark('area', START, frames(START + 9))
+    assert local_index.advance_watermark('area', START + 1, frames(START + 20), mark) == (START, START + 20)
+    # Nothing new since the watermark.
+    assert local_index.advance_watermark('area', START + 1, [], (START, START + 20)) == (START, START + 20)
+    assert local_index.watermark('area') == (START, START + 20)
+
+
+def test_full_search_replaces_watermark():
+    local_index.advance_watermark('area', START, frames(START + 9))
+    local_index.advance_watermark('area', START + 100, frames(START + 150))
+    assert local_index.watermark('area') == (START + 100, START + 150)
+
+
+def test_truncated_search_leaves_watermark():
+    assert local_index.advance_watermark('area', START, frames(START + 9), truncated=True) is None
+    assert local_index.watermark('area') is None
+
+    mark = local_index.advance_watermark('area', START, frames(START + 9))
+    assert local_index.advance_watermark('area', START, frames(START + 50), mark, truncated=True) == mark
+    assert local_index.watermark('area') == (START, START + 9)
@@ -0,0 +1,58 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+import phash
+
+
+def image(pixels):
+    buffer = io.BytesIO()
+    Image.fromarray(np.asarray(pixels, dtype=np.uint8)).save(buffer, format='PNG')
+    buffer.seek(0)
+    return buffer
+
+
+def scene(width=320, height=180, seed=0):
+    # A smooth random scene, so its low frequencies carry the structure the hash records.
+    rng = np.random.default_rng(seed)
+    coarse = rng.uniform(0, 255, (9, 16))
+    rows = np.linspace(0, 8, height)[:, None]
+    columns = np.linspace(0, 15, width)[None, :]
+    return coarse[rows.round().astype(int), columns.round().astype(int)] * 0.5 + \
+        np.add.outer(np.linspace(0, 60, height), np.linspace(0, 60, width))
+
+
+def test_hamming_distances():
+    assert list(phash.hamming_distances(0, [0, 1, 0b1011, 2 ** 64 - 1, 2 ** 63])) == [0, 1, 3, 64, 1]
+    assert list(phash.hamming_distances(2 ** 64 - 1, [2 ** 64 - 1, 0])) == [0, 64]
+    assert list(phash.hamming_distances(0xF0F0, np.array([[0x0F0F], [0xF0F0]], dtype=np.uint64))) == [16, 0]
+
+
+def test_hamming_distances_empty():
+    assert len(phash.hamming_distances(5, [])) == 0
+
+
+def test_hamming_distance_is_symmetric():
+    rng = np.random.default_rng(1)
+    a, b = (int(value) for value in rng.integers(0, 2 ** 63, 2, dtype=np.uint64))
+    assert phash.hamming_distances(a, [b])[0] == phash.hamming_distances(b, [a])[0] == bin(a ^ b).count('1')
+
+
+def test_image_hash_of_near_duplicates():
+    pixels = scene()
+    original = phash.image_hash(image(pixels))
+    assert 0 <= original < 2 ** 64
+    # Resized and slightly brightened, as the same view on another pass.
+    changed = Image.fromarray(np.clip(pixels * 1.05 + 5, 0, 255).astype(np.uint8)).resize((160, 90))
+    buffer = io.BytesIO()
+    changed.save(buffer, format='JPEG', quality=70)
+    buffer.seek(0)
+    assert phash.hamming_distances(original, [phash.image_hash(buffer)])[0] <= phash.DUPLICATE_DISTANCE
+
+
+def test_image_hash_of_different_images():
+    hashes = [phash.image_hash(image(scene(seed=seed))) for seed in range(4)]
+    for n, value in enumerate(hashes):
+        others = hashes[:n] + hashes[n + 1:]
+        assert min(phash.hamming_distances(value, others)) > phash.DUPLICATE_DISTANCE
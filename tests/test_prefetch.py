@@ -0,0 +1,75 @@
+import pytest
+
+import prefetch
+
+LATITUDE, LONGITUDE = 33.98343972, -84.21422089
+# About a meter of latitude, in degrees.
+METER = 1 / 111195
+
+
+class Clock:
+    """
+    Stands in for the time module in prefetch.
+    """
+
+    def __init__(self):
+        self.now = 10000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def test_predict_needs_two_searches():
+    assert prefetch.predict([]) == []
+    assert prefetch.predict([(LATITUDE, LONGITUDE, 100)]) == []
+
+
+def test_predict_repeated_search():
+    assert prefetch.predict([(LATITUDE, LONGITUDE, 100), (LATITUDE, LONGITUDE, 100)]) == []
+
+
+def test_predict_walk():
+    history = [(LATITUDE, LONGITUDE, 100), (LATITUDE + 0.001, LONGITUDE - 0.002, 100)]
+    predicted = prefetch.predict(history)
+    assert len(predicted) == prefetch.PREFETCH_STEPS
+    assert predicted[0] == pytest.approx((LATITUDE + 0.002, LONGITUDE - 0.004, 100))
+    assert predicted[1] == pytest.approx((LATITUDE + 0.003, LONGITUDE - 0.006, 100))
+    assert len(prefetch.predict(history, steps=4)) == 4
+
+
+def test_predict_only_from_last_two_searches():
+    history = [(LATITUDE - 1, LONGITUDE, 100), (LATITUDE, LONGITUDE, 100), (LATITUDE, LONGITUDE + 0.001, 100)]
+    assert prefetch.predict(history, steps=1) == [pytest.approx((LATITUDE, LONGITUDE + 0.002, 100))]
+
+
+def test_predict_uses_latest_radius():
+    history = [(LATITUDE, LONGITUDE, 50), (LATITUDE + 100 * METER, LONGITUDE, 200)]
+    assert all(area[2] == 200 for area in prefetch.predict(history))
+
+
+def test_predict_jump():
+    radius = 100
+    limit = prefetch.MAX_STEP_RADII * radius
+    walk = [(LATITUDE, LONGITUDE, radius), (LATITUDE + (limit - 10) * METER, LONGITUDE, radius)]
+    jump = [(LATITUDE, LONGITUDE, radius), (LATITUDE + (limit + 10) * METER, LONGITUDE, radius)]
+    assert len(prefetch.predict(walk)) == prefetch.PREFETCH_STEPS
+    assert prefetch.predict(jump) == []
+    # The same step is a walk with a larger radius.
+    assert len(prefetch.predict([(LATITUDE, LONGITUDE, radius), jump[1][:2] + (radius * 2,)])) == \
+        prefetch.PREFETCH_STEPS
+
+
+def test_budget(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(prefetch, 'time', clock)
+    budget = prefetch.Budget(requests_per_hour=3, bytes_per_hour=1000)
+    assert budget.allows()
+    budget.spend(2, 100)
+    assert budget.allows()
+    budget.spend(1, 100)
+    assert not budget.allows()
+    # Spends older than an hour no longer count.
+    clock.now += 3601
+    assert budget.allows()
+    budget.spend(0, 1000)
+    assert not budget.allows()
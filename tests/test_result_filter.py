@@ -0,0 +1,109 @@
+from datetime import datetime as dt
+
+import numpy as np
+
+import result_filter
+
+LATITUDE, LONGITUDE = 33.98343972, -84.21422089
+
+
+def frame(frame_id, latitude=LATITUDE, longitude=LONGITUDE, heading=0.0, captured_at=None, quality=None,
+          direction=None):
+    return {'frame_id': frame_id, 'gps_info': {'latitude': latitude, 'longitude': longitude},
+            'camera_heading': heading, 'captured_at': captured_at, 'frame_quality': quality, 'direction': direction}
+
+
+def row(point, captured_at=None, heading=None):
+    # The columns of the datalake.camera_image query used by the filter: geom text, datetime and vehicle heading.
+    return (1, 's3://bucket/image.jpg', None, None, point, None, None, captured_at, heading, None, None)
+
+
+def test_parse_point():
+    assert result_filter.parse_point('POINT(-84.21 33.98)') == (-84.21, 33.98)
+    assert np.isnan(result_filter.parse_point(None)).all()
+    assert np.isnan(result_filter.parse_point('POINT EMPTY')).all()
+    assert np.isnan(result_filter.parse_point('POINT(-84.21)')).all()
+
+
+def test_heading_directions_sector_edges():
+    directions = result_filter.heading_directions([0, 22.4, 22.5, 359.9, -10, 180, 720 + 90, np.nan])
+    assert list(directions) == ['NORTH', 'NORTH', 'NORTH_EAST', 'NORTH', 'NORTH', 'SOUTH', 'EAST', '']
+
+
+def test_nexar_columns_prefers_reported_direction():
+    columns = result_filter.nexar_columns([frame(1, heading=90, direction='WEST'), frame(2, heading=90),
+                                           frame(3, heading=None, captured_at=None, quality='bad')])
+    assert list(columns['direction']) == ['WEST', 'EAST', '']
+    assert np.isnan(columns['heading'][2])
+    assert np.isnan(columns['captured_at'][2])
+    assert np.isnan(columns['quality'][2])
+
+
+def test_datalake_rows_columns():
+    columns = result_filter.datalake_rows_columns([row('POINT(-84.2 33.9)', dt(2024, 1, 1), 180.0),
+                                                   row(None)])
+    assert columns['longitude'][0] == -84.2 and columns['latitude'][0] == 33.9
+    assert columns['captured_at'][0] == dt(2024, 1, 1).timestamp()
+    assert list(columns['direction']) == ['SOUTH', '']
+    assert np.isnan(columns['latitude'][1]) and np.isnan(columns['captured_at'][1])
+    assert np.isnan(columns['quality']).all()
+
+
+def test_empty_results():
+    columns = result_filter.nexar_columns([])
+    assert len(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE, directions=['NORTH'], max_distance=10,
+                                             sort_by=result_filter.SORT_NEAREST_FIRST)) == 0
+
+
+def test_filter_keeps_unknown_values():
+    columns = result_filter.nexar_columns([frame(1, captured_at=1000_000, quality=0.9),
+                                           frame(2, captured_at=None, quality=None),
+                                           frame(3, captured_at=5000_000, quality=0.2)])
+    indices = result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE, start_time=500, end_time=2000,
+                                            min_quality=0.5)
+    assert list(indices) == [0, 1]
+
+
+def test_filter_time_window_is_inclusive():
+    columns = result_filter.nexar_columns([frame(n, captured_at=n * 1000) for n in range(5)])
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE, start_time=1, end_time=3)) == [1, 2, 3]
+
+
+def test_filter_directions_and_distance():
+    columns = result_filter.nexar_columns([frame(1, heading=0), frame(2, heading=180),
+                                           frame(3, latitude=LATITUDE + 0.01, heading=0)])
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE, directions={'NORTH'})) == [0, 2]
+    # 0.01 degrees of latitude is about 1.1 km.
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE, max_distance=1000)) == [0, 1]
+    # No directions, or a distance of 0, don't filter.
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE, directions=[], max_distance=0)) == \
+        [0, 1, 2]
+
+
+def test_sort_is_stable_with_unknown_values_last():
+    columns = result_filter.nexar_columns([frame(0, captured_at=2000), frame(1, captured_at=None),
+                                           frame(2, captured_at=3000), frame(3, captured_at=2000)])
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE,
+                                              sort_by=result_filter.SORT_NEWEST_FIRST)) == [2, 0, 3, 1]
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE,
+                                              sort_by=result_filter.SORT_OLDEST_FIRST)) == [0, 3, 2, 1]
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE,
+                                              sort_by=result_filter.SORT_AS_RETURNED)) == [0, 1, 2, 3]
+
+
+def test_sort_nearest_and_best_quality():
+    columns = result_filter.nexar_columns([frame(0, latitude=LATITUDE + 0.002, quality=0.5),
+                                           frame(1, latitude=LATITUDE + 0.001, quality=None),
+                                           frame(2, latitude=np.nan, longitude=np.nan, quality=0.9)])
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE,
+                                              sort_by=result_filter.SORT_NEAREST_FIRST)) == [1, 0, 2]
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE,
+                                              sort_by=result_filter.SORT_BEST_QUALITY_FIRST)) == [2, 0, 1]
+
+
+def test_filter_directions_keeps_unknown_headings():
+    columns = result_filter.nexar_columns([frame(1, heading=0), frame(2, heading=None), frame(3, heading=180)])
+    assert list(result_filter.filter_and_sort(columns, LATITUDE, LONGITUDE, directions=['SOUTH'])) == [1, 2]
+    columns = result_filter.datalake_rows_columns([row('POINT(-84.2 33.9)', heading=None),
+                                                   row('POINT(-84.2 33.9)', heading=90.0)])
+    assert list(result_filter.filter_and_sort(columns, 33.9, -84.2, directions=['NORTH'])) == [0]
@@ -0,0 +1,92 @@
+import pytest
+
+import known_frames
+import local_index
+import regions
+import search
+import services
+
+LATITUDE, LONGITUDE = 33.98343972, -84.21422089
+# About a meter of latitude, in degrees.
+METER = 1 / 111195
+START = 1_700_000_000_000
+END = START + 86400_000
+
+
+class Nexar:
+    """
+    Stands in for services.nexar_request, answering frame searches with the frames given.
+    """
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.requests = []
+
+    def __call__(self, method, url, **kwargs):
+        self.requests.append(kwargs['json'])
+        return self
+
+    def json(self):
+        return {'frames': [dict(frame) for frame in self.frames]}
+
+
+def frame(frame_id, meters_north, captured_at, direction='NORTH'):
+    return {'frame_id': frame_id, 'captured_at': captured_at, 'direction': direction, 'frame_quality': 0.9,
+            'gps_info': {'latitude': LATITUDE + meters_north * METER, 'longitude': LONGITUDE}}
+
+
+@pytest.fixture(autouse=True)
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(local_index, 'INDEX_PATH', str(tmp_path / 'local_index.sqlite'))
+    monkeypatch.setattr(known_frames, 'lookup', lambda frame_ids: {'2': 's3://ushr-image/Nexar/2.jpg'})
+    monkeypatch.setattr(known_frames, 'query_datalake', lambda frame_ids, db_regions: {})
+    monkeypatch.setattr(regions, 'regions_for_box', lambda *box: ['standin'])
+    yield
+    local_index.close()
+
+
+def run(nexar, monkeypatch, **kwargs):
+    monkeypatch.setattr(services, 'nexar_request', nexar)
+    messages = []
+    data = search.search_nexar(LATITUDE, LONGITUDE, 100, 'token', START, END, 0.5, ['NORTH'],
+                               status=messages.append, **kwargs)
+    return data, messages
+
+
+def test_search_nexar(monkeypatch):
+    # Frame 3 is in a corner of the box, outside the radius.
+    nexar = Nexar([frame(1, 10, START + 1), frame(2, 50, START + 2), frame(3, 99, START + 3)])
+    nexar.frames[2]['gps_info']['longitude'] += 99 * METER
+    data, messages = run(nexar, monkeypatch)
+
+    assert [f['frame_id'] for f in data['frames']] == [1, 2]
+    assert data['frames'][1]['datalake_s3_location'] == 's3://ushr-image/Nexar/2.jpg'
+    assert 'datalake_s3_location' not in data['frames'][0]
+    assert "Dropped 1 of 3 Nexar frames outside the search radius." in messages
+    assert "1 of 2 Nexar frames are already in the Datalake." in messages
+
+    filters = nexar.requests[0]['filters']
+    assert (filters['start_time'], filters['end_time'], filters['directions']) == (START, END, ['NORTH'])
+    box = nexar.requests[0]['bounding_box']
+    assert box['south_west']['latitude'] < LATITUDE < box['north_east']['latitude']
+    assert len(local_index.search(local_index.NEXAR, LATITUDE, LONGITUDE, 100, cached_only=False)) == 2
+
+
+def test_search_nexar_incremental(monkeypatch):
+    run(Nexar([frame(1, 10, START + 1000)]), monkeypatch, incremental=True)
+
+    nexar = Nexar([frame(4, 20, START + 5000)])
+    data, messages = run(nexar, monkeypatch, incremental=True)
+    # Only the frames captured since the newest one seen are requested; the rest come from the index.
+    assert nexar.requests[0]['filters']['start_time'] == START + 1001
+    assert sorted(f['frame_id'] for f in data['frames']) == [1, 4]
+    assert "1 new Nexar frames, and 1 from earlier searches of this area." in messages
+
+
+def test_search_nexar_not_incremental(monkeypatch):
+    run(Nexar([frame(1, 10, START + 1000)]), monkeypatch)
+
+    nexar = Nexar([frame(1, 10, START + 1000)])
+    data, messages = run(nexar, monkeypatch)
+    assert nexar.requests[0]['filters']['start_time'] == START
+    assert [f['frame_id'] for f in data['frames']] == [1]
@@ -0,0 +1,284 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import services
+
+
+class Clock:
+    """
+    Stands in for the time module in services: sleeping advances the clock at once.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+        self.slept += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(services, 'time', clock)
+    return clock
+
+
+def test_token_bucket_burst(clock):
+    bucket = services.TokenBucket(rate=10, burst=5)
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.slept == 0
+    assert bucket.available() == 0
+    # Past the burst, each request waits for the next token.
+    bucket.acquire()
+    assert clock.slept == pytest.approx(0.1)
+    bucket.acquire()
+    assert clock.slept == pytest.approx(0.2)
+
+
+def test_token_bucket_refill(clock):
+    bucket = services.TokenBucket(rate=10, burst=5)
+    for _ in range(5):
+        bucket.acquire()
+    clock.now += 0.25
+    assert bucket.available() == pytest.approx(2.5)
+    # Tokens don't pile up past the burst while idle.
+    clock.now += 60
+    assert bucket.available() == 5
+    for _ in range(5):
+        bucket.acquire()
+    assert clock.slept == 0
+
+
+def test_token_bucket_burst_of_at_least_one(clock):
+    bucket = services.TokenBucket(rate=2, burst=0)
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.slept == pytest.approx(0.5)
+
+
+def test_token_bucket_without_rate(clock):
+    bucket = services.TokenBucket(rate=0, burst=5)
+    for _ in range(100):
+        bucket.acquire()
+    assert clock.slept == 0
+    assert bucket.available() == 5
+
+
+def test_token_bucket_pause(clock):
+    bucket = services.TokenBucket(rate=10, burst=5)
+    bucket.pause(3)
+    assert bucket.available() == 0
+    bucket.acquire()
+    # Held for the pause, then for the first token to refill after it.
+    assert clock.slept == pytest.approx(3.1)
+    # A shorter pause doesn't cut a longer one short.
+    bucket.pause(5)
+    bucket.pause(1)
+    before = clock.slept
+    bucket.acquire()
+    assert clock.slept - before == pytest.approx(5.1)
+
+
+def test_coalesce_shares_one_fetch():
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'data'
+
+    results = []
+    owner = threading.Thread(target=lambda: results.append(services.coalesce(('test', 'shared'), fetch)))
+    owner.start()
+    started.wait(5)
+    waiters = [threading.Thread(target=lambda: results.append(services.coalesce(('test', 'shared'), fetch)))
+               for _ in range(3)]
+    for thread in waiters:
+        thread.start()
+    # Let the waiters reach the fetch in flight.
+    time.sleep(0.2)
+    release.set()
+    for thread in [owner] + waiters:
+        thread.join(5)
+
+    assert results == ['data'] * 4
+    assert len(calls) == 1
+    assert ('test', 'shared') not in services._in_flight
+
+
+def test_coalesce_shares_exception():
+    started = threading.Event()
+    release = threading.Event()
+
+    def fetch():
+        started.set()
+        release.wait(5)
+        raise OSError('failed')
+
+    errors = []
+
+    def call():
+        try:
+            services.coalesce(('test', 'failing'), fetch)
+        except OSError as e:
+            errors.append(e)
+
+    owner = threading.Thread(target=call)
+    owner.start()
+    started.wait(5)
+    waiter = threading.Thread(target=call)
+    waiter.start()
+    time.sleep(0.2)
+    release.set()
+    owner.join(5)
+    waiter.join(5)
+
+    assert [str(e) for e in errors] == ['failed', 'failed']
+    # The next call fetches again.
+    assert services.coalesce(('test', 'failing'), lambda: 'retried') == 'retried'
+
+
+def test_coalesce_keys_apart():
+    assert services.coalesce(('test', 'a'), lambda: 'a') == 'a'
+    assert services.coalesce(('test', 'b'), lambda: 'b') == 'b'
+    assert services.coalesce(('test', 'a'), lambda: 'again') == 'again'
+
+
+CONTENT = bytes(range(256)) * 40
+
+
+class FileServer:
+    """
+    Stands in for the Nexar file server, serving CONTENT with Range support.
+    ignore_range sends the whole file for a Range request; truncate is how many responses
+    are cut off halfway through the body.
+    """
+
+    def __init__(self):
+        self.ranges = []
+        self.ignore_range = False
+        self.truncate = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                requested = self.headers.get('Range')
+                server.ranges.append(requested)
+                start = 0
+                if requested and not server.ignore_range:
+                    start = int(requested.removeprefix('bytes=').rstrip('-'))
+                    if start >= len(CONTENT):
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{len(CONTENT)}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}')
+                else:
+                    self.send_response(200)
+                body = CONTENT[start:]
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if server.truncate:
+                    server.truncate -= 1
+                    body = body[:len(body) // 2]
+                    self.close_connection = True
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/frame.jpg'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def file_server():
+    server = FileServer()
+    yield server
+    server.stop()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_stream_download(file_server, tmp_path):
+    path = str(tmp_path / 'frame.jpg')
+    services.stream_download(file_server.url, path)
+    assert read(path) == CONTENT
+    assert file_server.ranges == [None]
+    assert not (tmp_path / ('frame.jpg' + services.PARTIAL_EXTENSION)).exists()
+
+
+def test_stream_download_resumes_partial_file(file_server, tmp_path):
+    path = str(tmp_path / 'frame.jpg')
+    with open(path + services.PARTIAL_EXTENSION, 'wb') as f:
+        f.write(CONTENT[:1000])
+    services.stream_download(file_server.url, path)
+    assert read(path) == CONTENT
+    assert file_server.ranges == ['bytes=1000-']
+
+
+def test_stream_download_range_ignored(file_server, tmp_path):
+    file_server.ignore_range = True
+    path = str(tmp_path / 'frame.jpg')
+    with open(path + services.PARTIAL_EXTENSION, 'wb') as f:
+        f.write(CONTENT[:1000])
+    services.stream_download(file_server.url, path)
+    # The whole file sent with 200 replaces the partial file rather than being appended to it.
+    assert read(path) == CONTENT
+    assert file_server.ranges == ['bytes=1000-']
+
+
+def test_stream_download_range_not_satisfiable(file_server, tmp_path):
+    path = str(tmp_path / 'frame.jpg')
+    # A partial file longer than the file on the server, which has changed since.
+    with open(path + services.PARTIAL_EXTENSION, 'wb') as f:
+        f.write(CONTENT + b'stale')
+    services.stream_download(file_server.url, path)
+    assert read(path) == CONTENT
+    assert file_server.ranges == [f'bytes={len(CONTENT) + 5}-', None]
+
+
+def test_stream_download_resumes_truncated_body(file_server, tmp_path, monkeypatch):
+    # Chunks small enough that the part received before the cut is written.
+    monkeypatch.setattr(services, 'DOWNLOAD_CHUNK_SIZE', 1024)
+    file_server.truncate = 1
+    path = str(tmp_path / 'frame.jpg')
+    services.stream_download(file_server.url, path)
+    assert read(path) == CONTENT
+    assert file_server.ranges == [None, f'bytes={len(CONTENT) // 2}-']
+
+
+def test_stream_download_truncated_body(file_server, tmp_path, monkeypatch):
+    # Chunks small enough that the part received before the cut is written.
+    monkeypatch.setattr(services, 'DOWNLOAD_CHUNK_SIZE', 1024)
+    file_server.truncate = 3
+    path = str(tmp_path / 'frame.jpg')
+    with pytest.raises(services.IncompleteDownload):
+        services.stream_download(file_server.url, path, attempts=3)
+    # Only complete files are renamed to path; the partial file is kept to resume from.
+    assert not (tmp_path / 'frame.jpg').exists()
+    assert len(file_server.ranges) == 3
+    assert 0 < len(read(path + services.PARTIAL_EXTENSION)) < len(CONTENT)
@@ -0,0 +1,159 @@
+import os
+
+import pytest
+
+import thumbnail_pack
+
+
+@pytest.fixture
+def pack(tmp_path):
+    pack = thumbnail_pack.Pack(directory=str(tmp_path), max_bytes=10 ** 6)
+    yield pack
+    pack.close()
+
+
+def record_size(key, data):
+    return thumbnail_pack.HEADER.size + len(key.encode()) + len(data)
+
+
+def test_packed():
+    assert thumbnail_pack.packed(os.path.join('thumbnails', 'a.jpg')) == 'thumbnails/a.jpg'
+    assert thumbnail_pack.packed('full_images/a.jpg.phash') == 'full_images/a.jpg.phash'
+    assert thumbnail_pack.packed('full_images/a.jpg') is None
+    assert thumbnail_pack.packed('thumbnails') is None
+    assert thumbnail_pack.packed(os.path.abspath('thumbnails/a.jpg')) is None
+
+
+def test_put_get(pack):
+    pack.put('thumbnails/a.jpg', b'first')
+    pack.put('thumbnails/b.jpg', b'second')
+    assert pack.get('thumbnails/a.jpg') == b'first'
+    assert pack.get('thumbnails/b.jpg') == b'second'
+    assert pack.get('thumbnails/c.jpg') is None
+    assert pack.contains('thumbnails/a.jpg')
+    assert not pack.contains('thumbnails/c.jpg')
+
+
+def test_put_replaces(pack):
+    pack.put('thumbnails/a.jpg', b'first')
+    pack.put('thumbnails/a.jpg', b'replaced')
+    assert pack.get('thumbnails/a.jpg') == b'replaced'
+    summary = pack.summary()
+    assert summary['entries'] == 1
+    assert summary['live_bytes'] == record_size('thumbnails/a.jpg', b'replaced')
+    assert summary['pack_bytes'] == summary['live_bytes'] + record_size('thumbnails/a.jpg', b'first')
+
+
+def test_get_checks_crc(pack):
+    pack.put('thumbnails/a.jpg', b'data')
+    with open(pack.pack_path(0), 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        f.write(b'X')
+    assert pack.get('thumbnails/a.jpg') is None
+
+
+def test_evict_least_recently_used(pack):
+    for n in range(5):
+        pack.put(f'thumbnails/{n}.jpg', bytes(100))
+    pack.get('thumbnails/0.jpg')
+    size = record_size('thumbnails/0.jpg', bytes(100))
+    pack.evict(3 * size)
+    assert pack.summary()['live_bytes'] == 3 * size
+    # 0 was read last, so 1 and 2 are the least recently used.
+    assert pack.contains('thumbnails/0.jpg')
+    assert not pack.contains('thumbnails/1.jpg')
+    assert not pack.contains('thumbnails/2.jpg')
+    assert pack.get('thumbnails/4.jpg') == bytes(100)
+
+
+def test_put_evicts_past_bound(tmp_path):
+    size = record_size('thumbnails/00.jpg', bytes(1000))
+    pack = thumbnail_pack.Pack(directory=str(tmp_path), max_bytes=10 * size)
+    try:
+        for n in range(11):
+            pack.put(f'thumbnails/{n:02}.jpg', bytes(1000))
+        assert pack.summary()['live_bytes'] <= 10 * size
+        assert not pack.contains('thumbnails/00.jpg')
+        assert pack.contains('thumbnails/10.jpg')
+    finally:
+        pack.close()
+
+
+def test_compact(pack):
+    for n in range(5):
+        pack.put(f'thumbnails/{n}.jpg', bytes([n]) * 100)
+    pack.put('thumbnails/0.jpg', b'replaced')
+    pack.evict(pack.summary()['live_bytes'] - record_size('thumbnails/1.jpg', bytes(100)))
+    pack.get('thumbnails/2.jpg')
+    pack.compact()
+
+    assert not os.path.exists(pack.pack_path(0))
+    assert os.path.exists(pack.pack_path(1))
+    summary = pack.summary()
+    assert summary['pack_bytes'] == summary['live_bytes']
+    assert pack.get('thumbnails/0.jpg') == b'replaced'
+    for n in range(2, 5):
+        assert pack.get(f'thumbnails/{n}.jpg') == bytes([n]) * 100
+    # Writes after compaction go to the new pack.
+    pack.put('thumbnails/5.jpg', b'after')
+    assert pack.get('thumbnails/5.jpg') == b'after'
+
+
+def test_rebuild_lost_index(tmp_path):
+    pack = thumbnail_pack.Pack(directory=str(tmp_path))
+    pack.put('thumbnails/a.jpg', b'first')
+    pack.put('thumbnails/b.jpg', b'second')
+    pack.put('thumbnails/a.jpg', b'replaced')
+    pack.compact()
+    pack.put('thumbnails/c.jpg', b'third')
+    pack.close()
+    for name in os.listdir(tmp_path):
+        if name.startswith('index.sqlite'):
+            os.remove(tmp_path / name)
+
+    pack = thumbnail_pack.Pack(directory=str(tmp_path))
+    try:
+        assert pack.meta('pack') == 1
+        assert pack.get('thumbnails/a.jpg') == b'replaced'
+        assert pack.get('thumbnails/b.jpg') == b'second'
+        assert pack.get('thumbnails/c.jpg') == b'third'
+        assert pack.summary()['live_bytes'] == os.path.getsize(pack.pack_path(1))
+    finally:
+        pack.close()
+
+
+def test_rebuild_stops_at_cut_record(tmp_path):
+    pack = thumbnail_pack.Pack(directory=str(tmp_path))
+    pack.put('thumbnails/a.jpg', b'first')
+    pack.put('thumbnails/b.jpg', b'second')
+    pack.close()
+    with open(os.path.join(tmp_path, 'pack-0.dat'), 'r+b') as f:
+        f.truncate(os.path.getsize(f.name) - 1)
+    for name in os.listdir(tmp_path):
+        if name.startswith('index.sqlite'):
+            os.remove(tmp_path / name)
+
+    pack = thumbnail_pack.Pack(directory=str(tmp_path))
+    try:
+        assert pack.get('thumbnails/a.jpg') == b'first'
+        assert not pack.contains('thumbnails/b.jpg')
+    finally:
+        pack.close()
+
+
+def test_open_keeps_newer_pack(tmp_path):
+    pack = thumbnail_pack.Pack(directory=str(tmp_path))
+    pack.put('thumbnails/a.jpg', b'first')
+    pack.compact()
+    pack.close()
+    # A pack left by an earlier compaction, and one being written by a compaction in another process.
+    for number in [0, 2]:
+        with open(os.path.join(tmp_path, f'pack-{number}.dat'), 'wb') as f:
+            f.write(b'partial')
+
+    pack = thumbnail_pack.Pack(directory=str(tmp_path))
+    try:
+        assert sorted(pack.pack_numbers()) == [1, 2]
+        assert pack.get('thumbnails/a.jpg') == b'first'
+    finally:
+        pack.close()
@@ -0,0 +1,428 @@
+"""
+Pack file of the small files in the local caches: thumbnails, thumbnail derivatives and perceptual hashes.
+
+Caching every thumbnail in a file of its own leaves hundreds of thousands of tiny files after months
+of use: an inode each, slow directory scans, and a page of thumbnails scattered over the disk, with
+an open round trip for every one of them on a network file system. They are appended to one pack
+file instead, read through a memory map, and found with an index kept in sqlite. The thumbnails of a
+search are written together, so loading a page of them reads neighbouring parts of one mapped file.
+
+The pack is bounded in size. Past the bound the least recently used entries are dropped from the
+index, and compaction reclaims their space by copying the live entries, in their order, to a new pack
+file. Records hold their key and checksum, so a lost index is rebuilt from the pack. Writes and
+compaction take the write lock of the index, so several processes can share a working directory.
+
+Files are still known by their cache paths, as in disk_cache, which routes the paths packed here;
+files of these directories cached before the pack are still read from disk until imported.
+
+The bound is set with an environment variable before the tool starts:
+    IMAGE_VIEWER_THUMBNAIL_PACK_MB=1024
+
+Usage, to move the files cached before the pack into it, or to compact it at once:
+    python thumbnail_pack.py import
+    python thumbnail_pack.py compact
+"""
+
+import argparse
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+DIRECTORY = 'thumbnail_pack'
+# Cache directories packed: Nexar thumbnails, and the datalake derivatives of thumbnails.DIRECTORY.
+PACKED_DIRECTORIES = ['thumbnails', 'datalake_thumbnails']
+# Files packed wherever they are cached: the hashes cached next to images by phash.
+PACKED_EXTENSIONS = ['.phash']
+
+MAX_BYTES = int(float(os.environ.get('IMAGE_VIEWER_THUMBNAIL_PACK_MB', '1024')) * 1024 * 1024)
+# Share of the bound evicted past it, so eviction doesn't run at every write.
+EVICT_MARGIN = 0.1
+# Compaction runs once this share of the pack file is space of evicted or replaced entries.
+COMPACT_RATIO = 0.5
+# Smaller pack files aren't worth compacting.
+COMPACT_MIN_BYTES = 16 * 1024 * 1024
+# Seconds between writes of the last use of entries to the index.
+USED_FLUSH_INTERVAL = 60
+
+MAGIC = b'TPK1'
+# Header of every record: magic, key length, data length and CRC-32 of the data. The key and data follow.
+HEADER = struct.Struct('<4sHII')
+
+
+def packed(path):
+    """
+    Return the key of path in the pack if it is packed, else None.
+    """
+    if os.path.isabs(path):
+        return None
+    key = os.path.normpath(path).replace(os.sep, '/')
+    parts = key.split('/')
+    if (len(parts) > 1 and parts[0] in PACKED_DIRECTORIES) or key.endswith(tuple(PACKED_EXTENSIONS)):
+        return key
+    return None
+
+
+class Pack:
+    """
+    An append-only pack file of entries by key, with its index.
+    """
+
+    def __init__(self, directory=DIRECTORY, max_bytes=MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Statements run in autocommit mode; writes are wrapped in BEGIN IMMEDIATE to lock out other processes.
+        self.conn = sqlite3.connect(os.path.join(directory, 'index.sqlite'), timeout=30, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            pack INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            crc INTEGER NOT NULL,
+            used REAL NOT NULL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_used ON entries (used)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.lock = threading.Lock()
+        self.map = None
+        self.mapped = None
+        # Last use of the entries read since the last flush, by key.
+        self.used = {}
+        self.flushed = time.monotonic()
+
+        with self.lock:
+            if self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] == 0:
+                self.rebuild()
+        self.remove_old_packs()
+
+    def pack_path(self, number):
+        return os.path.join(self.directory, f'pack-{number}.dat')
+
+    def pack_numbers(self):
+        # Numbers of the pack files in the directory.
+        return [int(name[5:-4]) for name in os.listdir(self.directory)
+                if name.startswith('pack-') and name.endswith('.dat') and name[5:-4].isdigit()]
+
+    def meta(self, name):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def set_meta(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (name, value))
+
+    def rebuild(self):
+        # Index the records of the current pack file. A record cut short by a crash ends the scan.
+        # A lost index doesn't know the current pack; it is the newest one, as compaction removes the others.
+        number = self.meta('pack') if self.conn.execute("SELECT 1 FROM meta WHERE name = 'pack'").fetchone() \
+            else max(self.pack_numbers(), default=0)
+        path = self.pack_path(number)
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return
+        log.warning(f"Rebuilding the index of {path}")
+        entries = {}
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + HEADER.size <= len(data):
+                magic, key_length, length, crc = HEADER.unpack_from(data, offset)
+                size = HEADER.size + key_length + length
+                if magic != MAGIC or offset + size > len(data):
+                    break
+                key = data[offset + HEADER.size:offset + HEADER.size + key_length].decode()
+                # A key written twice was replaced; the last record is the live one.
+                entries[key] = (key, number, offset + HEADER.size + key_length, length, size, crc, time.time())
+                offset += size
+        self.conn.execute("BEGIN IMMEDIATE")
+        self.conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)", entries.values())
+        self.set_meta('pack', number)
+        self.set_meta('live', sum(entry[4] for entry in entries.values()))
+        self.conn.execute("COMMIT")
+
+    def remove_old_packs(self):
+        # Pack files left by compaction. A newer pack than the current one is being written by a compaction
+        # in another process, and is kept. One still mapped by another process can't be removed on Windows.
+        current = self.meta('pack')
+        for number in self.pack_numbers():
+            if number < current:
+                try:
+                    os.remove(self.pack_path(number))
+                except OSError:
+                    pass
+
+    def remap(self, number):
+        # Map the whole of pack file number, as it is now.
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.mapped = number
+        try:
+            with open(self.pack_path(number), 'rb') as f:
+                if os.fstat(f.fileno()).st_size:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        """
+        Return the data of key, or None if it isn't in the pack or fails its checksum.
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT pack, offset, length, crc FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            number, offset, length, crc = row
+            # Entries appended since the pack was mapped are past the end of the map.
+            if self.mapped != number or self.map is None or offset + length > len(self.map):
+                self.remap(number)
+            if self.map is None or offset + length > len(self.map):
+                return None
+            # Slicing a map copies the data, so the map can be closed while the data is in use.
+            data = self.map[offset:offset + length]
+            self.used[key] = time.time()
+        if zlib.crc32(data) != crc:
+            log.warning(f"Checksum of {key} in the thumbnail pack does not match")
+            return None
+        return data
+
+    def contains(self, key):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+
+    def put(self, key, data):
+        """
+        Append data to the pack as key, replacing any earlier entry of key, then evict and compact if due.
+        """
+        encoded = key.encode()
+        crc = zlib.crc32(data)
+        record = HEADER.pack(MAGIC, len(encoded), len(data), crc) + encoded + data
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                number = self.meta('pack')
+                with open(self.pack_path(number), 'ab') as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    f.write(record)
+                replaced = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+                self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                  (key, number, offset + HEADER.size + len(encoded), len(data), len(record), crc,
+                                   time.time()))
+                self.set_meta('live', self.meta('live') + len(record) - (replaced[0] if replaced else 0))
+                if time.monotonic() - self.flushed > USED_FLUSH_INTERVAL:
+                    self.flush_used()
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            live = self.meta('live')
+            size = os.path.getsize(self.pack_path(number))
+
+        if live > self.max_bytes:
+            self.evict(int(self.max_bytes * (1 - EVICT_MARGIN)))
+            live = self.meta('live')
+        if size >= COMPACT_MIN_BYTES and size - live > COMPACT_RATIO * size:
+            self.compact()
+
+    def flush_used(self):
+        # Write the last use of the entries read to the index. Called in a transaction, holding the lock.
+        self.conn.executemany("UPDATE entries SET used = ? WHERE key = ?",
+                              [(used, key) for key, used in self.used.items()])
+        self.used = {}
+        self.flushed = time.monotonic()
+
+    def evict(self, target):
+        """
+        Drop the least recently used entries from the index, until the live entries take target bytes or less.
+        Their space is reclaimed by the next compaction.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.flush_used()
+                live = self.meta('live')
+                evicted = 0
+                while live > target:
+                    rows = self.conn.execute("SELECT key, size FROM entries ORDER BY used LIMIT 1000").fetchall()
+                    if not rows:
+                        break
+                    for key, size in rows:
+                        if live <= target:
+                            break
+                        self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                        live -= size
+                        evicted += 1
+                self.set_meta('live', live)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        log.info(f"Evicted {evicted} entries from the thumbnail pack")
+
+    def compact(self):
+        """
+        Copy the live entries, in their order, to a new pack file, and remove the old one.
+        Entries are still read from the old pack until the new one is committed.
+        """
+        # A connection of its own, so readers holding the lock aren't kept waiting during the copy.
+        conn = sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30, isolation_level=None)
+        new_path = None
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE name = 'pack'").fetchone()
+                number = row[0] if row else 0
+                old_path = self.pack_path(number)
+                if not os.path.exists(old_path):
+                    conn.execute("ROLLBACK")
+                    return
+                new_path = self.pack_path(number + 1)
+                entries = conn.execute("SELECT key, offset, size, length FROM entries WHERE pack = ? "
+                                       "ORDER BY offset", (number,)).fetchall()
+                moved = []
+                with open(old_path, 'rb') as source, open(new_path, 'wb') as destination:
+                    data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) if entries else None
+                    try:
+                        for key, offset, size, length in entries:
+                            record_offset = offset + length - size
+                            moved.append((number + 1, destination.tell() + size - length, key))
+                            destination.write(data[record_offset:record_offset + size])
+                    finally:
+                        if data is not None:
+                            data.close()
+                    destination.flush()
+                    os.fsync(destination.fileno())
+                conn.executemany("UPDATE entries SET pack = ?, offset = ? WHERE key = ?", moved)
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('pack', ?)", (number + 1,))
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('live', ?)", (sum(entry[2] for entry in entries),))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                if new_path is not None and os.path.exists(new_path):
+                    os.remove(new_path)
+                raise
+        finally:
+            conn.close()
+
+        log.info(f"Compacted the thumbnail pack from {os.path.getsize(old_path) / 1e6:.1f} MB "
+                 f"to {os.path.getsize(new_path) / 1e6:.1f} MB")
+        with self.lock:
+            if self.mapped == number:
+                self.remap(number + 1)
+        self.remove_old_packs()
+
+    def summary(self):
+        """
+        Return the entries, their bytes, the bytes of the pack file and the bytes mapped.
+        """
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            live = self.meta('live')
+            path = self.pack_path(self.meta('pack'))
+            mapped = len(self.map) if self.map is not None else 0
+        return {'entries': entries, 'live_bytes': live,
+                'pack_bytes': os.path.getsize(path) if os.path.exists(path) else 0, 'mapped_bytes': mapped}
+
+    def close(self):
+        with self.lock:
+            if self.used:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.flush_used()
+                self.conn.execute("COMMIT")
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.conn.close()
+
+
+_lock = threading.Lock()
+_pack = None
+
+
+def _open():
+    # Open the pack the first time it is needed.
+    global _pack
+    with _lock:
+        if _pack is None:
+            _pack = Pack()
+        return _pack
+
+
+def get(path):
+    """
+    Return the data of the packed path, or None if it isn't in the pack.
+    """
+    return _open().get(packed(path))
+
+
+def contains(path):
+    return _open().contains(packed(path))
+
+
+def put(path, data):
+    _open().put(packed(path), data)
+
+
+def mapped_bytes():
+    """
+    Return the bytes of the pack mapped in memory, without opening the pack.
+    """
+    pack = _pack
+    return pack.summary()['mapped_bytes'] if pack is not None else 0
+
+
+def close():
+    """
+    Close the pack, if open. It is opened again when next needed.
+    """
+    global _pack
+    with _lock:
+        if _pack is not None:
+            _pack.close()
+            _pack = None
+
+
+def import_files(root='.'):
+    """
+    Move the packed files cached before the pack into it. Return the number of files moved.
+    """
+    pack = _open()
+    moved = 0
+    for directory, names, files in os.walk(root):
+        # The pack's own directory holds nothing to import.
+        names[:] = [name for name in names if os.path.join(directory, name) != os.path.join(root, DIRECTORY)]
+        for name in files:
+            path = os.path.relpath(os.path.join(directory, name), root)
+            key = packed(path)
+            if key is None or name.endswith('.tmp'):
+                continue
+            with open(os.path.join(root, path), 'rb') as f:
+                pack.put(key, f.read())
+            os.remove(os.path.join(root, path))
+            moved += 1
+    return moved
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Import the cached thumbnails into the pack, or compact it.')
+    parser.add_argument('command', choices=['import', 'compact', 'summary'])
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    if args.command == 'import':
+        print(f"Moved {import_files()} files into the pack.")
+    elif args.command == 'compact':
+        _open().compact()
+    print(_open().summary())
+    close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Thumbnail derivatives of datalake images, stored in s3 next to the images they are rendered from.
+
+The datalake search fills its grid from these small derivatives, and the original is only downloaded
+when an image is opened in the viewer. The derivative of s3://ushr-image/Nexar/abc.jpg is
+s3://ushr-image/Nexar/abc.thumb.jpg.
+"""
+
+import io
+import logging
+import os
+import tempfile
+
+from PIL import Image
+
+import disk_cache
+import local_index
+import services
+import thumbnail_pack
+
+log = logging.getLogger(__name__)
+
+# Largest width and height of a derivative; the aspect ratio of the image is kept.
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_SUFFIX = '.thumb.jpg'
+# Local cache of the derivatives rendered or downloaded.
+DIRECTORY = 'datalake_thumbnails'
+
+
+def thumbnail_name(name):
+    """
+    Return the file name or key of the derivative of an image file name or key.
+    """
+    return os.path.splitext(name)[0] + THUMBNAIL_SUFFIX
+
+
+def render(source):
+    """
+    Return the JPEG bytes of the derivative of an image.
+
+    Parameters:
+    - source: str or bytes, the image path or the image itself.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    with Image.open(source) as image:
+        # draft lets the JPEG decoder downscale while decoding, which is much cheaper on large originals.
+        image.draft('RGB', THUMBNAIL_SIZE)
+        image = image.convert('RGB')
+        image.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def upload_thumbnail(source, bucket, key, directory=DIRECTORY):
+    """
+    Render the derivative of an image and upload it next to the image at bucket/key.
+    The derivative is kept in directory, by default the local cache, so this tool doesn't download it again.
+    Return the local path of the derivative; in the local cache, the path it is cached under in the pack.
+    """
+    data = render(source)
+    path = os.path.join(directory, thumbnail_name(os.path.basename(key)))
+    if thumbnail_pack.packed(path):
+        # The local cache keeps derivatives in its pack; the upload is made from a temporary file.
+        disk_cache.write_async(path, data)
+        with tempfile.NamedTemporaryFile(suffix=THUMBNAIL_SUFFIX, delete=False) as f:
+            f.write(data)
+        try:
+            services.upload_file(f.name, bucket, thumbnail_name(key))
+        finally:
+            os.remove(f.name)
+        return path
+
+    os.makedirs(directory, exist_ok=True)
+    # Write to a temporary file first, so an interrupted write never leaves a truncated derivative.
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+
+    services.upload_file(path, bucket, thumbnail_name(key))
+    return path
+
+
+def load(source, result, auth_token, status=log.info):
+    """
+    Return the path and JPEG bytes of the thumbnail of a search result, from the local caches first.
+    The datalake derivative of a result is preferred to the original, and frames already in the datalake
+    are loaded from s3 rather than Nexar. Raise if it can't be loaded.
+
+    Parameters:
+    - source: local_index.DATALAKE for a datalake row, or local_index.NEXAR for a Nexar frame.
+    - status: called with a message for every image downloaded.
+    """
+    # Thumbnails are loaded into memory; the disk cache is written in the background.
+    if source == local_index.DATALAKE:
+        path, data = _load_datalake(result[1], status)
+    elif result.get('datalake_s3_location'):
+        path, data = _load_known_frame(result, status)
+    else:
+        path, data = _download_nexar(result['thumbnail_url'], auth_token, status)
+
+    # Record where the thumbnail is cached, so the local index can offer this result offline.
+    key = result[1] if source == local_index.DATALAKE else result['frame_id']
+    local_index.set_thumbnail_path(source, key, path)
+    return path, data
+
+
+def _load_datalake(s3_location, status):
+
+    file, bucket, key = services.split_s3_location(s3_location)
+
+    # Use the derivative stored next to the image in s3, if there is one.
+    path = DIRECTORY + '/' + thumbnail_name(file)
+    data = disk_cache.read(path)
+    if data is None:
+        try:
+            data = services.read_file(bucket, thumbnail_name(key))
+        except Exception:
+            # Images not backfilled yet have no derivative; fall back to the original.
+            data = None
+        else:
+            disk_cache.write_async(path, data)
+    if data is not None:
+        return path, data
+
+    # Download the original from s3 if not already downloaded. Raises if it can't be.
+    path = 'datalake_images/' + file
+    data = disk_cache.read(path)
+    if data is not None:
+        status(f'Image previously downloaded: /datalake_images/{file}')
+    else:
+        data = services.read_file(bucket, key)
+        disk_cache.write_async(path, data)
+        status(f'Image downloaded: /datalake_images/{file}')
+    return path, data
+
+
+def _load_known_frame(frame, status):
+
+    # A Nexar thumbnail or full image already on disk is cheaper than an s3 download.
+    for path in ['thumbnails/' + frame['thumbnail_url'].split('/')[-1],
+                 'full_images/' + frame['frame_url'].split('/')[-1]]:
+        data = disk_cache.read(path)
+        if data is not None:
+            return path, data
+
+    return _load_datalake(frame['datalake_s3_location'], status)
+
+
+def _download_nexar(url, auth_token, status):
+
+    file = url.split('/')[-1]
+    path = 'thumbnails/' + file
+
+    # Thumbnails shown for an earlier filter of the same results are already cached.
+    data = disk_cache.read(path)
+    if data is not None:
+        return path, data
+
+    data = services.read_nexar_file(url, auth_token)
+    disk_cache.write_async(path, data)
+    status(f'Image downloaded: /thumbnails/{file}')
+    return path, data
@@ -0,0 +1,274 @@
+"""
+Timeline playback of every capture of a location, Nexar frames and Datalake images together.
+
+The captures are played in capture time order, like a video, for change detection. A sliding window
+of frames around the playhead is fetched and decoded in the background, most of it ahead of the
+playhead and a few frames behind it for stepping back. Frames are decoded at the playback size, which
+is much cheaper than a full resolution decode and keeps the window small in memory. Playback only
+advances to a frame once it is decoded, so a slow download shows as a pause, counted as a stall,
+rather than as a blank frame.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+
+from PyQt5 import QtCore, QtGui, QtWidgets
+from PyQt5.QtCore import Qt
+
+import export
+import geodesy
+import result_filter
+import services
+
+# Frames kept fetched and decoded ahead of and behind the playhead.
+WINDOW_AHEAD = 24
+WINDOW_BEHIND = 8
+# Frames fetched at once.
+FETCH_WORKERS = 6
+# Frames are decoded to fit this size.
+PLAYBACK_SIZE = QtCore.QSize(1280, 720)
+DEFAULT_FPS = 5
+# Milliseconds between checks for frames that finished loading while paused or buffering.
+REFRESH_INTERVAL = 50
+
+
+def timeline_entries(datalake_rows, nexar_frames, latitude, longitude, radius_meters):
+    """
+    Return (captured, label, sources) of the results within radius_meters of a point, in capture time order.
+    captured is in epoch seconds, and sources are for services.fetch_image. Nexar frames already in the
+    datalake are only played once, from the datalake row.
+    """
+    entries = []
+    locations = set()
+
+    points = [result_filter.parse_point(row[4]) for row in datalake_rows]
+    keep = geodesy.within_radius(latitude, longitude, radius_meters,
+                                 [point[1] for point in points], [point[0] for point in points])
+    for row, inside in zip(datalake_rows, keep):
+        if inside and row[7] is not None:
+            entries.append((row[7].timestamp(), f"Datalake, captured {row[7]}", export.datalake_row_sources(row)))
+            locations.add(row[1])
+
+    keep = geodesy.within_radius(latitude, longitude, radius_meters,
+                                 [frame['gps_info']['latitude'] for frame in nexar_frames],
+                                 [frame['gps_info']['longitude'] for frame in nexar_frames])
+    for frame, inside in zip(nexar_frames, keep):
+        if not inside or frame.get('captured_at') is None or frame.get('datalake_s3_location') in locations:
+            continue
+        # captured_at is epoch ms
+        captured = float(frame['captured_at']) / 1000
+        entries.append((captured, f"Nexar {frame.get('direction')}, captured {dt.fromtimestamp(captured)}",
+                        export.nexar_frame_sources(frame)))
+
+    entries.sort(key=lambda entry: entry[0])
+    return entries
+
+
+def decode_scaled(path, size=PLAYBACK_SIZE):
+    """
+    Return the image at path decoded to fit size, keeping its aspect ratio. Raise if it can't be decoded.
+    """
+    reader = QtGui.QImageReader(path)
+    full = reader.size()
+    if full.isValid():
+        reader.setScaledSize(full.scaled(size, Qt.KeepAspectRatio).boundedTo(full))
+    image = reader.read()
+    if image.isNull():
+        raise ValueError(f'Image could not be decoded: {path}; {reader.errorString()}')
+    return image
+
+
+class FrameWindow:
+    """
+    Fetches and decodes the frames within a window around the playhead, nearest to it first.
+    """
+
+    def __init__(self, entries, auth_token=None, ahead=WINDOW_AHEAD, behind=WINDOW_BEHIND, workers=FETCH_WORKERS):
+        self.entries = entries
+        self.auth_token = auth_token
+        self.ahead = ahead
+        self.behind = behind
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='timeline')
+        # Future of the decoded image of every frame in the window, by index.
+        self.futures = {}
+
+    def move(self, playhead):
+        """
+        Move the window to the playhead: frames that left it are dropped, and frames that entered it are queued.
+        """
+        wanted = range(max(playhead - self.behind, 0), min(playhead + self.ahead + 1, len(self.entries)))
+        for index in list(self.futures):
+            if index not in wanted:
+                self.futures.pop(index).cancel()
+        # The frames about to be played come first, then the ones behind.
+        for index in sorted(wanted, key=lambda index: (index < playhead, abs(index - playhead))):
+            if index not in self.futures:
+                self.futures[index] = self.executor.submit(self.load, index)
+
+    def load(self, index):
+        # Runs in the executor. The image is fetched from the first source that has it, and cached on disk.
+        path = services.fetch_image(self.entries[index][2], self.auth_token)
+        return decode_scaled(path)
+
+    def state(self, index):
+        """
+        Return ('ready', image), ('failed', error) or ('loading', None) for the frame at index.
+        """
+        future = self.futures.get(index)
+        if future is None or not future.done():
+            return 'loading', None
+        try:
+            return 'ready', future.result()
+        except Exception as e:
+            return 'failed', str(e)
+
+    def buffered(self, playhead):
+        # Return the number of frames ready, or failed and to be skipped, in a row ahead of the playhead.
+        count = 0
+        for index in range(playhead + 1, min(playhead + self.ahead + 1, len(self.entries))):
+            if self.state(index)[0] == 'loading':
+                break
+            count += 1
+        return count
+
+    def decoded(self):
+        # Return the bytes and number of the frames decoded in the window.
+        images = [future.result() for future in list(self.futures.values())
+                  if future.done() and not future.cancelled() and future.exception() is None]
+        return sum(image.sizeInBytes() for image in images), len(images)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TimelineWindow(QtWidgets.QWidget):
+    """
+    A player of timeline entries, with a slider to scrub through them and a frame rate.
+    Left and right arrow keys step a frame, and space plays or pauses.
+    """
+
+    def __init__(self, entries, auth_token=None, fps=DEFAULT_FPS):
+        super().__init__()
+        self.setWindowTitle(f'Timeline of {len(entries)} captures')
+        self.entries = entries
+        self.frames = FrameWindow(entries, auth_token)
+        self.playhead = 0
+        # Index of the frame shown, or None while the one at the playhead is loading.
+        self.shown = None
+        self.stalls = 0
+        self.pixmap = None
+
+        self.label = QtWidgets.QLabel('Loading ...')
+        self.label.setAlignment(Qt.AlignCenter)
+        self.label.setSizePolicy(QtWidgets.QSizePolicy.Ignored, QtWidgets.QSizePolicy.Ignored)
+        self.slider = QtWidgets.QSlider(Qt.Horizontal)
+        self.slider.setRange(0, max(len(entries) - 1, 0))
+        self.button_play = QtWidgets.QPushButton('Play')
+        self.spin_box_fps = QtWidgets.QSpinBox()
+        self.spin_box_fps.setRange(1, 30)
+        self.spin_box_fps.setSuffix(' frames/s')
+        self.spin_box_fps.setValue(fps)
+        self.label_status = QtWidgets.QLabel()
+
+        controls = QtWidgets.QHBoxLayout()
+        controls.addWidget(self.button_play)
+        controls.addWidget(self.slider, 1)
+        controls.addWidget(self.spin_box_fps)
+        layout = QtWidgets.QVBoxLayout(self)
+        layout.addWidget(self.label, 1)
+        layout.addLayout(controls)
+        layout.addWidget(self.label_status)
+
+        # Advances the playhead at the frame rate while playing.
+        self.timer_play = QtCore.QTimer(self)
+        self.timer_play.setTimerType(Qt.PreciseTimer)
+        self.timer_play.setInterval(1000 // fps)
+        self.timer_play.timeout.connect(self.advance)
+        # Shows a frame that finished loading, and the buffer status.
+        self.timer_refresh = QtCore.QTimer(self)
+        self.timer_refresh.setInterval(REFRESH_INTERVAL)
+        self.timer_refresh.timeout.connect(self.refresh)
+
+        self.button_play.clicked.connect(self.toggle_play)
+        self.slider.valueChanged.connect(self.seek)
+        self.spin_box_fps.valueChanged.connect(lambda value: self.timer_play.setInterval(1000 // value))
+
+        self.frames.move(0)
+        self.timer_refresh.start()
+
+    def toggle_play(self):
+        if self.timer_play.isActive():
+            self.timer_play.stop()
+            self.button_play.setText('Play')
+        else:
+            if self.playhead >= len(self.entries) - 1:
+                self.seek(0)
+            self.timer_play.start()
+            self.button_play.setText('Pause')
+
+    def seek(self, index):
+        # Move the playhead, from the slider or the keys.
+        if index == self.playhead and self.shown == index:
+            return
+        self.playhead = index
+        self.frames.move(index)
+        self.refresh()
+
+    def advance(self):
+        # Move to the next frame if it is decoded; otherwise hold the current one until it is.
+        following = self.playhead + 1
+        if following >= len(self.entries):
+            self.toggle_play()
+            return
+        if self.frames.state(following)[0] == 'loading':
+            self.stalls += 1
+            return
+        self.set_playhead(following)
+
+    def set_playhead(self, index):
+        # Move the slider without seeking twice.
+        self.slider.blockSignals(True)
+        self.slider.setValue(index)
+        self.slider.blockSignals(False)
+        self.seek(index)
+
+    def refresh(self):
+        state, value = self.frames.state(self.playhead) if self.entries else ('failed', 'No captures to play.')
+        if self.shown != self.playhead:
+            if state == 'ready':
+                self.pixmap = QtGui.QPixmap.fromImage(value)
+                self.rescale()
+                self.shown = self.playhead
+            elif state == 'failed':
+                self.label.setText(f'Frame could not be loaded; {value}')
+                self.shown = self.playhead
+
+        if self.entries:
+            captured, label, sources = self.entries[self.playhead]
+            self.label_status.setText(f"{self.playhead + 1} of {len(self.entries)}: {label}. "
+                                      f"{self.frames.buffered(self.playhead)} frames buffered ahead, "
+                                      f"{self.stalls} stalls.")
+
+    def rescale(self):
+        if self.pixmap is not None:
+            self.label.setPixmap(self.pixmap.scaled(self.label.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.rescale()
+
+    def keyPressEvent(self, event):
+        if event.key() == Qt.Key_Right and self.playhead < len(self.entries) - 1:
+            self.set_playhead(self.playhead + 1)
+        elif event.key() == Qt.Key_Left and self.playhead > 0:
+            self.set_playhead(self.playhead - 1)
+        elif event.key() == Qt.Key_Space:
+            self.toggle_play()
+        else:
+            super().keyPressEvent(event)
+
+    def closeEvent(self, event):
+        self.timer_play.stop()
+        self.timer_refresh.stop()
+        self.frames.close()
+        super().closeEvent(event)